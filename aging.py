@@ -0,0 +1,124 @@
+# aging.py - how long requests wait at each approval stage
+#
+# Every transition stamps <role>_at / <role>_by on the request and resets
+# stage_entered_at (see models._transition_statement). stage_waits() turns
+# that into per-stage wait percentiles with window functions (an index range
+# scan on each <role>_at, live and archived), queue_aging() counts what is
+# waiting now and how much of it is past APPROVAL_SLA_HOURS (an index range
+# scan on stage, stage_entered_at), and flag_overdue() marks newly overdue
+# requests and tells their approvers, once per stage visit. It runs from the
+# outbox worker every SLA_CHECK_INTERVAL seconds and from
+# `flask --app app flag-overdue`. Requests already queued when migration
+# 0008 added the timestamps start out flagged, so they are only reported
+# from their next stage on.
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, literal, select, union_all, update
+
+from models import db, Reimbursement, reimbursement_entity
+from notifications import notify, stage_recipients
+from pipeline import PIPELINE, STAGES, get_stage
+
+
+def _seconds(later, earlier):
+    # later - earlier in seconds, for the configured database
+    if db.engine.dialect.name == 'postgresql':
+        return func.extract('epoch', later - earlier)
+    return (func.julianday(later) - func.julianday(earlier)) * 86400
+
+
+def _hours(seconds):
+    return round(seconds / 3600, 1) if seconds is not None else None
+
+
+def stage_waits(days=90, now=None):
+    # Per stage: how many requests it acted on in the last `days` days and
+    # the p50 / p90 / max hours they waited there. A stage is entered when
+    # the previous non-skipped stage acted (or on submission).
+    now = now or datetime.utcnow()
+    since = now - timedelta(days=days)
+    entity = reimbursement_entity(include_archived=True)
+    waits, entered = [], entity.submitted_at
+    for stage in PIPELINE:
+        acted = getattr(entity, f'{stage.prefix}_at')
+        waits.append(select(literal(stage.role).label('stage'), _seconds(acted, entered).label('wait'))
+                     .where(acted >= since))
+        entered = func.coalesce(acted, entered)
+    waits = union_all(*waits).subquery('waits')
+
+    # Nearest-rank percentiles: the smallest wait whose rank reaches p * n.
+    ranked = select(
+        waits.c.stage, waits.c.wait,
+        func.row_number().over(partition_by=waits.c.stage, order_by=waits.c.wait).label('position'),
+        func.count().over(partition_by=waits.c.stage).label('total'),
+    ).subquery('ranked')
+    rows = db.session.execute(select(
+        ranked.c.stage, ranked.c.total,
+        func.min(case((ranked.c.position >= ranked.c.total * 0.5, ranked.c.wait))).label('p50'),
+        func.min(case((ranked.c.position >= ranked.c.total * 0.9, ranked.c.wait))).label('p90'),
+        func.max(ranked.c.wait).label('longest'),
+    ).group_by(ranked.c.stage, ranked.c.total)).all()
+
+    by_stage = {r.stage: r for r in rows}
+    return [{
+        'stage': role,
+        'count': by_stage[role].total if role in by_stage else 0,
+        'p50_hours': _hours(by_stage[role].p50) if role in by_stage else None,
+        'p90_hours': _hours(by_stage[role].p90) if role in by_stage else None,
+        'max_hours': _hours(by_stage[role].longest) if role in by_stage else None,
+    } for role in STAGES]
+
+
+def queue_aging(sla_hours, now=None):
+    # Per department and stage: requests waiting now, how many are past the
+    # SLA and how long the oldest has waited.
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(hours=sla_hours)
+    rows = db.session.execute(
+        select(Reimbursement.department, Reimbursement.stage, func.count().label('waiting'),
+               func.sum(case((Reimbursement.stage_entered_at < cutoff, 1), else_=0)).label('overdue'),
+               func.min(Reimbursement.stage_entered_at).label('oldest'))
+        .where(Reimbursement.stage.in_(STAGES))
+        .group_by(Reimbursement.department, Reimbursement.stage)
+    ).all()
+    order = {role: i for i, role in enumerate(STAGES)}
+    return [{
+        'department': r.department, 'stage': r.stage, 'waiting': r.waiting, 'overdue': r.overdue or 0,
+        'oldest_hours': _hours((now - r.oldest).total_seconds()) if r.oldest else None,
+    } for r in sorted(rows, key=lambda r: (r.department or '', order[r.stage]))]
+
+
+def flag_overdue(sla_hours, sender=None, now=None):
+    # Marks requests that have waited at their stage longer than the SLA and
+    # queues one reminder per approver group; returns how many were flagged.
+    # The flag is cleared by the next transition, so each stage visit is
+    # reported once, and claiming rows with UPDATE ... RETURNING keeps
+    # concurrent runs from reporting the same request twice.
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(hours=sla_hours)
+    rows = db.session.execute(
+        update(Reimbursement)
+        .where(Reimbursement.stage.in_(STAGES), Reimbursement.stage_entered_at < cutoff,
+               Reimbursement.sla_flagged_at.is_(None))
+        # Not a change to the request itself: keep updated_at (report cache key).
+        .values(sla_flagged_at=now, updated_at=Reimbursement.updated_at)
+        .returning(Reimbursement.id, Reimbursement.stage, Reimbursement.department, Reimbursement.amount,
+                   Reimbursement.stage_entered_at)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    groups = {}
+    for r in rows:
+        stage = get_stage(r.stage)
+        groups.setdefault((stage.role, r.department if stage.scoped else None), []).append(r)
+    for (role, department), group in groups.items():
+        stage = get_stage(role)
+        lines = "\n".join(
+            f"  - Request {r.id}: ₹{r.amount} ({r.department}), waiting since {r.stage_entered_at:%Y-%m-%d %H:%M}"
+            for r in sorted(group, key=lambda r: r.stage_entered_at))
+        notify(f"⏰ Overdue: {role} approval ({len(group)} requests)", stage_recipients(stage, department),
+               f"The following reimbursement requests have been waiting for {role} approval for more than "
+               f"{sla_hours:g} hours:\n\n{lines}\n\nPlease login to review.",
+               [r.id for r in group], sender=sender, topic=f"⏰ Overdue: {role} approval")
+    db.session.commit()
+    return len(rows)
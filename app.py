@@ -1,93 +1,297 @@
 # app.py (PostgreSQL + SQLAlchemy version)
 from mailbox import Message
-from flask import Flask, Response, render_template, request, redirect, send_from_directory, url_for, session, flash
+from flask import Blueprint, Flask, Response, abort, current_app, get_template_attribute, jsonify, render_template, request, redirect, send_file, url_for, session, flash, stream_with_context
 from flask_mail import *
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from datetime import datetime
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.graphics.barcode.qr import QrCodeWidget
-from reportlab.graphics import renderPDF
+import io
+import json
+import queue
 import random
 import os
-import tempfile
+import time
+import click
 
 # Models and database operations
 from models import (
     db,
-    insert_user, get_user_by_email, get_emails_by_role_and_dept, get_emails_by_role,
-    get_name_by_email, get_all_users, get_all_reimbursements, insert_reimbursement,
-    get_reimbursement_by_email, get_pending_requests_for_teacher, get_pending_requests_for_hod,
-    get_pending_requests_for_principal, get_pending_requests_for_md, get_pending_requests_for_accountant,
-    update_teacher_approval, update_hod_approval, update_principal_approval,
-    update_md_approval, update_accountant_approval, get_request_details,
-    User, Reimbursement
+    insert_user, get_user_by_email, get_emails_by_role_and_dept,
+    get_name_by_email, get_user_profile, get_users_page, get_reimbursements_page, insert_reimbursement,
+    get_reimbursement_by_email, get_pending_requests,
+    transition_request, enqueue_email,
+    bulk_update_approval, STAGES, STAGE_PROCESSED, STAGE_REJECTED,
+    get_summary, rebuild_summary, filter_reimbursements, set_notify_mode, PAGE_SIZE,
+    get_reimbursement, Reimbursement, PayoutBatch, student_scope
 )
+from migrations import run_migrations
+from exports import EXPORT_FORMATS, export_reimbursements_stream
+from reports import ReportService
+from payouts import PayoutService, create_payout_batch, run_payout_batch
+from storage import init_storage, store_upload, serve_upload
+from archive import archive_finalised, count_archivable
+from aging import flag_overdue, queue_aging, stage_waits
+from maintenance import NORMALIZE_JOB, count_unnormalized_statuses, normalize_statuses, reset_checkpoint
+from profiling import QueryProfiler
+from replicas import ReplicaRouter, read_replica, replica_binds
+from caching import conditional_get
+from sessions import init_sessions, regenerate_session
+from events import channels_for, init_events, stage_channel
+from search import search_reimbursements
+from pipeline import PIPELINE, get_stage, is_final
+from notifications import NOTIFY_MODES, notify, send_due_digests, stage_recipients
+from provisioning import DEPARTMENTS, import_users, redeem_invite
+from mailer import OutboxWorker, drain_outbox, outbox_stats, retry_failed
+import config
 from config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_TRACK_MODIFICATIONS
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
 load_dotenv()
 
-# Email config
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
-app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
-app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
-app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
-mail = Mail(app)
-
-# Uploads config
 UPLOAD_FILE = 'uploads'
-ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'pdf'])
-app.config['UPLOAD_FOLDER'] = UPLOAD_FILE
-if not os.path.exists(UPLOAD_FILE):
-    os.makedirs(UPLOAD_FILE)
-
-# Database config
-app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = SQLALCHEMY_TRACK_MODIFICATIONS
-print("📦 SQLALCHEMY_DATABASE_URI =", app.config['SQLALCHEMY_DATABASE_URI'])
-
 
-db.init_app(app)
-
-with app.app_context():
+mail = Mail()
+
+# Routes and CLI commands live on this blueprint; create_app() wires it to an
+# app. cli_group=None keeps the commands at the top level (flask --app app migrate).
+bp = Blueprint('main', __name__, cli_group=None)
+
+
+def create_app(overrides=None):
+    # Cheap and DB-independent: no queries, no DDL and no PDF imports happen
+    # here, so workers boot fast and `gunicorn --preload` can fork safely.
+    # Schema changes are applied by `flask --app app migrate`.
+    app = Flask(__name__)
+    app.secret_key = config.SECRET_KEY
+    if not app.secret_key:
+        app.logger.warning("SECRET_KEY is not set; using a random key, sessions will not survive restarts "
+                           "or work across workers")
+        app.secret_key = os.urandom(24)
+
+    # Session config
+    for key in ('SESSION_BACKEND', 'SESSION_LIFETIME', 'SESSION_ANONYMOUS_LIFETIME', 'SESSION_SWEEP_INTERVAL', 'OTP_TTL'):
+        app.config[key] = getattr(config, key)
+
+    # Email config
+    app.config['MAIL_SERVER'] = config.MAIL_SERVER
+    app.config['MAIL_PORT'] = config.MAIL_PORT
+    app.config['MAIL_USE_TLS'] = config.MAIL_USE_TLS
+    app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
+    app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
+    app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
+    for key in ('MAIL_OUTBOX_WORKERS', 'MAIL_OUTBOX_BATCH_SIZE', 'MAIL_OUTBOX_POLL_INTERVAL', 'MAIL_OUTBOX_LEASE',
+                'MAIL_OUTBOX_MAX_ATTEMPTS', 'MAIL_OUTBOX_BACKOFF_BASE', 'MAIL_OUTBOX_BACKOFF_MAX',
+                'NOTIFY_DIGEST_INTERVAL', 'APPROVAL_SLA_HOURS', 'SLA_CHECK_INTERVAL'):
+        app.config[key] = getattr(config, key)
+
+    # Uploads config
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FILE
+    app.config['UPLOAD_MAX_FILE_SIZE'] = config.UPLOAD_MAX_FILE_SIZE
+    app.config['UPLOAD_MAX_REQUEST_SIZE'] = config.UPLOAD_MAX_REQUEST_SIZE
+    app.config['UPLOAD_CACHE_MAX_AGE'] = config.UPLOAD_CACHE_MAX_AGE
+    app.config['RELEASE_ID'] = config.RELEASE_ID
+
+    # PDF reports config
+    app.config['REPORT_CACHE_DIR'] = config.REPORT_CACHE_DIR
+    app.config['REPORT_WORKERS'] = config.REPORT_WORKERS
+    app.config['REPORT_WAIT'] = config.REPORT_WAIT
+    app.config['PAYOUT_DIR'] = config.PAYOUT_DIR
+    app.config['ARCHIVE_AFTER_DAYS'] = config.ARCHIVE_AFTER_DAYS
+    app.config['PAYOUT_WORKERS'] = config.PAYOUT_WORKERS
+
+    # Database config
+    app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = SQLALCHEMY_TRACK_MODIFICATIONS
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(config.DATABASE_REPLICA_URLS)
+    for key in ('REPLICA_MAX_LAG', 'REPLICA_CHECK_INTERVAL', 'READ_YOUR_WRITES'):
+        app.config[key] = getattr(config, key)
+
+    for key in ('PROVISION_WORKERS', 'PROVISION_BATCH_SIZE', 'INVITE_TTL'):
+        app.config[key] = getattr(config, key)
+
+    for key in ('EVENTS_BACKEND', 'EVENTS_POLL_INTERVAL', 'SSE_HEARTBEAT', 'SSE_MAX_DURATION', 'SSE_MAX_STREAMS',
+                'SSE_RETRY_AFTER'):
+        app.config[key] = getattr(config, key)
+
+    for key in ('QUERY_PROFILING', 'QUERY_PROFILING_SLOW_MS', 'QUERY_PROFILING_REPEAT_THRESHOLD', 'QUERY_PROFILING_TOP'):
+        app.config[key] = getattr(config, key)
+
+    app.config.update(overrides or {})
+
+    mail.init_app(app)
+    init_storage(app)
+    ReportService(app)
+    PayoutService(app)
+    db.init_app(app)
+    init_sessions(app)
+    ReplicaRouter(app)
+    init_events(app, lambda: db.engine)
+    QueryProfiler(app)
+    app.register_blueprint(bp)
+    return app
+
+
+# Outbox delivery threads are started lazily so each (forked) worker process
+# gets its own; run `flask --app app outbox-worker` for a dedicated process.
+@bp.before_app_request
+def start_outbox_worker():
+    app = current_app._get_current_object()
+    if 'outbox_worker' not in app.extensions and app.config['MAIL_OUTBOX_WORKERS'] > 0:
+        app.extensions['outbox_worker'] = OutboxWorker(app, mail, threads=app.config['MAIL_OUTBOX_WORKERS']).start()
+
+
+@bp.cli.command('outbox-worker')
+@click.option('--threads', default=2, show_default=True, help='Delivery threads.')
+@click.option('--once', is_flag=True, help='Drain whatever is due and exit.')
+def outbox_worker_command(threads, once):
+    """Deliver queued emails from the mail outbox."""
+    app = current_app._get_current_object()
+    if once:
+        click.echo(f"Sent {drain_outbox(app, mail)} message(s)")
+        return
+    worker = OutboxWorker(app, mail, threads=threads).start()
+    click.echo(f"Outbox worker running with {threads} thread(s), Ctrl+C to stop")
+    try:
+        while True:
+            worker._stop.wait(60)
+            click.echo(f"Outbox: {outbox_stats()}")
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+@bp.cli.command('outbox-retry')
+def outbox_retry_command():
+    """Re-queue messages that exhausted their delivery attempts."""
+    click.echo(f"Re-queued {retry_failed()} message(s)")
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply pending schema migrations."""
+    click.echo(f"📦 SQLALCHEMY_DATABASE_URI = {current_app.config['SQLALCHEMY_DATABASE_URI']}")
     db.create_all()
-
-def normalize_statuses():
-    with app.app_context():
-        records = Reimbursement.query.all()
-        for r in records:
-            if r.teacher_status.lower() == 'approved':
-                r.teacher_status = 'Approved'
-            if r.hod_status.lower() == 'approved':
-                r.hod_status = 'Approved'
-            if r.principal_status.lower() == 'approved':
-                r.principal_status = 'Approved'
-            if r.md_status.lower() == 'approved':
-                r.md_status = 'Approved'
-            if r.accountant_status.lower() == 'pending':
-                r.accountant_status = 'Pending'
-        db.session.commit()
-
-@app.route('/')
+    run_migrations(echo=click.echo)
+    click.echo("Database is up to date")
+
+
+@bp.cli.command('rebuild-summary')
+def rebuild_summary_command():
+    """Recompute the reimbursement summary rollup from reimb_form."""
+    rebuild_summary()
+    click.echo("Summary rebuilt")
+
+
+@bp.cli.command('normalize-statuses')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows (by id range) per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only count the rows that would change.')
+@click.option('--restart', is_flag=True, help='Ignore a saved checkpoint and start from the first id.')
+def normalize_statuses_command(batch_size, dry_run, restart):
+    """Canonicalise the casing of per-role status columns."""
+    if dry_run:
+        for column, count in count_unnormalized_statuses().items():
+            click.echo(f"{column}: {count} row(s) to update")
+        return
+    if restart:
+        reset_checkpoint(NORMALIZE_JOB)
+    totals = normalize_statuses(batch_size=batch_size, echo=click.echo)
+    for column, count in totals.items():
+        click.echo(f"{column}: {count} row(s) updated")
+
+
+@bp.cli.command('archive-finalised')
+@click.option('--older-than-days', type=int, default=None, help='Days since a request became final (default: ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', default=5000, show_default=True, help='Requests moved per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only count the requests that would move.')
+def archive_finalised_command(older_than_days, batch_size, dry_run):
+    """Move long-finalised requests from reimb_form to reimb_form_archive."""
+    days = older_than_days if older_than_days is not None else current_app.config['ARCHIVE_AFTER_DAYS']
+    if dry_run:
+        click.echo(f"{count_archivable(days)} request(s) to archive")
+        return
+    click.echo(f"Archived {archive_finalised(days, batch_size=batch_size, echo=click.echo)} request(s)")
+
+
+@bp.cli.command('import-users')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--no-invites', is_flag=True, help='Reject rows without a password instead of inviting them.')
+@click.option('--dry-run', is_flag=True, help='Validate and report without creating users.')
+@click.option('--base-url', default='http://localhost:5000', show_default=True, help='Portal URL used in invite links.')
+def import_users_command(csv_file, no_invites, dry_run, base_url):
+    """Create users in bulk from a CSV file (name,email,role,department,password)."""
+    with current_app.test_request_context(base_url=base_url):
+        result = import_users(csv_file, invite_url=lambda token: url_for('main.accept_invite', token=token, _external=True),
+                              send_invites=not no_invites, dry_run=dry_run, **import_options())
+    for line, email, message in result.errors:
+        click.echo(f"line {line}: {email or '-'}: {message}", err=True)
+    click.echo(f"{'Would create' if dry_run else 'Created'} {result.created} user(s), {result.invited} invite(s), "
+               f"{len(result.errors)} error(s)")
+
+
+@bp.cli.command('payout-report')
+@click.option('--month', required=True, help='Month the claims were processed in (YYYY-MM).')
+@click.option('--department', default=None, help='Only this department (default: all).')
+@click.option('--workers', type=int, default=None, help='PDF rendering processes (default: PAYOUT_WORKERS).')
+def payout_report_command(month, department, workers):
+    """Build the month-end ZIP of department summaries and claim reports."""
+    try:
+        batch = create_payout_batch(month, department, requested_by='cli')
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM', param_hint='--month')
+    path = run_payout_batch(batch.id, current_app.config['PAYOUT_DIR'],
+                            workers=workers or current_app.config['PAYOUT_WORKERS'], echo=click.echo)
+    click.echo(f"Payout bundle written to {path}")
+
+
+@bp.cli.command('send-digests')
+@click.option('--flush', is_flag=True, help='Send every pending digest now, not only the due ones.')
+def send_digests_command(flush):
+    """Queue hourly / daily notification digests that are due."""
+    sent = send_due_digests(sender=current_app.config['MAIL_USERNAME'], flush=flush)
+    click.echo(f"Queued {sent} digest(s)")
+
+
+@bp.cli.command('flag-overdue')
+@click.option('--sla-hours', type=float, help='Defaults to APPROVAL_SLA_HOURS.')
+def flag_overdue_command(sla_hours):
+    """Flag requests waiting past the approval SLA and remind their approvers."""
+    flagged = flag_overdue(sla_hours or current_app.config['APPROVAL_SLA_HOURS'],
+                           sender=current_app.config['MAIL_USERNAME'])
+    click.echo(f"Flagged {flagged} overdue request(s)")
+
+
+@bp.cli.command('aging-report')
+@click.option('--days', default=90, show_default=True, help='Stage actions to include, by age.')
+def aging_report_command(days):
+    """Print per-stage wait percentiles and overdue counts by department."""
+    click.echo(f"{'Stage':12} {'Acted':>7} {'p50 h':>8} {'p90 h':>8} {'max h':>8}")
+    for row in stage_waits(days):
+        click.echo(f"{row['stage']:12} {row['count']:>7} {row['p50_hours'] or '-':>8} "
+                   f"{row['p90_hours'] or '-':>8} {row['max_hours'] or '-':>8}")
+    click.echo(f"\n{'Department':12} {'Stage':12} {'Waiting':>8} {'Overdue':>8} {'Oldest h':>9}")
+    for row in queue_aging(current_app.config['APPROVAL_SLA_HOURS']):
+        click.echo(f"{row['department'] or '-':12} {row['stage']:12} {row['waiting']:>8} {row['overdue']:>8} "
+                   f"{row['oldest_hours'] or '-':>9}")
+
+
+@bp.cli.command('sweep-sessions')
+def sweep_sessions_command():
+    """Delete expired server-side sessions."""
+    store = current_app.extensions.get('sessions')
+    if store is None:
+        click.echo("Server-side sessions are disabled (SESSION_BACKEND=cookie)")
+        return
+    click.echo(f"Removed {store.sweep()} expired session(s)")
+
+
+@bp.route('/')
 def home():
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 
-@app.route('/logout', methods=['POST'])
+@bp.route('/logout', methods=['POST'])
 def logout():
     session.clear()
-    return redirect(url_for('login')) 
+    return redirect(url_for('main.login')) 
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         email = request.form['email']
@@ -95,47 +299,51 @@ def register():
         # ✅ Check if already registered
         if get_user_by_email(email):
             flash('📝 You have already registered. Please login instead.', 'warning')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
         # ✅ Continue if not registered
         if not (email.endswith('fcrit.ac.in') or email.endswith('gmail.com')):
             flash('❌ Only college or Gmail IDs allowed', 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
 
         otp = str(random.randint(100000, 999999))
         session['otp'] = otp
+        session['otp_expires_at'] = time.time() + current_app.config['OTP_TTL']
         session['email'] = email
 
-        msg = Message('Your OTP', sender=app.config['MAIL_USERNAME'], recipients=[email])
-        msg.body = f'Your OTP is {otp}'
-        mail.send(msg)
+        enqueue_email('Your OTP', [email], f'Your OTP is {otp}', sender=current_app.config['MAIL_USERNAME'])
+        db.session.commit()
 
         flash("📩 OTP sent to your email.", 'info')
-        return redirect(url_for('verify'))
+        return redirect(url_for('main.verify'))
 
     return render_template('register.html')
 
                     
 
-@app.route('/verify', methods=['GET','POST'])
+@bp.route('/verify', methods=['GET','POST'])
 def verify():
     if request.method == 'POST':
         ent_otp = request.form['otp']
+        if time.time() > session.get('otp_expires_at', 0):
+            session.pop('otp', None)
+            flash('⌛ OTP expired. Please register again.', 'warning')
+            return redirect(url_for('main.register'))
         if ent_otp == session.get('otp'):
             flash('Email verified successfully', 'success')
-            return redirect(url_for('complete_registration'))  # ✅ go to next step
+            return redirect(url_for('main.complete_registration'))  # ✅ go to next step
         else:
             flash('Invalid OTP', 'danger')
     return render_template('otp.html')
 
 
-@app.route('/complete_registration', methods=['GET', 'POST'])
+@bp.route('/complete_registration', methods=['GET', 'POST'])
 def complete_registration():
     email = session.get('email')
 
     if not email:
         flash("Session expired. Please restart registration.", "warning")
-        return redirect(url_for('register'))
+        return redirect(url_for('main.register'))
 
     if request.method == 'POST':
         name = request.form['name']
@@ -145,18 +353,18 @@ def complete_registration():
 
         if get_user_by_email(email):
             flash('User already exists. Please login.', 'warning')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
         password_hash = generate_password_hash(password)
         insert_user(name, email, password_hash, role, department)
 
         flash('Registration successful! You can now log in.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     return render_template('complete_registration.html')
 
 
-@app.route('/login', methods=['GET', 'POST'])    
+@bp.route('/login', methods=['GET', 'POST'])    
 def login():
     if request.method == 'POST':
         email = request.form['email']
@@ -165,23 +373,62 @@ def login():
 
         if user and check_password_hash(user.password_hash, password):
 
+            session.clear()
+            regenerate_session(session)
             session['department'] = user.department
             session['user_id'] = user.id
             session['role'] = user.role
             session['email'] = user.email
         # ✅ Correct: index 2 is email
             flash('Login successful', 'success')
-            return redirect(url_for(f"{user.role.lower()}_dashboard"))
+            return redirect(url_for(f"main.{user.role.lower()}_dashboard"))
         else:
             flash('Invalid credentials', 'danger')
 
     return render_template('login.html')
 
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def filter_args(scoped_department=False):
+    # Filters for list views and exports, read from the query string. Invalid
+    # values are ignored. Department-scoped roles cannot filter to another
+    # department.
+    args = request.args
+    filters = {
+        'min_amount': args.get('min_amount', type=float),
+        'max_amount': args.get('max_amount', type=float),
+        'date_from': args.get('date_from', type=lambda v: datetime.strptime(v, '%Y-%m-%d')),
+        'date_to': args.get('date_to', type=lambda v: datetime.strptime(v, '%Y-%m-%d')),
+    }
+    if not scoped_department:
+        filters['department'] = args.get('department') or None
+    if session.get('role') == 'Admin':
+        filters['status'] = args.get('status') or None
+    return filters
+
+
+def include_archived():
+    # History views read reimb_form_archive too only when asked (?archived=1).
+    return request.args.get('archived') == '1'
+
+
+def page_args(scoped_department=False):
+    # filter_args() plus keyset paging and sorting options.
+    args = request.args
+    return dict(
+        filter_args(scoped_department),
+        cursor=args.get('cursor') or None,
+        sort=args.get('sort', 'submitted_at'),
+        order='desc' if args.get('order') == 'desc' else 'asc',
+        limit=args.get('limit', type=int),
+    )
+
+
+def render_queue(template, rows, next_cursor, scoped_department=False, **context):
+    return render_template(template, requests=rows, next_cursor=next_cursor,
+                           show_department_filter=not scoped_department, **context)
+
 
-@app.route('/student/apply', methods=['GET', 'POST'])
+@bp.route('/student/apply', methods=['GET', 'POST'])
 def student_apply():
     amount = None
     if request.method == 'POST':
@@ -198,456 +445,563 @@ def student_apply():
 
         if not email:
             flash("⚠️ Session expired. Please log in again.", "warning")
-            return redirect(url_for('login'))
-
-        def save_file(file_obj, label):
-            if file_obj and allowed_file(file_obj.filename):
-                filename = secure_filename(f"{label}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file_obj.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file_obj.save(filepath)
-                return filename
-            return None
-
-        letter_filename = save_file(letter, 'letter')
-        cert_filename = save_file(certificate, 'certificate')
-        brochure_filename = save_file(brochure, 'brochure')
-        bill_filename = save_file(bill, 'bill')
-
-        insert_reimbursement(email, purpose, amount, letter_filename, cert_filename, brochure_filename, bill_filename)
-
-        # ✅ Notify Teacher(s) of the same department
+            return redirect(url_for('main.login'))
+
+        # Already streamed to disk and hashed while the form was parsed;
+        # identical documents are stored once and only referenced again.
+        documents = {
+            'letter': store_upload(letter),
+            'certificate': store_upload(certificate),
+            'brochure': store_upload(brochure),
+            'bill': store_upload(bill),
+        }
+        letter_filename, cert_filename, brochure_filename, bill_filename = (
+            d.key if d else None for d in documents.values())
+
+        reimb = insert_reimbursement(email, purpose, amount, letter_filename, cert_filename, brochure_filename,
+                                     bill_filename, documents=documents)
+
+        # ✅ Notify Teacher(s) of the same department; the outbox row commits
+        # together with the request (needs the new request's id for digests)
         teacher_emails = get_emails_by_role_and_dept('Teacher', department)
-        if teacher_emails:
-            msg = Message(
-                "New Reimbursement Request",
-                sender=app.config['MAIL_USERNAME'],
-                recipients=teacher_emails
-            )
-            msg.body = f"A student from the {department} department has submitted a reimbursement request for: {purpose}.\nPlease login to review."
-            mail.send(msg)
+        notify(
+            "New Reimbursement Request", teacher_emails,
+            f"A student from the {department} department has submitted a reimbursement request for: {purpose}.\nPlease login to review.",
+            [reimb.id], sender=current_app.config['MAIL_USERNAME']
+        )
+        db.session.commit()
 
         flash("✅ Reimbursement request submitted successfully!", "success")
-        return redirect(url_for('student_apply'))
+        return redirect(url_for('main.student_apply'))
 
     return render_template('student_form.html')
 
 
 # Dummy dashboards
 
-@app.route('/admin_dashboard')
+@bp.route('/admin_dashboard')
+@read_replica
 def admin_dashboard():
     if session.get('role') != 'Admin':
         flash('Access denied', 'danger')
-        return redirect(url_for('login'))
-
-    users = get_all_users()
-    reimbursements = get_all_reimbursements()
-    return render_template('admin_dashboard.html', users=users, reimbursements=reimbursements)
-
-
-@app.route('/export_reimbursements')
+        return redirect(url_for('main.login'))
+
+    users, next_users_after = get_users_page(after_id=request.args.get('users_after', type=int))
+    reimbursements, next_cursor = get_reimbursements_page(include_archived=include_archived(), **page_args())
+
+    # Summary panel: department x stage cells plus monthly totals, read from
+    # the rollup table (O(departments x stages) rows).
+    summary_stages = STAGES + [STAGE_PROCESSED, STAGE_REJECTED]
+    summary = {}
+    for cell in get_summary(by=('department', 'stage')):
+        summary.setdefault(cell['department'], {})[cell['stage']] = cell
+    monthly = get_summary(by=('month',))[-12:]
+    return render_template('admin_dashboard.html', users=users, next_users_after=next_users_after,
+                           reimbursements=reimbursements,
+                           next_cursor=next_cursor, show_department_filter=True, show_status_filter=True,
+                           show_archive_filter=True,
+                           summary=summary, summary_stages=summary_stages, monthly=monthly)
+
+
+@bp.route('/export_reimbursements')
+@read_replica
 def export_reimbursements():
     if session.get('role') != 'Admin':
         flash("Access denied", "danger")
-        return redirect(url_for('login'))
-
-    data = get_all_reimbursements()  # This function should return a list of tuples
-    output = []
+        return redirect(url_for('main.login'))
 
-    # Header
-    output.append(['Email', 'Purpose', 'Amount', 'Status', 'Submitted At', 'Teacher Status', 'HOD Status', 'Principal Status', 'MD Status', 'Accountant Status'])
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        flash("Unsupported export format", "danger")
+        return redirect(url_for('main.admin_dashboard'))
 
-    for row in data:
-        output.append(list(row))
+    # Rows are streamed from a server-side cursor while the response is sent,
+    # so the generator needs the request context kept alive.
+    mimetype, extension, body = export_reimbursements_stream(fmt, include_archived=include_archived(), **filter_args())
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment;filename=reimbursements.{extension}"})
 
-    # Create CSV
-    def generate():
-        for row in output:
-            yield ','.join(str(cell) for cell in row) + '\n'
+def student_scopes():
+    email = session.get('email')
+    return [student_scope(email)] if email else None
 
-    return Response(generate(), mimetype='text/csv',
-                    headers={"Content-Disposition": "attachment;filename=reimbursements.csv"})
 
-@app.route('/student_dashboard')
+@bp.route('/student_dashboard')
+@read_replica
+@conditional_get(student_scopes)
 def student_dashboard():
     email = session.get('email')
     if not email:
         flash("Please log in again.", "warning")
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
-    reimbursements = get_reimbursement_by_email(email)
+    archived = include_archived()
+    reimbursements = get_reimbursement_by_email(email, include_archived=archived)
     username = showName()
-    return render_template('student.html', reimbursements=reimbursements, username=username )
+    return render_template('student.html', reimbursements=reimbursements, username=username, archived=archived)
 
 def showName():
     email = session.get('email')
     return get_name_by_email(email)
 
 
-@app.route('/uploads/<filename>')
+@bp.route('/uploads/<filename>')
 def uploaded_file(filename):
     if session.get('role') not in ['Teacher', 'HOD', 'Principal', 'MD', 'Accountant', 'Student']:
         flash("Access denied", "danger")
-        return redirect(url_for('login'))
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        return redirect(url_for('main.login'))
+    return serve_upload(filename)
 
 
 
-# ------------------ TEACHER ------------------
-@app.route('/teacher_dashboard')
-def teacher_dashboard():
-    if session.get('role') != 'Teacher':
-        flash('Access Denied', 'danger')
-        return redirect(url_for('login'))
-    
-    department = session.get('department')
-    requests = get_pending_requests_for_teacher(department)
-    return render_template('teacher_dashboard.html', requests=requests)
+# ------------------ APPROVALS ------------------
+# One dashboard and one approve route serve every stage of the pipeline (see
+# pipeline.py); they are registered below as main.<prefix>_dashboard and
+# main.<prefix>_approve.
 
+def form_version():
+    # Version of the request the approver was looking at (hidden form field).
+    return request.form.get('version', type=int)
 
-@app.route('/teacher_approve/<int:req_id>', methods=['POST'])
-def teacher_approve(req_id):
-    if session.get('role') != 'Teacher':
-        flash('Access Denied', 'danger')
-        return redirect(url_for('login'))
 
-    remarks = request.form['remarks']
-    action = request.form['action']
+def approval_conflict(req_id):
+    # transition_request matched nothing: say what happened instead.
+    db.session.rollback()
+    current = get_reimbursement(req_id)
+    if current is None:
+        flash("Reimbursement request not found", "danger")
+    else:
+        flash(f"⚠️ Request {req_id} was changed by someone else in the meantime (now: {current.status}). "
+              "Your action was not applied.", "warning")
 
-    # ✅ Always fetch department fresh from DB to avoid session mismatch
-    teacher_email = session.get('email')
-    user = User.query.filter_by(email=teacher_email).first()
-    teacher_dept = user.department if user else "Unknown"
 
-    if action == 'approve':
-        update_teacher_approval(req_id, 'Approved', remarks)
+def approver_department(stage):
+    # Department-scoped approvers act on their own department, read from the
+    # user directory (not the session) to avoid a session mismatch.
+    if not stage.scoped:
+        return None
+    profile = get_user_profile(session.get('email'))
+    return profile.department if profile else "Unknown"
 
-        # Fetch HOD emails from actual department
-        hod_emails = get_emails_by_role_and_dept('HOD', teacher_dept)
 
-        if hod_emails:
-            msg = Message(
-                "Action Required: HOD Approval",
-                sender=app.config['MAIL_USERNAME'],
-                recipients=hod_emails
-            )
-            msg.body = f"A reimbursement request (ID: {req_id}) has been approved by the Teacher and awaits your review."
-            mail.send(msg)
+def _request_lines(rows):
+    return "\n".join(f"  - Request {r.id}: ₹{r.amount} ({r.department})" for r in rows)
 
-        flash('✅ Request approved and sent to HOD', 'success')
 
-    elif action == 'reject':
-        update_teacher_approval(req_id, 'Rejected', remarks)
-        flash('❌ Request rejected', 'danger')
+def notify_transition(stage, status, rows, remarks_by_id):
+    # Mails for requests `stage` just approved or rejected: the approvers of
+    # whichever stage each request moved on to and, after the final stage, the
+    # students and their teachers. One mail per recipient group, however many
+    # requests it covers.
+    sender = current_app.config['MAIL_USERNAME']
+    if status == 'Approved':
+        groups = {}
+        for r in rows:
+            next_stage = get_stage(r.stage)
+            if next_stage is not None:
+                groups.setdefault((next_stage.role, r.department if next_stage.scoped else None), []).append(r)
+        for (role, department), group in groups.items():
+            next_stage = get_stage(role)
+            if len(group) == 1:
+                subject = next_stage.subject
+                body = f"Request {group[0].id} has been approved by the {stage.role}. {next_stage.ask}"
+            else:
+                subject = f"{next_stage.subject} ({len(group)} requests)"
+                body = (f"The following reimbursement requests have been approved by the {stage.role} "
+                        f"and await your review:\n\n{_request_lines(group)}\n\n{next_stage.ask}")
+            notify(subject, stage_recipients(next_stage, department), body, [r.id for r in group],
+                   sender=sender, topic=next_stage.subject)
+    if not is_final(stage):
+        return
+
+    by_student = {}
+    for r in rows:
+        by_student.setdefault(r.email, []).append(r)
+    outcome = '✅ approved and processed' if status == 'Approved' else '❌ rejected by the accountant'
+    for email, group in by_student.items():
+        if len(group) == 1:
+            r = group[0]
+            body = (f"\nDear Student,\n\nYour reimbursement request (ID: {r.id}) has been {outcome}.\n\n"
+                    f"Remarks: {remarks_by_id[r.id]}\n\nThank you,\nAccounts Department\n")
+        else:
+            lines = "\n".join(f"  - Request {r.id}: ₹{r.amount} — Remarks: {remarks_by_id[r.id]}" for r in group)
+            body = (f"\nDear Student,\n\nThe following reimbursement requests have been {outcome}:\n\n{lines}\n\n"
+                    f"Thank you,\nAccounts Department\n")
+        enqueue_email('Reimbursement Status Update', [email], body, sender=sender)
+    if status != 'Approved':
+        return
+
+    # Teachers get the PDF report: attached from the report cache at send
+    # time for a single request, as download links for a batch.
+    teachers = PIPELINE[0]
+    by_department = {}
+    for r in rows:
+        by_department.setdefault(r.department, []).append(r)
+    for department, group in by_department.items():
+        recipients = stage_recipients(teachers, department)
+        if len(group) == 1:
+            r = group[0]
+            notify("✅ Final Reimbursement Report", recipients,
+                   f"\nDear Faculty,\n\nThe reimbursement request (ID: {r.id}) from student "
+                   f"{get_name_by_email(r.email)} has been fully approved and processed.\n\n"
+                   f"Please find the attached report for your records.\n\nRegards,\nReimbursement Portal\n",
+                   [r.id], sender=sender, report_id=r.id)
+        else:
+            links = "\n".join(f"  - Request {r.id}: {url_for('main.download_report', req_id=r.id, _external=True)}"
+                              for r in group)
+            notify(f"✅ Final Reimbursement Reports ({len(group)} requests)", recipients,
+                   f"\nDear Faculty,\n\nThe following reimbursement requests have been fully approved and processed. "
+                   f"Reports can be downloaded here:\n\n{links}\n\nRegards,\nReimbursement Portal\n",
+                   [r.id for r in group], sender=sender, immediate=True)
 
-    return redirect(url_for('teacher_dashboard'))
 
-# ------------------ HOD ------------------
-@app.route('/hod_dashboard')
-def hod_dashboard():
-    if session.get('role') != 'HOD':
-        flash('Access denied', 'danger')
-        return redirect(url_for('login'))
+def render_reports(rows):
+    # Processed requests get their PDF rendered off the request path.
+    for r in rows:
+        if r.stage == STAGE_PROCESSED:
+            current_app.extensions['reports'].submit(r.id)
 
-    department = session.get('department')
-    requests = get_pending_requests_for_hod(department)
-    return render_template('Hod_dashboard.html', requests=requests)
 
+def queue_scopes(role):
+    if session.get('role') != role:
+        return None
+    return [stage_channel(role, session.get('department'))]
 
-@app.route('/hod_approve/<int:req_id>', methods=['POST'])
-def hod_approve(req_id):
-    if session.get('role') != 'HOD':
-        flash('Access denied', 'danger')
-        return redirect(url_for('login'))
 
-    remarks = request.form['remarks']
-    action = request.form['action']
-
-    if action == 'approve':
-        update_hod_approval(req_id, 'Approved', remarks)
-        principal_emails = get_emails_by_role('Principal')  # ✅
-
-        if principal_emails:
-            msg = Message(
-                "Action Required: Principal Approval",
-                sender=app.config['MAIL_USERNAME'],
-                recipients=principal_emails
-            )
-            msg.body = f"Request {req_id} has been approved by HOD. Please review and take action."
-            mail.send(msg)
-        flash('✅ Request approved and sent to Principal', 'success')
-    elif action == 'reject':
-        update_hod_approval(req_id, 'Rejected', remarks)
-        flash('❌ Request rejected', 'danger')
-
-    return redirect(url_for('hod_dashboard'))
+@read_replica
+@conditional_get(queue_scopes)
+def queue_dashboard(role):
+    if session.get('role') != role:
+        flash('Access denied', 'danger')
+        return redirect(url_for('main.login'))
 
+    stage = get_stage(role)
+    page = page_args(scoped_department=stage.scoped)
+    if stage.scoped:
+        page['department'] = session.get('department')
+    requests, next_cursor = get_pending_requests(role, **page)
+    return render_queue(stage.template, requests, next_cursor, scoped_department=stage.scoped)
 
-# ------------------ PRINCIPAL ------------------
-@app.route('/principal_dashboard')
-def principal_dashboard():
-    if session.get('role') != 'Principal':
-        flash('Access denied', 'danger')
-        return redirect(url_for('login'))
-    requests = get_pending_requests_for_principal()
-    return render_template('Principal_dashboard.html', requests=requests)
 
-@app.route('/principal_approve/<int:req_id>', methods=['POST'])
-def principal_approve(req_id):
-    if session.get('role') != 'Principal':
+def approve_request(role, req_id):
+    if session.get('role') != role:
         flash('Access denied', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
+    stage = get_stage(role)
+    dashboard = url_for(f'main.{stage.prefix}_dashboard')
     remarks = request.form['remarks']
     action = request.form['action']
+    if action not in ('approve', 'reject'):
+        return redirect(dashboard)
 
-    if action == 'approve':
-        update_principal_approval(req_id, 'Approved', remarks)
-        md_emails = get_emails_by_role('MD')
-        if md_emails:
-            msg = Message(
-                "Action Required: MD Approval",
-                sender=app.config['MAIL_USERNAME'],
-                recipients=md_emails
-            )
-            msg.body = f"Request {req_id} has been approved by Principal. Please review and take action."
-            mail.send(msg)
-        flash('✅ Request approved and sent to MD', 'success')
-    elif action == 'reject':
-        update_principal_approval(req_id, 'Rejected', remarks)
+    status = 'Approved' if action == 'approve' else 'Rejected'
+    row = transition_request(req_id, role, status, remarks, version=form_version(),
+                             department=approver_department(stage), actor=session.get('email'))
+    if row is None:
+        approval_conflict(req_id)
+        return redirect(dashboard)
+
+    # Notifications are queued and committed in the same transaction as the approval.
+    notify_transition(stage, status, [row], {row.id: remarks})
+    db.session.commit()
+    render_reports([row])
+
+    if row.stage == STAGE_PROCESSED:
+        flash('✅ Final status saved, student and teacher notified with report.', 'success')
+    elif status == 'Approved':
+        flash(f'✅ Request approved and sent to {row.stage}', 'success')
+    else:
         flash('❌ Request rejected', 'danger')
+    return redirect(dashboard)
 
-    return redirect(url_for('principal_dashboard'))
 
+for _stage in PIPELINE:
+    bp.add_url_rule(f'/{_stage.prefix}_dashboard', f'{_stage.prefix}_dashboard', queue_dashboard,
+                    defaults={'role': _stage.role})
+    bp.add_url_rule(f'/{_stage.prefix}_approve/<int:req_id>', f'{_stage.prefix}_approve', approve_request,
+                    methods=['POST'], defaults={'role': _stage.role})
 
-# ------------------ MD ------------------
-@app.route('/md_dashboard')
-def md_dashboard():
-    if session.get('role') != 'MD':
-        flash('Access denied', 'danger')
-        return redirect(url_for('login'))
-    requests = get_pending_requests_for_md()
-    return render_template('md_dashboard.html', requests=requests)
 
-@app.route('/md_approve/<int:req_id>', methods=['POST'])
-def md_approve(req_id):
-    if session.get('role') != 'MD':
+# ------------------ BULK ACTIONS ------------------
+@bp.route('/bulk_approve', methods=['POST'])
+def bulk_approve():
+    stage = get_stage(session.get('role'))
+    if stage is None:
         flash('Access denied', 'danger')
-        return redirect(url_for('login'))
-
-    remarks = request.form['remarks']
-    action = request.form['action']
-
-    if action == 'approve':
-        update_md_approval(req_id, 'Approved', remarks)
-        accountant_emails = get_emails_by_role('Accountant')
-        if accountant_emails:
-            msg = Message(
-                "Action Required: Accountant Final Check",
-                sender=app.config['MAIL_USERNAME'],
-                recipients=accountant_emails
-            )
-            msg.body = f"Request {req_id} has been approved by MD. Please process this reimbursement."
-            mail.send(msg)
-        flash('✅ Request approved and sent to Accountant', 'success')
-    elif action == 'reject':
-        update_md_approval(req_id, 'Rejected', remarks)
-        flash('❌ Request rejected', 'danger')
+        return redirect(url_for('main.login'))
+    dashboard = url_for(f"main.{stage.prefix}_dashboard")
 
-    return redirect(url_for('md_dashboard'))
+    req_ids = sorted({int(i) for i in request.form.getlist('ids') if i.isdigit()})
+    action = request.form.get('action')
+    if not req_ids or action not in ('approve', 'reject'):
+        flash('Select at least one request', 'warning')
+        return redirect(dashboard)
 
-def generate_reimbursement_report(data, output_path):
-    doc = SimpleDocTemplate(output_path, pagesize=A4, rightMargin=40, leftMargin=40, topMargin=60, bottomMargin=30)
-    elements = []
-    styles = getSampleStyleSheet()
-    normal = styles["Normal"]
-    bold = styles["Heading4"]
-
-    # Optional custom paragraph style for cleaner spacing
-    para_style = ParagraphStyle(name="Custom", parent=normal, fontSize=10, leading=14)
-
-    # Logo
-    logo_path = "static/logo.png"  # Ensure this path is correct
-    try:
-        logo = Image(logo_path, width=60, height=60)
-        logo.hAlign = 'LEFT'
-        elements.append(logo)
-    except:
-        pass
-
-    # Heading
-    elements.append(Paragraph("<b>Fr. C Rodrigues Institute of Technology, Vashi</b>", styles["Heading1"]))
-    elements.append(Paragraph("Reimbursement Final Report", styles["Title"]))
-    elements.append(Spacer(1, 12))
-
-    # Student Info
-    elements.append(Paragraph(f"<b>Student Name:</b> {data['student_name']}", para_style))
-    elements.append(Paragraph(f"<b>Email:</b> {data['email']}", para_style))
-    elements.append(Paragraph(f"<b>Department:</b> {data['department']}", para_style))
-    if 'transaction_ref' in data:
-        elements.append(Paragraph(f"<b>Transaction Ref:</b> {data['transaction_ref']}", para_style))
-    elements.append(Spacer(1, 12))
-
-    # Main table
-    table_data = [[
-        Paragraph("<b>Purpose</b>", para_style),
-        Paragraph("<b>Amount (₹)</b>", para_style),
-        Paragraph("<b>Status</b>", para_style),
-        Paragraph("<b>Date Submitted</b>", para_style)
-    ], [
-        Paragraph(data['purpose'], para_style),
-        f"₹{data['amount']}",
-        data['accountant_status'],
-        str(data['submitted_at']).split('.')[0]
-    ]]
-
-    table = Table(table_data, colWidths=[3.2 * inch, 1.2 * inch, 1.2 * inch, 2 * inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('ALIGN', (1, 1), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('BOX', (0, 0), (-1, -1), 0.8, colors.black),
-        ('GRID', (0, 0), (-1, -1), 0.4, colors.grey),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('LEFTPADDING', (0, 0), (-1, -1), 6),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-    ]))
-    elements.append(table)
-    elements.append(Spacer(1, 20))
-
-    # Remarks sections
-    elements.append(Paragraph("<b>Accountant Remarks:</b>", bold))
-    elements.append(Paragraph(data['accountant_remarks'], para_style))
-    elements.append(Spacer(1, 8))
-
-    # Optional other roles
-    for role in ['teacher', 'hod', 'principal']:
-        status_key = f"{role}_status"
-        remarks_key = f"{role}_remarks"
-        if data.get(status_key) or data.get(remarks_key):
-            elements.append(Paragraph(f"<b>{role.upper()} Status:</b> {data.get(status_key, '')}", para_style))
-            elements.append(Paragraph(f"<b>{role.upper()} Remarks:</b> {data.get(remarks_key, '')}", para_style))
-            elements.append(Spacer(1, 8))
-
-    elements.append(Spacer(1, 30))
-
-    # Signature Line
-    elements.append(Spacer(1, 40))
-    elements.append(Paragraph("__________________________", para_style))
-    elements.append(Paragraph("Signature (Accounts Dept)", para_style))
-    elements.append(Spacer(1, 20))
-
-
-
-    # Footer
-    elements.append(Spacer(1, 20))
-    footer = Paragraph("<i>Generated by Reimbursement Portal - FCRIT</i>", para_style)
-    elements.append(footer)
-
-    doc.build(elements)
-@app.route('/accountant_dashboard')
-def accountant_dashboard():
-    if session.get('role') != 'Accountant':
-        flash('Access Denied', 'danger')
-        return redirect(url_for('login'))
-    requests = get_pending_requests_for_accountant()
-    return render_template('accountant_dashboard.html', requests=requests)
-@app.route('/accountant_approve/<int:req_id>', methods=['POST'])
-def accountant_approve(req_id):
-    if session.get('role') != 'Accountant':
-        flash('Access Denied', 'danger')
-        return redirect(url_for('login'))
-
-    remarks = request.form['remarks']
-    action = request.form['action']
     status = 'Approved' if action == 'approve' else 'Rejected'
+    shared_remarks = request.form.get('remarks', '')
+    remarks_by_id = {i: (request.form.get(f'remarks_{i}') or '').strip() or shared_remarks.strip() for i in req_ids}
+    missing = [i for i, remarks in remarks_by_id.items() if not remarks]
+    if missing:
+        flash(f"⚠️ Add remarks for request(s) {', '.join(map(str, missing))}, or shared remarks for all selected.",
+              'warning')
+        return redirect(dashboard)
+
+    rows = bulk_update_approval(stage.role, req_ids, status, remarks_by_id, department=approver_department(stage),
+                                actor=session.get('email'))
+    notify_transition(stage, status, rows, remarks_by_id)
+    db.session.commit()
+    render_reports(rows)
+
+    skipped = len(req_ids) - len(rows)
+    verb = 'approved' if status == 'Approved' else 'rejected'
+    flash(f"{'✅' if status == 'Approved' else '❌'} {len(rows)} request(s) {verb}", 'success' if status == 'Approved' else 'danger')
+    if skipped:
+        flash(f"⚠️ {skipped} request(s) skipped: already handled or changed by someone else in the meantime.", 'warning')
+    return redirect(dashboard)
+
+
+# ------------------ USER IMPORT ------------------
+def import_options():
+    config = current_app.config
+    return dict(workers=config['PROVISION_WORKERS'], batch_size=config['PROVISION_BATCH_SIZE'],
+                invite_ttl=config['INVITE_TTL'], sender=config['MAIL_USERNAME'])
+
+
+@bp.route('/admin/import_users', methods=['GET', 'POST'])
+def import_users_view():
+    if session.get('role') != 'Admin':
+        flash('Access denied', 'danger')
+        return redirect(url_for('main.login'))
+
+    result = None
+    dry_run = bool(request.form.get('dry_run'))
+    if request.method == 'POST' and request.files.get('file'):
+        # The upload is already spooled to disk; read it back as text.
+        stream = request.files['file'].stream
+        stream.seek(0)
+        result = import_users(
+            io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''),
+            invite_url=lambda token: url_for('main.accept_invite', token=token, _external=True),
+            send_invites=bool(request.form.get('send_invites')), dry_run=dry_run, **import_options())
+    return render_template('import_users.html', result=result, dry_run=dry_run, departments=DEPARTMENTS)
+
+
+@bp.route('/invite/<token>', methods=['GET', 'POST'])
+def accept_invite(token):
+    error = None
+    if request.method == 'POST':
+        if redeem_invite(token, request.form['password']):
+            flash('Password set. You can now log in.', 'success')
+            return redirect(url_for('main.login'))
+        error = 'This invite link is invalid, already used or expired.'
+    return render_template('accept_invite.html', error=error)
+
+
+# ------------------ NOTIFICATION SETTINGS ------------------
+@bp.route('/notifications', methods=['GET', 'POST'])
+def notification_settings():
+    # Approvers and admins only; students are always mailed right away.
+    role = session.get('role')
+    if not role or role == 'Student':
+        flash('Access denied', 'danger')
+        return redirect(url_for('main.login'))
 
-    update_accountant_approval(req_id, status, remarks)
-
-    # Get student record using SQLAlchemy
-    form_data = Reimbursement.query.filter_by(id=req_id).first()
-    if not form_data:
-        flash("Reimbursement request not found", "danger")
-        return redirect(url_for('accountant_dashboard'))
-
-    student_email = form_data.email
-    department = form_data.department
-    student_name = User.query.filter_by(email=student_email).first().name
-
-    # Send email to student
-    msg = Message(
-        'Reimbursement Status Update',
-        sender=app.config['MAIL_USERNAME'],
-        recipients=[student_email]
-    )
-    msg.body = f"""
-Dear Student,
-
-Your reimbursement request (ID: {req_id}) has been {'✅ approved and processed' if status == 'Approved' else '❌ rejected by the accountant'}.
+    email = session.get('email')
+    saved = False
+    if request.method == 'POST' and request.form.get('notify_mode') in NOTIFY_MODES:
+        set_notify_mode(email, request.form['notify_mode'])
+        saved = True
+    user = get_user_by_email(email)
+    return render_template('notification_settings.html', mode=user.notify_mode if user else 'immediate', saved=saved)
+
+
+# ------------------ AGING ------------------
+@bp.route('/admin/aging')
+@read_replica
+def aging_report():
+    if session.get('role') not in ('Admin', 'Principal'):
+        flash('Access denied', 'danger')
+        return redirect(url_for('main.login'))
+
+    days = min(max(request.args.get('days', 90, type=int), 1), 730)
+    sla_hours = current_app.config['APPROVAL_SLA_HOURS']
+    waits, queues = stage_waits(days), queue_aging(sla_hours)
+    if request.args.get('format') == 'json':
+        return jsonify(days=days, sla_hours=sla_hours, stages=waits, queues=queues)
+    return render_template('aging_report.html', days=days, sla_hours=sla_hours, waits=waits, queues=queues)
+
+
+# ------------------ SEARCH ------------------
+@bp.route('/search')
+@read_replica
+def search():
+    role = session.get('role')
+    if role not in ['Teacher', 'HOD', 'Principal', 'MD', 'Accountant', 'Admin']:
+        flash('Access denied', 'danger')
+        return redirect(url_for('main.login'))
+
+    # Teachers and HODs only search their own department.
+    stage = get_stage(role)
+    scoped = stage is not None and stage.scoped
+    department = session.get('department') if scoped else (request.args.get('department') or None)
+    q = request.args.get('q', '')
+    results, next_cursor = search_reimbursements(
+        q, stage=request.args.get('stage') or None, department=department,
+        cursor=request.args.get('cursor') or None, limit=request.args.get('limit', type=int))
+
+    if request.args.get('format') == 'json':
+        return jsonify(next_cursor=next_cursor, results=[{
+            'id': r.id, 'email': r.email, 'department': r.department, 'purpose': r.purpose, 'amount': r.amount,
+            'stage': r.stage, 'status': r.status, 'submitted_at': r.submitted_at.isoformat(), 'rank': r.search_rank,
+        } for r in results])
+    return render_template('search.html', results=results, next_cursor=next_cursor, q=q,
+                           stages=STAGES + [STAGE_PROCESSED, STAGE_REJECTED], show_department_filter=not scoped)
+
+
+# ------------------ LIVE UPDATES ------------------
+@bp.route('/events')
+def dashboard_events():
+    # Server-Sent Events for the caller's approval queue: "added" / "removed"
+    # with the request id. Streams end after SSE_MAX_DURATION and the browser
+    # reconnects, so no worker thread is held indefinitely, and at most
+    # SSE_MAX_STREAMS per process are open at once.
+    role = session.get('role')
+    if get_stage(role) is None:
+        return '', 204  # tells EventSource not to reconnect
+    config = current_app.config
+    broker = current_app.extensions['events']
+    channels = channels_for(role, session.get('department'))
+    slots = current_app.extensions['sse_slots']
+    if not slots.acquire(blocking=False):
+        # EventSource gives up on a non-200; _live_updates.html tries again later.
+        retry = config['SSE_RETRY_AFTER']
+        return Response(f"retry: {retry * 1000}\n\n", status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(retry), 'Cache-Control': 'no-cache'})
+
+    def stream():
+        sub = broker.subscribe(channels)
+        try:
+            yield 'retry: 5000\n\n'
+            deadline = time.monotonic() + config['SSE_MAX_DURATION']
+            while time.monotonic() < deadline:
+                try:
+                    _, payload = sub.get(timeout=config['SSE_HEARTBEAT'])
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: {payload['event']}\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            broker.unsubscribe(sub)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs even if the client goes away before the stream starts.
+    response.call_on_close(slots.release)
+    return response
+
+
+@bp.route('/queue_rows')
+@read_replica
+def queue_rows():
+    # Table rows for requests that just entered the caller's queue, rendered
+    # with the dashboard's own row macro; requests already handled or outside
+    # the current filters come back empty.
+    role = session.get('role')
+    stage = get_stage(role)
+    if stage is None:
+        return '', 403
+    ids = [int(i) for i in request.args.get('ids', '').split(',') if i.isdigit()][:PAGE_SIZE]
+    scoped = stage.scoped
+    query = Reimbursement.query.filter(Reimbursement.id.in_(ids), Reimbursement.stage == role)
+    if scoped:
+        query = query.filter(Reimbursement.department == session.get('department'))
+    rows = filter_reimbursements(query, **filter_args(scoped_department=scoped)).order_by(Reimbursement.id).all()
+    queue_row = get_template_attribute(stage.template, 'queue_row')
+    return ''.join(str(queue_row(req)) for req in rows)
+
+
+@bp.route('/reports/<int:req_id>')
+def download_report(req_id):
+    role = session.get('role')
+    if role not in ['Teacher', 'HOD', 'Principal', 'MD', 'Accountant', 'Admin', 'Student']:
+        flash("Access denied", "danger")
+        return redirect(url_for('main.login'))
+
+    reimb = get_reimbursement(req_id)
+    if not reimb or reimb.status != 'Processed' or (role == 'Student' and reimb.email != session.get('email')):
+        flash("Report not available", "warning")
+        return redirect(url_for('main.login'))
+
+    reports = current_app.extensions['reports']
+    for attempt in range(2):
+        path = reports.fetch(reimb)
+        if path is None:
+            return Response("⏳ The report is being generated. Please try again in a few seconds.", status=503,
+                            mimetype='text/plain', headers={'Retry-After': '5'})
+        try:
+            return send_file(os.path.abspath(path), mimetype='application/pdf', as_attachment=True,
+                             download_name=f"Reimbursement_Report_{req_id}.pdf")
+        except FileNotFoundError:
+            # Replaced by a newer version in between: fetch that one.
+            reimb = get_reimbursement(req_id)
+    abort(404)
+
+
+# ------------------ PAYOUT REPORTS ------------------
+def payouts_allowed():
+    return session.get('role') in ('Accountant', 'Admin')
+
+
+@bp.route('/payouts', methods=['GET', 'POST'])
+def payout_reports():
+    if not payouts_allowed():
+        flash('Access denied', 'danger')
+        return redirect(url_for('main.login'))
 
-Remarks: {remarks}
+    error = None
+    if request.method == 'POST':
+        try:
+            batch = create_payout_batch(request.form.get('month', ''), request.form.get('department'),
+                                        requested_by=session.get('email'))
+        except ValueError:
+            error = 'Choose a month.'
+        else:
+            current_app.extensions['payouts'].submit(batch.id)
+            return redirect(url_for('main.payout_reports'))
 
-Thank you,
-Accounts Department
-"""
-    mail.send(msg)
+    batches = PayoutBatch.query.order_by(PayoutBatch.id.desc()).limit(20).all()
+    return render_template('payout_reports.html', batches=batches, error=error, departments=DEPARTMENTS,
+                           default_month=datetime.utcnow().strftime('%Y-%m'))
 
-    if status == 'Approved':
-        # Prepare PDF report
-        form_keys = [
-            'id', 'email', 'purpose', 'amount', 'letter', 'certificate',
-            'brochure', 'bill', 'status', 'submitted_at',
-            'teacher_status', 'teacher_remarks',
-            'hod_status', 'hod_remarks',
-            'principal_status', 'principal_remarks',
-            'md_status', 'md_remarks',
-            'accountant_status', 'accountant_remarks', 'department'
-        ]
-        form_values = [
-            form_data.id, form_data.email, form_data.purpose, form_data.amount, form_data.letter, form_data.certificate,
-            form_data.brochure, form_data.bill, form_data.status, form_data.submitted_at,
-            form_data.teacher_status, form_data.teacher_remarks,
-            form_data.hod_status, form_data.hod_remarks,
-            form_data.principal_status, form_data.principal_remarks,
-            form_data.md_status, form_data.md_remarks,
-            form_data.accountant_status, form_data.accountant_remarks, form_data.department
-        ]
-        data_dict = dict(zip(form_keys, form_values))
-        data_dict['student_name'] = student_name
-
-        # Generate PDF in temporary path
-        temp_path = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf").name
-        generate_reimbursement_report(data_dict, temp_path)
-
-        # Send email to teacher with PDF
-        teacher_emails = get_emails_by_role_and_dept('Teacher', department)
-        if teacher_emails:
-            msg2 = Message(
-                "✅ Final Reimbursement Report",
-                sender=app.config['MAIL_USERNAME'],
-                recipients=teacher_emails
-            )
-            msg2.body = f"""
-Dear Faculty,
 
-The reimbursement request (ID: {req_id}) from student {student_name} has been fully approved and processed.
+@bp.route('/payouts/<int:batch_id>/status')
+def payout_status(batch_id):
+    if not payouts_allowed():
+        return jsonify(error='forbidden'), 403
+    batch = db.get_or_404(PayoutBatch, batch_id)
+    return jsonify(id=batch.id, status=batch.status, done=batch.done, total=batch.total, error=batch.error)
 
-Please find the attached report for your records.
 
-Regards,
-Reimbursement Portal
-"""
-            with open(temp_path, 'rb') as f:
-                msg2.attach(f"Reimbursement_Report_{req_id}.pdf", "application/pdf", f.read())
+@bp.route('/payouts/<int:batch_id>/download')
+def download_payouts(batch_id):
+    if not payouts_allowed():
+        flash('Access denied', 'danger')
+        return redirect(url_for('main.login'))
+    batch = db.get_or_404(PayoutBatch, batch_id)
+    if batch.status != 'Done' or not batch.path or not os.path.exists(batch.path):
+        flash('Payout bundle not available', 'warning')
+        return redirect(url_for('main.payout_reports'))
+    return send_file(os.path.abspath(batch.path), mimetype='application/zip', as_attachment=True,
+                     download_name=os.path.basename(batch.path))
 
-            mail.send(msg2)
 
-    flash('✅ Final status saved, student and teacher notified with report.', 'success')
-    return redirect(url_for('accountant_dashboard'))
+# gunicorn app:app / flask --app app
+app = create_app()
 
 
 if __name__ == '__main__':
-    normalize_statuses()
+    with app.app_context():
+        db.create_all()
+        run_migrations()
     app.run(debug=True)
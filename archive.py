@@ -0,0 +1,56 @@
+# archive.py - moves finalised requests out of the live reimb_form table
+#
+# Processed and Rejected requests are never touched by the approval queues
+# again. Once they have been final for ARCHIVE_AFTER_DAYS they are copied to
+# reimb_form_archive and deleted from reimb_form in id-ordered batches, one
+# transaction per batch, so the queues, their indexes and the search index
+# only cover the working set however many years of history accumulate. A run
+# can be stopped at any point and simply started again. Readers that want
+# history ask for it (models.reimbursement_entity(include_archived=True)).
+# Run nightly with `flask --app app archive-finalised`.
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, literal, select
+
+from models import db, Reimbursement, ReimbursementArchive, bump_change_versions, student_scope
+from pipeline import FINAL_STAGES
+
+ARCHIVE_COLUMNS = [c.name for c in Reimbursement.__table__.columns]
+
+
+def _archivable(cutoff):
+    return (Reimbursement.stage.in_(FINAL_STAGES),
+            func.coalesce(Reimbursement.updated_at, Reimbursement.submitted_at) < cutoff)
+
+
+def count_archivable(older_than_days):
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    return db.session.query(func.count(Reimbursement.id)).filter(*_archivable(cutoff)).scalar()
+
+
+def archive_finalised(older_than_days, batch_size=5000, echo=print):
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved = 0
+    while True:
+        ids = db.session.execute(
+            select(Reimbursement.id).where(*_archivable(cutoff)).order_by(Reimbursement.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        now = datetime.utcnow()
+        columns = [Reimbursement.__table__.c[name] for name in ARCHIVE_COLUMNS]
+        db.session.execute(insert(ReimbursementArchive).from_select(
+            ARCHIVE_COLUMNS + ['archived_at'],
+            select(*columns, literal(now)).where(Reimbursement.id.in_(ids), *_archivable(cutoff))
+        ))
+        emails = db.session.execute(
+            delete(Reimbursement).where(Reimbursement.id.in_(ids), *_archivable(cutoff))
+            .returning(Reimbursement.email)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        # The students' default (live-only) history pages lose these rows.
+        bump_change_versions(student_scope(email) for email in emails)
+        db.session.commit()
+        moved += len(ids)
+        echo(f"ids {ids[0]}-{ids[-1]} archived ({moved} so far)")
+    return moved
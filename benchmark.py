@@ -0,0 +1,380 @@
+# benchmark.py - reproducible benchmarks for the reimbursement workflow
+#
+# Seeds a database with synthetic users and reimbursement requests, then times
+# the hot paths: worker startup, the pending-queue queries, search, every dashboard route, the export,
+# PDF report rendering and the approve routes (mail only goes to the outbox;
+# no delivery threads run). It also races parallel approvals of the same
+# request and fails unless exactly one wins each time. Results are written as
+# JSON so runs on different commits can be compared:
+#
+#   python benchmark.py --requests 100000
+#   python benchmark.py --requests 100000 --reuse --compare benchmark_results/<older>.json
+#   python benchmark.py --database-url postgresql+pg8000://user:pw@localhost/rms_bench
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Share of requests per stage, roughly what a term's data looks like.
+STAGE_MIX = [
+    ('Teacher', 0.10), ('HOD', 0.08), ('Principal', 0.07), ('MD', 0.05), ('Accountant', 0.05),
+    ('Processed', 0.55), ('Rejected', 0.10),
+]
+CHAIN = ['teacher', 'hod', 'principal', 'md', 'accountant']
+NEXT_STATUS = {'Teacher': 'Pending Teacher', 'HOD': 'Pending HOD', 'Principal': 'Pending Principal',
+               'MD': 'Pending MD', 'Accountant': 'Pending Accountant', 'Processed': 'Processed'}
+PURPOSES = ['Conference registration', 'Hackathon travel', 'Workshop fee', 'Paper publication charges',
+            'Certification exam', 'Sports meet travel, lodging', 'Project hardware "kit"']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url', help='Defaults to a SQLite file in the temp directory.')
+    parser.add_argument('--requests', type=int, default=10000, help='reimb_form rows to seed.')
+    parser.add_argument('--departments', type=int, default=6)
+    parser.add_argument('--students-per-department', type=int, default=200)
+    parser.add_argument('--years', type=int, default=3, help='Spread submissions over this many years.')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed iterations per operation.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--race-threads', type=int, default=8, help='Concurrent approvals per raced request.')
+    parser.add_argument('--reuse', action='store_true', help='Skip seeding if the database already has data.')
+    parser.add_argument('--output', help='Result file (default benchmark_results/<commit>-<time>.json).')
+    parser.add_argument('--compare', help='Earlier result file to print deltas against.')
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return 'unknown'
+
+
+def departments(n):
+    return [f'DEPT{i + 1}' for i in range(n)]
+
+
+def seed(db, models, args):
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(args.seed)
+    password_hash = generate_password_hash('benchmark')  # hashed once, shared by all users
+    depts = departments(args.departments)
+
+    users = []
+    for dept in depts:
+        users.append(dict(name=f'HOD {dept}', email=f'hod.{dept.lower()}@fcrit.ac.in', role='HOD', department=dept))
+        for t in range(5):
+            users.append(dict(name=f'Teacher {t} {dept}', email=f'teacher{t}.{dept.lower()}@fcrit.ac.in',
+                              role='Teacher', department=dept))
+        for s in range(args.students_per_department):
+            users.append(dict(name=f'Student {s} {dept}', email=f'student{s}.{dept.lower()}@fcrit.ac.in',
+                              role='Student', department=dept))
+    for role in ('Principal', 'MD', 'Accountant', 'Admin'):
+        users.append(dict(name=role, email=f'{role.lower()}@fcrit.ac.in', role=role, department='None'))
+    for u in users:
+        u['password_hash'] = password_hash
+    db.session.execute(insert(models.User), users)
+
+    stages, weights = zip(*STAGE_MIX)
+    start = datetime.now() - timedelta(days=365 * args.years)
+    span = 365 * args.years * 86400
+    batch = []
+    for i in range(args.requests):
+        dept = rng.choice(depts)
+        stage = rng.choices(stages, weights)[0]
+        row = dict(
+            email=f'student{rng.randrange(args.students_per_department)}.{dept.lower()}@fcrit.ac.in',
+            purpose=f'{rng.choice(PURPOSES)} #{i}', amount=round(rng.uniform(200, 25000), 2),
+            letter='letter.pdf', certificate='certificate.pdf', brochure='brochure.pdf', bill='bill.pdf',
+            department=dept, stage=stage, submitted_at=start + timedelta(seconds=rng.randrange(span)),
+        )
+        if stage == 'Rejected':
+            rejected_at = rng.randrange(len(CHAIN))
+            for j, role in enumerate(CHAIN):
+                row[f'{role}_status'] = 'Approved' if j < rejected_at else ('Rejected' if j == rejected_at else 'Pending')
+            row['status'] = f"Rejected by {['Teacher', 'HOD', 'Principal', 'MD', 'Accountant'][rejected_at]}"
+        else:
+            reached = len(CHAIN) if stage == 'Processed' else [s.lower() for s in stages].index(stage.lower())
+            for j, role in enumerate(CHAIN):
+                row[f'{role}_status'] = 'Approved' if j < reached else 'Pending'
+            row['status'] = NEXT_STATUS[stage]
+        # Each stage that acted did so some hours after the previous one.
+        acted_at = row['submitted_at']
+        for j, role in enumerate(CHAIN):
+            if row[f'{role}_status'] != 'Pending':
+                acted_at += timedelta(minutes=rng.randrange(10, 96 * 60))
+                row[f'{role}_remarks'] = 'ok'
+                row[f'{role}_at'] = acted_at
+                row[f'{role}_by'] = 'benchmark@fcrit.ac.in'
+        row['stage_entered_at'] = row['updated_at'] = acted_at
+        batch.append(row)
+        if len(batch) == 5000:
+            db.session.execute(insert(models.Reimbursement), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(models.Reimbursement), batch)
+    db.session.commit()
+    models.rebuild_summary()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'runs': repeat,
+        'min_ms': round(samples[0], 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'mean_ms': round(statistics.mean(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+    }
+
+
+def login(flask_app, email):
+    client = flask_app.test_client()
+    response = client.post('/login', data={'email': email, 'password': 'benchmark'})
+    assert response.status_code == 302, f'login failed for {email}'
+    return client
+
+
+# Imports app.py in a fresh interpreter against an unreachable database.
+# That this neither connects nor imports reportlab is checked by test.py.
+STARTUP_PROBE = """
+import time
+started = time.perf_counter()
+import app
+app.create_app()
+print(time.perf_counter() - started)
+"""
+
+
+def measure_startup(repeat):
+    env = dict(os.environ, DATABASE_URL='sqlite:////nonexistent/rms/unreachable.db')
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        out = subprocess.check_output([sys.executable, '-c', STARTUP_PROBE], env=env, cwd=here, text=True)
+        total = time.perf_counter() - started
+        import_s = out.split()[-1]
+        samples.append((total * 1000, float(import_s) * 1000))
+    return {
+        'runs': repeat,
+        'median_ms': round(statistics.median(s[0] for s in samples), 3),
+        'import_median_ms': round(statistics.median(s[1] for s in samples), 3),
+    }
+
+
+def approval_race(flask_app, models, email, dept, threads, rounds):
+    # Each round `threads` teachers approve the same request at once, all
+    # with the version they were shown; times the contended approvals. That
+    # exactly one wins is checked by test.py.
+    with flask_app.app_context():
+        pending = [(r.id, r.version) for r in models.Reimbursement.query
+                   .filter_by(stage='Teacher', department=dept).order_by(models.Reimbursement.id).limit(rounds)]
+    clients = [login(flask_app, email) for _ in range(threads)]
+    samples, conflicts = [], 0
+    for req_id, version in pending:
+        barrier = threading.Barrier(threads)
+
+        def approve(i):
+            barrier.wait()
+            started = time.perf_counter()
+            clients[i].post(f'/teacher_approve/{req_id}',
+                            data={'remarks': f'race {i}', 'action': 'approve', 'version': version})
+            return (time.perf_counter() - started) * 1000
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            samples.extend(pool.map(approve, range(threads)))
+
+        for client in clients:
+            with client.session_transaction() as sess:
+                flashes = sess.pop('_flashes', [])
+            conflicts += any(category == 'warning' for category, _ in flashes)
+
+    samples.sort()
+    return {
+        'rounds': len(pending), 'threads': threads, 'conflicts': conflicts,
+        'median_ms': round(statistics.median(samples), 3) if samples else 0,
+        'max_ms': round(samples[-1], 3) if samples else 0,
+    }
+
+
+def run(args):
+    from app import create_app
+    import models
+    from models import db
+    from reports import render_report, report_data
+
+    flask_app = create_app({'MAIL_OUTBOX_WORKERS': 0})
+    results = {'startup': measure_startup(max(3, args.repeat // 4))}
+    dept = departments(args.departments)[0]
+
+    with flask_app.app_context():
+        db.create_all()
+        from migrations import run_migrations
+        run_migrations(echo=lambda *a: None)
+        if args.reuse and db.session.query(models.Reimbursement.id).first() is not None:
+            print('Reusing existing data')
+        else:
+            started = time.perf_counter()
+            seed(db, models, args)
+            results['seed_s'] = round(time.perf_counter() - started, 2)
+            print(f"Seeded {args.requests} requests in {results['seed_s']}s")
+        results['row_count'] = db.session.query(db.func.count(models.Reimbursement.id)).scalar()
+
+        queries = {
+            'teacher': lambda: models.get_pending_requests('Teacher', department=dept),
+            'hod': lambda: models.get_pending_requests('HOD', department=dept),
+            'principal': lambda: models.get_pending_requests('Principal'),
+            'md': lambda: models.get_pending_requests('MD'),
+            'accountant': lambda: models.get_pending_requests('Accountant'),
+        }
+        results['queries'] = {name: timed(fn, args.repeat) for name, fn in queries.items()}
+
+        from search import search_reimbursements
+        searches = {
+            'rare_prefix': lambda: search_reimbursements('hack kit'),
+            'common_word': lambda: search_reimbursements('conference'),
+            'email_part': lambda: search_reimbursements(f'student1 {dept.lower()}'),
+            'scoped': lambda: search_reimbursements('travel', stage='HOD', department=dept),
+        }
+        results['search'] = {name: timed(fn, args.repeat) for name, fn in searches.items()}
+
+        from aging import queue_aging, stage_waits
+        results['aging'] = {
+            'stage_waits': timed(lambda: stage_waits(days=365 * args.years), max(3, args.repeat // 4)),
+            'queue_aging': timed(lambda: queue_aging(72), args.repeat),
+        }
+
+        processed = models.Reimbursement.query.filter_by(stage='Processed').first()
+        data = report_data(processed)
+        results['generate_reimbursement_report'] = timed(lambda: render_report(data), max(3, args.repeat // 4))
+
+    lower = dept.lower()
+    accounts = {
+        'Teacher': f'teacher0.{lower}@fcrit.ac.in', 'HOD': f'hod.{lower}@fcrit.ac.in',
+        'Principal': 'principal@fcrit.ac.in', 'MD': 'md@fcrit.ac.in', 'Accountant': 'accountant@fcrit.ac.in',
+        'Admin': 'admin@fcrit.ac.in', 'Student': f'student0.{lower}@fcrit.ac.in',
+    }
+    clients = {role: login(flask_app, email) for role, email in accounts.items()}
+
+    def get(role, path):
+        def call():
+            response = clients[role].get(path)
+            assert response.status_code == 200, (path, response.status_code)
+            b''.join(response.response)  # drain streamed bodies
+        return call
+
+    routes = {
+        'teacher_dashboard': get('Teacher', '/teacher_dashboard'),
+        'hod_dashboard': get('HOD', '/hod_dashboard'),
+        'principal_dashboard': get('Principal', '/principal_dashboard'),
+        'md_dashboard': get('MD', '/md_dashboard'),
+        'accountant_dashboard': get('Accountant', '/accountant_dashboard'),
+        'admin_dashboard': get('Admin', '/admin_dashboard'),
+        'student_dashboard': get('Student', '/student_dashboard'),
+    }
+    results['routes'] = {name: timed(fn, args.repeat) for name, fn in routes.items()}
+
+    # A refresh of an unchanged page: If-None-Match -> 304 without the list query.
+    def revalidate(role, path):
+        etag = clients[role].get(path).headers['ETag']
+        def call():
+            response = clients[role].get(path, headers={'If-None-Match': etag})
+            assert response.status_code == 304, (path, response.status_code)
+        return call
+
+    results['routes_revalidate'] = {
+        name: timed(revalidate(role, f'/{name}'), args.repeat)
+        for name, role in (('teacher_dashboard', 'Teacher'), ('principal_dashboard', 'Principal'),
+                           ('student_dashboard', 'Student'))
+    }
+    results['export_reimbursements'] = timed(get('Admin', '/export_reimbursements'), max(1, args.repeat // 10))
+
+    # Each approve call consumes a different pending request of that stage.
+    results['approve'] = {}
+    for role in ('Teacher', 'HOD', 'Principal', 'MD', 'Accountant'):
+        with flask_app.app_context():
+            query = models.Reimbursement.query.filter_by(stage=role)
+            if role in ('Teacher', 'HOD'):
+                query = query.filter_by(department=dept)
+            pending = [r.id for r in query.limit(args.repeat).all()]
+        if len(pending) < args.repeat:
+            continue
+        ids = iter(pending)
+        endpoint = f'/{role.lower()}_approve'
+
+        def approve():
+            response = clients[role].post(f'{endpoint}/{next(ids)}', data={'remarks': 'benchmark', 'action': 'approve'})
+            assert response.status_code == 302
+        results['approve'][role.lower()] = timed(approve, args.repeat)
+
+    results['approve_race'] = approval_race(flask_app, models, accounts['Teacher'], dept,
+                                            args.race_threads, max(1, args.repeat // 4))
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict) and 'median_ms' in value:
+            flat[prefix + key] = value['median_ms']
+        elif isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+    return flat
+
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    old, new = flatten(previous['results']), flatten(current['results'])
+    print(f"\nMedian ms vs {previous['commit']} ({previous_path})")
+    for key in sorted(new):
+        if key in old and old[key]:
+            change = (new[key] - old[key]) / old[key] * 100
+            print(f"  {key:45} {old[key]:10.3f} -> {new[key]:10.3f}  ({change:+.1f}%)")
+
+
+def main():
+    args = parse_args()
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.gettempdir(), 'rms_benchmark.db')}"
+    # Must be set before app/config are imported.
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['MAIL_OUTBOX_WORKERS'] = '0'
+    os.environ.setdefault('REPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'rms_benchmark_reports'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    report = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'database': database_url.split('://')[0],
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'database_url')},
+        'results': run(args),
+    }
+    output = args.output or os.path.join(
+        'benchmark_results', f"{report['commit']}-{datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+    for key, value in sorted(flatten(report['results']).items()):
+        print(f"  {key:45} {value:10.3f} ms")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# caching.py - conditional GETs for the dashboards
+#
+# Each queue and each student's history has a change version
+# (models.ChangeVersion) that insert_reimbursement, the approval transitions
+# and archiving bump in the same transaction as the change. A page's ETag
+# hashes the versions of the scopes it shows with everything else the HTML
+# depends on (the URL, the signed-in user, RELEASE_ID for the templates), so
+# a refresh with a matching If-None-Match costs one primary-key lookup and
+# gets a bodyless 304 instead of re-running the list query. The versions are
+# read before the view runs: a change committed in between only makes the
+# next refresh miss, it can never pin stale HTML under a newer ETag.
+import functools
+import hashlib
+import json
+
+from flask import current_app, make_response, request, session
+
+from models import GLOBAL_SCOPE, get_change_versions
+
+
+def page_etag(scopes):
+    versions = get_change_versions(sorted(set(scopes)) + [GLOBAL_SCOPE])
+    key = json.dumps([sorted(versions.items()), request.full_path, session.get('email'), session.get('role'),
+                      session.get('department'), current_app.config['RELEASE_ID']])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def conditional_get(scopes_for):
+    # scopes_for(**view_args) -> the change scopes the page shows, or None
+    # when the view should just run (e.g. to redirect a logged out user).
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            scopes = scopes_for(**kwargs)
+            # A pending flash message (e.g. an approval conflict after a
+            # redirect) is not in the cached page, so render it afresh.
+            if scopes is None or session.get('_flashes'):
+                return view(*args, **kwargs)
+            etag = page_etag(scopes)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            # Weak: the same data, not necessarily byte-identical HTML.
+            response.set_etag(etag, weak=True)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
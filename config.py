@@ -7,3 +7,88 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL")
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Read replicas of DATABASE_URL, comma separated (see replicas.py)
+DATABASE_REPLICA_URLS = os.getenv("DATABASE_REPLICA_URLS", "")
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))  # seconds behind before reads fall back to the primary
+REPLICA_CHECK_INTERVAL = 5
+READ_YOUR_WRITES = int(os.getenv("READ_YOUR_WRITES", "10"))  # seconds a session reads from the primary after writing
+
+# Must be the same on every worker and host, or sessions signed by one are
+# rejected by the others.
+SECRET_KEY = os.getenv("SECRET_KEY")
+
+# Server-side sessions (see sessions.py): database | memory | cookie
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "database")
+SESSION_LIFETIME = int(os.getenv("SESSION_LIFETIME", str(8 * 3600)))  # logged-in sessions
+SESSION_ANONYMOUS_LIFETIME = int(os.getenv("SESSION_ANONYMOUS_LIFETIME", "1800"))  # registration in progress
+SESSION_SWEEP_INTERVAL = 600
+OTP_TTL = int(os.getenv("OTP_TTL", "600"))
+
+# Mail outbox delivery (see mailer.py)
+MAIL_SERVER = os.getenv("MAIL_SERVER", "smtp.gmail.com")
+MAIL_PORT = int(os.getenv("MAIL_PORT", "587"))
+MAIL_USE_TLS = os.getenv("MAIL_USE_TLS", "true").lower() == "true"
+MAIL_OUTBOX_WORKERS = int(os.getenv("MAIL_OUTBOX_WORKERS", "1"))  # in-process threads, 0 = separate worker only
+MAIL_OUTBOX_BATCH_SIZE = 50
+MAIL_OUTBOX_POLL_INTERVAL = 5
+MAIL_OUTBOX_LEASE = 300
+MAIL_OUTBOX_MAX_ATTEMPTS = 8
+MAIL_OUTBOX_BACKOFF_BASE = 30
+MAIL_OUTBOX_BACKOFF_MAX = 3600
+NOTIFY_DIGEST_INTERVAL = 60  # seconds between checks for due hourly / daily digests
+
+# PDF reports (see reports.py)
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR", "report_cache")
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+REPORT_WAIT = 10  # seconds a download waits for a render before answering 503
+
+# Upload limits (see storage.py)
+UPLOAD_MAX_FILE_SIZE = int(os.getenv("UPLOAD_MAX_FILE_SIZE", str(10 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_SIZE = int(os.getenv("UPLOAD_MAX_REQUEST_SIZE", str(40 * 1024 * 1024)))
+# Content-addressed uploads never change, so browsers may keep them this long
+UPLOAD_CACHE_MAX_AGE = int(os.getenv("UPLOAD_CACHE_MAX_AGE", str(365 * 86400)))
+
+# Stages small claims skip, as ROLE:AMOUNT pairs, e.g. "MD:5000" (see pipeline.py)
+APPROVAL_SKIP_BELOW = {
+    role.strip(): float(amount)
+    for role, amount in (pair.split(':') for pair in os.getenv("APPROVAL_SKIP_BELOW", "").split(',') if pair.strip())
+}
+
+# Requests waiting longer than this at one stage are flagged and their
+# approvers reminded (see aging.py)
+APPROVAL_SLA_HOURS = float(os.getenv("APPROVAL_SLA_HOURS", "72"))
+SLA_CHECK_INTERVAL = 600
+
+# Finalised requests older than this move to reimb_form_archive (see archive.py)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+
+# Month-end payout report bundles (see payouts.py)
+PAYOUT_DIR = os.getenv("PAYOUT_DIR", "payout_reports")
+PAYOUT_WORKERS = int(os.getenv("PAYOUT_WORKERS", "2"))  # PDF rendering processes
+
+# Bulk user import (see provisioning.py)
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", "4"))  # password hashing processes
+PROVISION_BATCH_SIZE = 1000
+INVITE_TTL = int(os.getenv("INVITE_TTL", str(7 * 86400)))
+
+# Live dashboard updates (see events.py): auto | postgres | memory
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "auto")
+EVENTS_POLL_INTERVAL = 1  # seconds between LISTEN checks on the Postgres connection
+SSE_HEARTBEAT = 15
+SSE_MAX_DURATION = int(os.getenv("SSE_MAX_DURATION", "300"))  # browsers reconnect automatically
+# Each open stream holds a worker thread (Procfile: 16 gthread threads per
+# process); above this many per process /events answers 503 and the page
+# retries later, so streams never take the threads logins and approvals need.
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "4"))
+SSE_RETRY_AFTER = 30  # seconds, with jitter on the client
+
+# Per-request SQL profiling (see profiling.py)
+QUERY_PROFILING = os.getenv("QUERY_PROFILING", "false").lower() == "true"
+QUERY_PROFILING_SLOW_MS = float(os.getenv("QUERY_PROFILING_SLOW_MS", "100"))
+QUERY_PROFILING_REPEAT_THRESHOLD = int(os.getenv("QUERY_PROFILING_REPEAT_THRESHOLD", "5"))
+QUERY_PROFILING_TOP = 5
+
+# Part of every dashboard ETag (see caching.py); set it per deploy so pages
+# cached from older templates are rendered again
+RELEASE_ID = os.getenv("RELEASE_ID", "")
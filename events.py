@@ -0,0 +1,187 @@
+# events.py - live queue updates for the dashboards
+#
+# Changes to a request's stage are recorded on the SQLAlchemy session and only
+# published once that transaction commits, so listeners never see a change
+# that was rolled back. Events are fanned out to Server-Sent Events streams
+# (see app.dashboard_events) through a broker: in-process for tests and single
+# process runs, or Postgres LISTEN/NOTIFY so a change committed by any worker
+# reaches the streams held open by every other worker and host.
+import json
+import queue
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from pipeline import PIPELINE
+
+# Queues that are split per department; the others are institution-wide.
+DEPARTMENT_STAGES = tuple(stage.role for stage in PIPELINE if stage.scoped)
+PG_CHANNEL = 'rms_events'
+
+
+def stage_channel(stage, department=None):
+    if stage in DEPARTMENT_STAGES:
+        return f"queue:{stage}:{department}"
+    return f"queue:{stage}"
+
+
+def channels_for(role, department=None):
+    # The approval queue a dashboard user is allowed to listen to.
+    return [stage_channel(role, department)]
+
+
+def record_stage_change(session, req_id, department, old_stage, new_stage):
+    # Queue "removed" for the old stage's queue and "added" for the new one;
+    # sent after the session commits.
+    pending = session.info.setdefault('pending_events', [])
+    payload = {'id': req_id, 'department': department, 'from': old_stage, 'to': new_stage}
+    if old_stage is not None:
+        pending.append((stage_channel(old_stage, department), dict(payload, event='removed')))
+    pending.append((stage_channel(new_stage, department), dict(payload, event='added')))
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending(session):
+    events = session.info.pop('pending_events', None)
+    if events and has_app_context():
+        broker = current_app.extensions.get('events')
+        if broker is not None:
+            try:
+                broker.publish(events)
+            except Exception:
+                current_app.logger.exception('Publishing dashboard events failed')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('pending_events', None)
+
+
+class Subscription:
+    def __init__(self, channels):
+        self.channels = set(channels)
+        self.queue = queue.Queue(maxsize=1000)
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+
+class EventBroker:
+    """In-process fan-out from published events to subscriptions."""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        sub = Subscription(channels)
+        with self._lock:
+            self._subscriptions.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscriptions.discard(sub)
+
+    def publish(self, events):
+        for channel, payload in events:
+            self._dispatch(channel, payload)
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            targets = [s for s in self._subscriptions if channel in s.channels]
+        for sub in targets:
+            try:
+                sub.queue.put_nowait((channel, payload))
+            except queue.Full:
+                pass  # a stalled client; it reloads when it reconnects
+
+
+class PostgresEventBroker(EventBroker):
+    """Cross-process events over a single Postgres NOTIFY channel."""
+
+    def __init__(self, app, engine_getter):
+        super().__init__()
+        self.app = app
+        self._engine_getter = engine_getter
+        self._engine = None
+        self.poll_interval = app.config['EVENTS_POLL_INTERVAL']
+        self._listener = None
+
+    @property
+    def engine(self):
+        # Resolved on first use; the engine only exists once the app is set up.
+        if self._engine is None:
+            with self.app.app_context():
+                self._engine = self._engine_getter()
+        return self._engine
+
+    def publish(self, events):
+        # Delivered back to this process (and every other one) by the listener.
+        with self.engine.begin() as conn:
+            for channel, payload in events:
+                conn.execute(select(func.pg_notify(PG_CHANNEL, json.dumps(dict(payload, channel=channel)))))
+
+    def subscribe(self, channels):
+        # The listener thread starts on first use, i.e. after gunicorn forks.
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='events-listener', daemon=True)
+                self._listener.start()
+        return super().subscribe(channels)
+
+    def _listen(self):
+        while True:
+            raw = None
+            try:
+                raw = self.engine.raw_connection()
+                driver = raw.driver_connection
+                driver.autocommit = True
+                cursor = driver.cursor()
+                cursor.execute(f"LISTEN {PG_CHANNEL}")
+                while True:
+                    for payload in self._drain(driver, cursor):
+                        data = json.loads(payload)
+                        self._dispatch(data.pop('channel'), data)
+                    time.sleep(self.poll_interval)
+            except Exception:
+                self.app.logger.exception('Event listener connection failed, reconnecting')
+                time.sleep(5)
+            finally:
+                if raw is not None:
+                    try:
+                        raw.invalidate()
+                    except Exception:
+                        pass
+
+    def _drain(self, driver, cursor):
+        if hasattr(driver, 'notifies'):  # psycopg2
+            driver.poll()
+            payloads = [n.payload for n in driver.notifies]
+            driver.notifies.clear()
+            return payloads
+        # pg8000 only reads notifications while talking to the server.
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        payloads = []
+        while driver.notifications:
+            payloads.append(driver.notifications.popleft()[2])
+        return payloads
+
+
+def init_events(app, engine_getter):
+    # EVENTS_BACKEND: auto (Postgres when the database is Postgres) | postgres | memory
+    backend = app.config['EVENTS_BACKEND']
+    if backend == 'auto':
+        backend = 'postgres' if (app.config['SQLALCHEMY_DATABASE_URI'] or '').startswith('postgres') else 'memory'
+    if backend == 'postgres':
+        broker = PostgresEventBroker(app, engine_getter)
+    else:
+        broker = EventBroker()
+    app.extensions['events'] = broker
+    # Open /events streams in this process (see config.SSE_MAX_STREAMS)
+    app.extensions['sse_slots'] = threading.BoundedSemaphore(app.config['SSE_MAX_STREAMS'])
+    return broker
@@ -0,0 +1,107 @@
+# exports.py - streaming reimbursement exports (CSV, gzipped CSV, XLSX)
+#
+# Rows are fetched through a server-side cursor in chunks of EXPORT_CHUNK_SIZE
+# and written out as they arrive, so memory stays flat however large
+# reimb_form grows.
+import csv
+import io
+import os
+import tempfile
+import zlib
+
+from sqlalchemy import select
+
+from models import db, Reimbursement, filter_reimbursements, reimbursement_entity
+
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_COLUMNS = [
+    ('Email', Reimbursement.email),
+    ('Purpose', Reimbursement.purpose),
+    ('Amount', Reimbursement.amount),
+    ('Status', Reimbursement.status),
+    ('Submitted At', Reimbursement.submitted_at),
+    ('Teacher Status', Reimbursement.teacher_status),
+    ('HOD Status', Reimbursement.hod_status),
+    ('Principal Status', Reimbursement.principal_status),
+    ('MD Status', Reimbursement.md_status),
+    ('Accountant Status', Reimbursement.accountant_status),
+]
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+
+def iter_export_rows(chunk_size=EXPORT_CHUNK_SIZE, include_archived=False, **filters):
+    entity = reimbursement_entity(include_archived)
+    stmt = select(*[getattr(entity, column.key) for _, column in EXPORT_COLUMNS]).order_by(entity.id)
+    stmt = filter_reimbursements(stmt, entity=entity, **filters)
+    # yield_per implies stream_results: psycopg2/pg8000 use a named cursor.
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield partition
+
+
+def iter_csv(chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    # One string per chunk of rows; the csv module handles quoting of commas,
+    # quotes and newlines in free-text columns such as purpose.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _ in EXPORT_COLUMNS])
+    for partition in iter_export_rows(chunk_size, **filters):
+        writer.writerows(partition)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_xlsx(chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    # openpyxl's write-only workbook spools rows to disk; the finished file is
+    # then streamed back and removed.
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Reimbursements')
+    sheet.append([header for header, _ in EXPORT_COLUMNS])
+    for partition in iter_export_rows(chunk_size, **filters):
+        for row in partition:
+            sheet.append(list(row))
+
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        workbook.save(path)
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(64 * 1024)
+                if not data:
+                    break
+                yield data
+    finally:
+        os.remove(path)
+
+
+def export_reimbursements_stream(fmt, **filters):
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    if fmt == 'csv':
+        body = iter_csv(**filters)
+    elif fmt == 'csv.gz':
+        body = iter_gzip(iter_csv(**filters))
+    else:
+        body = iter_xlsx(**filters)
+    return mimetype, extension, body
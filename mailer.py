@@ -0,0 +1,170 @@
+# mailer.py - background delivery of the mail outbox
+#
+# Routes never talk to SMTP directly: they call models.enqueue_email() inside
+# their own transaction and the workers below drain the `mail_outbox` table.
+# Point MAIL_SERVER / MAIL_PORT at a local stand-in (e.g. `python -m aiosmtpd
+# -n -l localhost:1025`) to exercise delivery without touching Gmail.
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import select
+
+from models import db, OutboxMessage
+from aging import flag_overdue
+from notifications import send_due_digests
+
+
+def _backoff(attempts, base, cap):
+    return timedelta(seconds=min(cap, base * (2 ** max(attempts - 1, 0))))
+
+
+def claim_batch(batch_size, lease_seconds):
+    # SKIP LOCKED lets several workers (threads or hosts) drain the same table
+    # without handing out a message twice. A claimed row gets a lease: if the
+    # worker dies mid-send the row becomes claimable again once it expires.
+    now = datetime.utcnow()
+    stmt = (
+        select(OutboxMessage)
+        .where(OutboxMessage.status.in_(('pending', 'sending')))
+        .where(OutboxMessage.next_attempt_at <= now)
+        .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    batch = db.session.execute(stmt).scalars().all()
+    for msg in batch:
+        msg.status = 'sending'
+        msg.next_attempt_at = now + timedelta(seconds=lease_seconds)
+    db.session.commit()
+    return batch
+
+
+def _to_message(row):
+    msg = Message(row.subject, sender=row.sender, recipients=row.recipients.split(','))
+    msg.body = row.body
+    if row.attachment_data is not None:
+        msg.attach(row.attachment_name, row.attachment_type, row.attachment_data)
+    if row.report_id is not None:
+        pdf = current_app.extensions['reports'].get_pdf(row.report_id)
+        if pdf is not None:
+            msg.attach(f"Reimbursement_Report_{row.report_id}.pdf", "application/pdf", pdf)
+    return msg
+
+
+def _mark_failed(row, error, config):
+    row.attempts += 1
+    row.last_error = str(error)[:2000]
+    if row.attempts >= config['MAIL_OUTBOX_MAX_ATTEMPTS']:
+        row.status = 'failed'
+    else:
+        row.status = 'pending'
+        row.next_attempt_at = datetime.utcnow() + _backoff(
+            row.attempts, config['MAIL_OUTBOX_BACKOFF_BASE'], config['MAIL_OUTBOX_BACKOFF_MAX'])
+
+
+def deliver_batch(mail, batch, config):
+    # One SMTP connection per batch instead of one handshake per message.
+    try:
+        with mail.connect() as conn:
+            for row in batch:
+                try:
+                    conn.send(_to_message(row))
+                    row.status = 'sent'
+                    row.sent_at = datetime.utcnow()
+                    row.last_error = None
+                except Exception as e:
+                    _mark_failed(row, e, config)
+    except Exception as e:
+        # Connection / login failure: nothing in the batch went out.
+        for row in batch:
+            if row.status == 'sending':
+                _mark_failed(row, e, config)
+    db.session.commit()
+    return sum(1 for row in batch if row.status == 'sent')
+
+
+def drain_outbox(app, mail, max_batches=None):
+    sent = batches = 0
+    with app.app_context():
+        while max_batches is None or batches < max_batches:
+            batch = claim_batch(app.config['MAIL_OUTBOX_BATCH_SIZE'], app.config['MAIL_OUTBOX_LEASE'])
+            if not batch:
+                break
+            sent += deliver_batch(mail, batch, app.config)
+            batches += 1
+    return sent
+
+
+class OutboxWorker:
+    """Pool of daemon threads polling the outbox until stop() is called."""
+
+    def __init__(self, app, mail, threads=1, poll_interval=None):
+        self.app = app
+        self.mail = mail
+        self.threads = threads
+        self.poll_interval = poll_interval or app.config['MAIL_OUTBOX_POLL_INTERVAL']
+        self._stop = threading.Event()
+        self._threads = []
+        self._periodic_lock = threading.Lock()
+        self._next_run = {}  # periodic job name -> monotonic time it is next due
+
+    def start(self):
+        for i in range(self.threads):
+            t = threading.Thread(target=self._run, name=f'outbox-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sent = drain_outbox(self.app, self.mail, max_batches=1)
+            except Exception:
+                self.app.logger.exception('Outbox worker iteration failed')
+                sent = 0
+            self._maybe_run('Sending notification digests', self.app.config['NOTIFY_DIGEST_INTERVAL'],
+                            lambda: send_due_digests(sender=self.app.config['MAIL_USERNAME']))
+            self._maybe_run('Flagging overdue requests', self.app.config['SLA_CHECK_INTERVAL'],
+                            lambda: flag_overdue(self.app.config['APPROVAL_SLA_HOURS'],
+                                                 sender=self.app.config['MAIL_USERNAME']))
+            if not sent:
+                self._stop.wait(self.poll_interval)
+
+    def _maybe_run(self, name, interval, job):
+        # Digests and SLA reminders: one thread per process runs each job
+        # every `interval` seconds; the mails it queues go out on the next
+        # outbox pass.
+        with self._periodic_lock:
+            if time.monotonic() < self._next_run.get(name, 0):
+                return
+            self._next_run[name] = time.monotonic() + interval
+        try:
+            with self.app.app_context():
+                job()
+        except Exception:
+            self.app.logger.exception('%s failed', name)
+
+
+def outbox_stats():
+    rows = db.session.execute(
+        select(OutboxMessage.status, db.func.count()).group_by(OutboxMessage.status)
+    ).all()
+    return dict(rows)
+
+
+def retry_failed():
+    count = OutboxMessage.query.filter_by(status='failed').update(
+        {'status': 'pending', 'attempts': 0, 'next_attempt_at': datetime.utcnow()},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return count
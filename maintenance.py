@@ -0,0 +1,77 @@
+# maintenance.py - batched, resumable data maintenance jobs
+#
+# Jobs walk reimb_form in id ranges of `batch_size`, issue set-based UPDATEs
+# per range and commit each range together with a checkpoint row, so a job
+# can be interrupted at any point and resumed without redoing finished
+# ranges or holding long locks.
+from sqlalchemy import func, update
+
+from models import db, Reimbursement, MaintenanceCheckpoint, GLOBAL_SCOPE, bump_change_versions
+
+# column -> canonical value for rows whose lower(column) matches it
+STATUS_CANONICAL = {
+    'teacher_status': 'Approved',
+    'hod_status': 'Approved',
+    'principal_status': 'Approved',
+    'md_status': 'Approved',
+    'accountant_status': 'Pending',
+}
+
+NORMALIZE_JOB = 'normalize_statuses'
+
+
+def _needs_fix(column_name, canonical):
+    column = getattr(Reimbursement, column_name)
+    return (func.lower(column) == canonical.lower()) & (column != canonical)
+
+
+def count_unnormalized_statuses():
+    return {
+        name: db.session.query(func.count(Reimbursement.id)).filter(_needs_fix(name, canonical)).scalar()
+        for name, canonical in STATUS_CANONICAL.items()
+    }
+
+
+def get_checkpoint(name):
+    checkpoint = db.session.get(MaintenanceCheckpoint, name)
+    return checkpoint.last_id if checkpoint else 0
+
+
+def reset_checkpoint(name):
+    MaintenanceCheckpoint.query.filter_by(name=name).delete()
+    db.session.commit()
+
+
+def normalize_statuses(batch_size=5000, echo=print):
+    start = get_checkpoint(NORMALIZE_JOB)
+    max_id = db.session.query(func.max(Reimbursement.id)).scalar() or 0
+    if start:
+        echo(f"Resuming after id {start}")
+
+    totals = dict.fromkeys(STATUS_CANONICAL, 0)
+    low = start
+    while low < max_id:
+        high = min(low + batch_size, max_id)
+        fixed = 0
+        for name, canonical in STATUS_CANONICAL.items():
+            result = db.session.execute(
+                update(Reimbursement)
+                .where(Reimbursement.id > low, Reimbursement.id <= high, _needs_fix(name, canonical))
+                .values({getattr(Reimbursement, name): canonical})
+                .execution_options(synchronize_session=False)
+            )
+            totals[name] += result.rowcount
+            fixed += result.rowcount
+        if fixed:
+            # Rows of any queue or student may have changed: invalidate every cached page.
+            bump_change_versions([GLOBAL_SCOPE])
+        checkpoint = db.session.get(MaintenanceCheckpoint, NORMALIZE_JOB) or MaintenanceCheckpoint(name=NORMALIZE_JOB)
+        checkpoint.last_id = high
+        db.session.add(checkpoint)
+        db.session.commit()
+        echo(f"ids {low + 1}-{high} of {max_id} done ({100 * high // max_id}%)")
+        low = high
+
+    # Finished: the next run starts from the beginning again.
+    reset_checkpoint(NORMALIZE_JOB)
+    return totals
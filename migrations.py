@@ -0,0 +1,183 @@
+# migrations.py - ordered schema changes that db.create_all() cannot apply
+#
+# db.create_all() only creates missing tables; it never adds columns or
+# indexes to tables that already exist. Each migration here is idempotent
+# (safe on a fresh database created by create_all) and recorded in
+# `schema_migrations` so it runs once. Apply with `flask --app app migrate`.
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from models import db, Reimbursement, ReimbursementArchive, User, PIPELINE, rebuild_summary
+from search import install_search_index
+
+
+def _columns(table):
+    return {c['name'] for c in inspect(db.session.connection()).get_columns(table)}
+
+
+def _create_indexes(model, *names):
+    # Only the named indexes: the model may also declare indexes on columns
+    # that a later migration adds.
+    conn = db.session.connection()
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(bind=conn, checkfirst=True)
+
+
+def _create_indexes_concurrently(model, *names):
+    # Postgres: build the indexes without blocking writes to the table.
+    # CONCURRENTLY cannot run inside a transaction, so this commits the
+    # session first and uses an autocommit connection. An interrupted build
+    # leaves an INVALID index behind that IF NOT EXISTS would keep; drop it
+    # and build again.
+    if db.engine.dialect.name != 'postgresql':
+        _create_indexes(model, *names)
+        return
+    db.session.commit()
+    table = model.__table__
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for index in table.indexes:
+            if index.name not in names:
+                continue
+            invalid = conn.execute(text(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+            ), {'name': index.name}).first()
+            if invalid:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+            columns = ', '.join(column.name for column in index.columns)
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {table.name} ({columns})"))
+
+
+# Backfill from the per-role status columns, matching what the old
+# get_pending_requests_for_* filters considered "pending" for each role.
+STAGE_BACKFILL = """
+    UPDATE reimb_form SET stage = CASE
+        WHEN lower(coalesce(teacher_status, 'pending')) = 'pending' THEN 'Teacher'
+        WHEN lower(teacher_status) <> 'approved' THEN 'Rejected'
+        WHEN lower(coalesce(hod_status, 'pending')) = 'pending' THEN 'HOD'
+        WHEN lower(hod_status) <> 'approved' THEN 'Rejected'
+        WHEN lower(coalesce(principal_status, 'pending')) = 'pending' THEN 'Principal'
+        WHEN lower(principal_status) <> 'approved' THEN 'Rejected'
+        WHEN lower(coalesce(md_status, 'pending')) = 'pending' THEN 'MD'
+        WHEN lower(md_status) <> 'approved' THEN 'Rejected'
+        WHEN lower(coalesce(accountant_status, 'pending')) = 'pending' THEN 'Accountant'
+        WHEN lower(accountant_status) = 'approved' THEN 'Processed'
+        ELSE 'Rejected'
+    END
+    WHERE id > :low AND id <= :high
+"""
+
+
+def add_reimbursement_stage(batch_size=5000):
+    if 'stage' not in _columns('reimb_form'):
+        db.session.execute(text(
+            "ALTER TABLE reimb_form ADD COLUMN stage VARCHAR(20) NOT NULL DEFAULT 'Teacher'"
+        ))
+        db.session.commit()
+    # One committed id range at a time (as in maintenance.py) so no single
+    # transaction locks every row; rerunning after an interruption is safe.
+    max_id = db.session.execute(text("SELECT max(id) FROM reimb_form")).scalar() or 0
+    for low in range(0, max_id, batch_size):
+        db.session.execute(text(STAGE_BACKFILL), {'low': low, 'high': low + batch_size})
+        db.session.commit()
+    _create_indexes_concurrently(Reimbursement, 'ix_reimb_stage_dept_submitted', 'ix_reimb_stage_submitted')
+
+
+def add_report_cache_keys():
+    # updated_at keys the PDF report cache; mail_outbox.report_id lets a queued
+    # mail reference that cache instead of embedding the PDF bytes.
+    if 'updated_at' not in _columns('reimb_form'):
+        db.session.execute(text("ALTER TABLE reimb_form ADD COLUMN updated_at TIMESTAMP"))
+        db.session.execute(text("UPDATE reimb_form SET updated_at = submitted_at"))
+    if 'report_id' not in _columns('mail_outbox'):
+        db.session.execute(text("ALTER TABLE mail_outbox ADD COLUMN report_id INTEGER"))
+
+
+def add_users_role_department_index():
+    _create_indexes(User, 'ix_users_role_department')
+
+
+def backfill_reimbursement_summary():
+    rebuild_summary()
+
+
+def add_reimbursement_search():
+    install_search_index()
+
+
+def add_user_notify_mode():
+    if 'notify_mode' not in _columns('users'):
+        db.session.execute(text(
+            "ALTER TABLE users ADD COLUMN notify_mode VARCHAR(10) NOT NULL DEFAULT 'immediate'"
+        ))
+
+
+def add_reimbursement_version():
+    # Optimistic-concurrency counter for approval transitions
+    for table in ('reimb_form', 'reimb_form_archive'):
+        if 'version' not in _columns(table):
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+def add_stage_timestamps():
+    # Per-stage acted-at / acted-by, queue entry time and SLA flag (see aging.py)
+    prefixes = ('teacher', 'hod', 'principal', 'md', 'accountant')
+    for table in ('reimb_form', 'reimb_form_archive'):
+        existing = _columns(table)
+        for prefix in prefixes:
+            if f'{prefix}_at' not in existing:
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {prefix}_at TIMESTAMP"))
+            if f'{prefix}_by' not in existing:
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {prefix}_by VARCHAR(120)"))
+        for column in ('stage_entered_at', 'sla_flagged_at'):
+            if column not in existing:
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} TIMESTAMP"))
+        # Best guesses for history: a request's last update is when it reached
+        # its current stage, and a Processed request was last updated when the
+        # accountant approved it. Requests already waiting count as reminded
+        # for their current stage, so the first flag_overdue run does not mail
+        # about the whole backlog at once.
+        db.session.execute(text(
+            f"UPDATE {table} SET sla_flagged_at = :now WHERE stage_entered_at IS NULL AND sla_flagged_at IS NULL"
+        ), {'now': datetime.utcnow()})
+        db.session.execute(text(
+            f"UPDATE {table} SET stage_entered_at = coalesce(updated_at, submitted_at) WHERE stage_entered_at IS NULL"
+        ))
+        db.session.execute(text(
+            f"UPDATE {table} SET accountant_at = updated_at WHERE stage = 'Processed' AND accountant_at IS NULL"
+        ))
+    _create_indexes(Reimbursement, 'ix_reimb_stage_entered', *(f'ix_reimb_{s.prefix}_at' for s in PIPELINE))
+    _create_indexes(ReimbursementArchive, *(f'ix_reimb_archive_{s.prefix}_at' for s in PIPELINE))
+
+
+MIGRATIONS = [
+    ('0001_reimbursement_stage', add_reimbursement_stage),
+    ('0002_report_cache_keys', add_report_cache_keys),
+    ('0003_users_role_department_index', add_users_role_department_index),
+    ('0004_reimbursement_summary', backfill_reimbursement_summary),
+    ('0005_reimbursement_search', add_reimbursement_search),
+    ('0006_user_notify_mode', add_user_notify_mode),
+    ('0007_reimbursement_version', add_reimbursement_version),
+    ('0008_stage_timestamps', add_stage_timestamps),
+]
+
+
+def run_migrations(echo=print):
+    db.session.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "name VARCHAR(100) PRIMARY KEY, applied_at TIMESTAMP NOT NULL)"
+    ))
+    db.session.commit()
+    applied = set(db.session.execute(text("SELECT name FROM schema_migrations")).scalars())
+    for name, migrate in MIGRATIONS:
+        if name in applied:
+            continue
+        echo(f"Applying {name}")
+        migrate()
+        db.session.execute(
+            text("INSERT INTO schema_migrations (name, applied_at) VALUES (:name, :at)"),
+            {'name': name, 'at': datetime.utcnow()}
+        )
+        db.session.commit()
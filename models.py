@@ -1,12 +1,43 @@
 from flask import session
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-
-
-db= SQLAlchemy()
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import and_, bindparam, case, select, tuple_, union_all, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.dialects import postgresql, sqlite
+import base64
+import functools
+import json
+import threading
+import time
+
+from events import record_stage_change, stage_channel
+from pipeline import (
+    PIPELINE, STAGES, STAGES_BY_ROLE, STAGE_PROCESSED, STAGE_REJECTED, SKIPPED, later_stages, previous_stage
+)
+
+
+class RoutingSession(FlaskSession):
+    # Reads go to info['replica'] when a read-only request set one (see
+    # replicas.py); flushes, INSERT/UPDATE/DELETE and SELECT ... FOR UPDATE
+    # always go to the primary, and once a session has written, its later
+    # reads stay there too so it sees its own changes.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase) or getattr(clause, '_for_update_arg', None) is not None:
+            self.info['wrote'] = True
+        elif bind is None and self.info.get('replica') is not None and not self.info.get('wrote'):
+            return self.info['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db= SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     __tablename__= 'users'
+    __table_args__ = (
+        db.Index('ix_users_role_department', 'role', 'department'),
+    )
 
     id=db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -14,13 +45,17 @@ class User(db.Model):
     password_hash = db.Column(db.String(200), nullable=False)
     role = db.Column(db.String(50), nullable=False)
     department = db.Column(db.String(100), nullable=False)
+    notify_mode = db.Column(db.String(10), nullable=False, default='immediate')  # immediate / hourly / daily
 
 
 
 
-class Reimbursement(db.Model):
-    __tablename__ = 'reimb_form'
+# Approval chain (see pipeline.py): `stage` holds the role whose action is
+# pending, or a final state.
+
 
+class ReimbursementColumns:
+    # Shared by the live table and its archive (see archive.py)
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), nullable=False)
     purpose = db.Column(db.String(200), nullable=False)
@@ -30,7 +65,9 @@ class Reimbursement(db.Model):
     brochure = db.Column(db.String(200), nullable=False)
     bill = db.Column(db.String(200), nullable=False)
     status = db.Column(db.String(50), nullable=False, default='Pending Teacher')
+    stage = db.Column(db.String(20), nullable=False, default='Teacher')
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     teacher_status = db.Column(db.String(50), default='Pending')
     teacher_remarks = db.Column(db.Text)
@@ -44,123 +81,610 @@ class Reimbursement(db.Model):
     accountant_remarks = db.Column(db.Text)
 
     department = db.Column(db.String(100), default='Unknown')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # bumped by every transition
+
+    # When and by whom each stage acted; NULL while pending or if skipped (see aging.py)
+    teacher_at = db.Column(db.DateTime)
+    teacher_by = db.Column(db.String(120))
+    hod_at = db.Column(db.DateTime)
+    hod_by = db.Column(db.String(120))
+    principal_at = db.Column(db.DateTime)
+    principal_by = db.Column(db.String(120))
+    md_at = db.Column(db.DateTime)
+    md_by = db.Column(db.String(120))
+    accountant_at = db.Column(db.DateTime)  # = processed at, for Processed requests
+    accountant_by = db.Column(db.String(120))
+    stage_entered_at = db.Column(db.DateTime, default=datetime.utcnow)  # when `stage` last changed
+    sla_flagged_at = db.Column(db.DateTime)  # set once the current stage is overdue
+
+
+class Reimbursement(ReimbursementColumns, db.Model):
+    __tablename__ = 'reimb_form'
+    __table_args__ = (
+        # Department-scoped queues (Teacher, HOD) and institution-wide queues
+        # (Principal, MD, Accountant) are both index range scans in submit order.
+        db.Index('ix_reimb_stage_dept_submitted', 'stage', 'department', 'submitted_at'),
+        db.Index('ix_reimb_stage_submitted', 'stage', 'submitted_at'),
+        # Queue age and SLA checks: who has been waiting longest at each stage.
+        db.Index('ix_reimb_stage_entered', 'stage', 'stage_entered_at'),
+        # Per-stage wait percentiles over a recent window (aging.stage_waits).
+        *(db.Index(f'ix_reimb_{stage.prefix}_at', f'{stage.prefix}_at') for stage in PIPELINE),
+    )
+
+
+class ReimbursementArchive(ReimbursementColumns, db.Model):
+    # Finalised requests moved out of reimb_form; ids are kept.
+    __tablename__ = 'reimb_form_archive'
+    __table_args__ = (
+        db.Index('ix_reimb_archive_email_submitted', 'email', 'submitted_at'),
+        db.Index('ix_reimb_archive_submitted', 'submitted_at'),
+        *(db.Index(f'ix_reimb_archive_{stage.prefix}_at', f'{stage.prefix}_at') for stage in PIPELINE),
+    )
+
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ReimbursementSummary(db.Model):
+    # Rollup of reimb_form maintained alongside every insert / stage change,
+    # so the admin summary never scans the request table.
+    __tablename__ = 'reimb_summary'
+
+    department = db.Column(db.String(100), primary_key=True)
+    stage = db.Column(db.String(20), primary_key=True)
+    month = db.Column(db.String(7), primary_key=True)  # YYYY-MM of submitted_at
+    request_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0)
+
+
+class StoredBlob(db.Model):
+    # One row per unique uploaded file; key is "<sha256>.<ext>" (see storage.py)
+    __tablename__ = 'stored_blobs'
+
+    key = db.Column(db.String(80), primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ReimbursementDocument(db.Model):
+    __tablename__ = 'reimb_documents'
+
+    id = db.Column(db.Integer, primary_key=True)
+    reimbursement_id = db.Column(db.Integer, nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # letter / certificate / brochure / bill
+    blob_key = db.Column(db.String(80), db.ForeignKey('stored_blobs.key'), nullable=False, index=True)
+
+
+class MaintenanceCheckpoint(db.Model):
+    # Progress of resumable maintenance jobs (see maintenance.py)
+    __tablename__ = 'maintenance_checkpoints'
+
+    name = db.Column(db.String(100), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class PayoutBatch(db.Model):
+    # Month-end payout report runs and their progress (see payouts.py)
+    __tablename__ = 'payout_batches'
+
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), nullable=False)  # YYYY-MM the claims were processed in
+    department = db.Column(db.String(100))  # None = all departments
+    status = db.Column(db.String(20), nullable=False, default='Queued')  # Queued / Running / Done / Failed
+    total = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    path = db.Column(db.String(300))
+    error = db.Column(db.Text)
+    requested_by = db.Column(db.String(120))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+
+class OutboxMessage(db.Model):
+    __tablename__ = 'mail_outbox'
+    __table_args__ = (
+        db.Index('ix_mail_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    sender = db.Column(db.String(120))
+    recipients = db.Column(db.Text, nullable=False)  # comma separated
+    body = db.Column(db.Text, nullable=False)
+    attachment_name = db.Column(db.String(200))
+    attachment_type = db.Column(db.String(100))
+    attachment_data = db.Column(db.LargeBinary)
+    report_id = db.Column(db.Integer)  # attach the cached PDF report of this request at send time
+
+    # pending -> sending -> sent | failed
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+
+class NotificationEvent(db.Model):
+    # Notifications held back for a recipient on an hourly / daily digest (see notifications.py)
+    __tablename__ = 'notification_events'
+    __table_args__ = (
+        db.Index('ix_notification_events_recipient_created', 'recipient', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    req_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class UserInvite(db.Model):
+    # One-time password-setup links for bulk-imported users (see provisioning.py)
+    __tablename__ = 'user_invites'
+
+    token_hash = db.Column(db.String(64), primary_key=True)  # sha256 of the emailed token
+    email = db.Column(db.String(120), nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    used_at = db.Column(db.DateTime)
 
 
+class ServerSession(db.Model):
+    # Server-side session data (see sessions.py); the cookie only holds the signed id
+    __tablename__ = 'user_sessions'
+
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ReplicaHeartbeat(db.Model):
+    # Single row rewritten on the primary; how far behind a replica's copy is
+    # tells how stale it is (see replicas.py)
+    __tablename__ = 'replica_heartbeat'
+
+    id = db.Column(db.Integer, primary_key=True)
+    beat_at = db.Column(db.DateTime, nullable=False)
+
+
+class ChangeVersion(db.Model):
+    # Counter per cache scope (an approval queue, a student's history), bumped
+    # in the same transaction as the change; HTTP ETags are built from it
+    __tablename__ = 'change_versions'
+
+    scope = db.Column(db.String(200), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+
+# ---------------- Directory Cache ----------------
+# Recipient lists and user profiles change a few times a year but are read on
+# every submission and approval. Entries live for DIRECTORY_TTL seconds and
+# the whole cache is dropped whenever this process writes to `users`; other
+# worker processes pick the change up when their entries expire.
+
+DIRECTORY_TTL = 300
+_directory_cache = {}
+_directory_lock = threading.Lock()
+
+def _directory_lookup(key, loader):
+    now = time.monotonic()
+    entry = _directory_cache.get(key)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    value = loader()
+    with _directory_lock:
+        _directory_cache[key] = (now + DIRECTORY_TTL, value)
+    return value
+
+def invalidate_directory():
+    with _directory_lock:
+        _directory_cache.clear()
+
 # db.py (PostgreSQL + SQLAlchemy version)
 def insert_user(name, email, password_hash, role, department):
     user = User(name=name, email=email, password_hash=password_hash, role=role, department=department)
     db.session.add(user)
     db.session.commit()
+    invalidate_directory()
 
 def get_user_by_email(email):
     return User.query.filter_by(email=email).first()
 
 def get_emails_by_role_and_dept(role, department):
-    users = User.query.filter_by(role=role, department=department).all()
-    return [user.email for user in users]
+    emails = _directory_lookup(('emails', role, department), lambda: tuple(
+        e for (e,) in db.session.query(User.email).filter_by(role=role, department=department)))
+    return list(emails)
 
 def get_emails_by_role(role):
-    users = User.query.filter_by(role=role).all()
-    return [user.email for user in users]
+    emails = _directory_lookup(('emails', role, None), lambda: tuple(
+        e for (e,) in db.session.query(User.email).filter_by(role=role)))
+    return list(emails)
+
+def get_user_profile(email):
+    # (name, role, department) or None
+    return _directory_lookup(('profile', email), lambda: db.session.query(
+        User.name, User.role, User.department).filter_by(email=email).first())
 
 def get_name_by_email(email):
-    user = User.query.filter_by(email=email).first()
-    return user.name if user else None
+    profile = get_user_profile(email)
+    return profile.name if profile else None
+
+def get_digest_modes():
+    # email -> notify_mode for the (few) users who chose a digest
+    return _directory_lookup(('digest_modes',), lambda: dict(
+        db.session.query(User.email, User.notify_mode).filter(User.notify_mode != 'immediate').all()))
 
-def get_all_users():
-    users = User.query.all()
-    return [(u.name, u.email, u.role, u.department) for u in users]
+def set_notify_mode(email, mode):
+    User.query.filter_by(email=email).update({'notify_mode': mode})
+    db.session.commit()
+    invalidate_directory()
+
+def get_users_page(after_id=None, limit=None):
+    # (rows, next_after_id) in id order; keyset paging like the request lists.
+    limit = max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+    query = User.query.order_by(User.id)
+    if after_id:
+        query = query.filter(User.id > after_id)
+    users = query.limit(limit + 1).all()
+    next_after = users[limit - 1].id if len(users) > limit else None
+    return [(u.name, u.email, u.role, u.department) for u in users[:limit]], next_after
 
 # ---------------- Reimbursement Flow ----------------
 
-def insert_reimbursement(email, purpose, amount, letter, certificate, brochure, bill):
-    user = User.query.filter_by(email=email).first()
-    department = user.department if user else "Unknown"
+def dialect_insert(model):
+    # INSERT with ON CONFLICT support for the configured database
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def insert_reimbursement(email, purpose, amount, letter, certificate, brochure, bill, documents=None):
+    # documents: {kind: storage.StoredFile} to record blob references. Does
+    # not commit: the caller queues the notifications (which need reimb.id,
+    # set by the flush) and commits them together with the request.
+    profile = get_user_profile(email)
+    department = profile.department if profile else "Unknown"
+    first = PIPELINE[0]
     reimb = Reimbursement(
         email=email, purpose=purpose, amount=amount,
         letter=letter, certificate=certificate, brochure=brochure, bill=bill,
-        status='Pending Teacher', submitted_at=datetime.now(),
+        status=first.pending_status, stage=first.role, submitted_at=datetime.now(),
         department=department
     )
+    reimb.stage_entered_at = reimb.submitted_at
     db.session.add(reimb)
-    db.session.commit()
-
-def get_all_reimbursements():
-    reimbursements = Reimbursement.query.all()
+    bump_summary(department, first.role, reimb.submitted_at, 1, amount)
+    db.session.flush()
+    record_stage_change(db.session, reimb.id, department, None, first.role)
+    bump_change_versions([stage_channel(first.role, department), student_scope(email)])
+    if documents:
+        stored = [d for d in documents.values() if d]
+        if stored:
+            db.session.execute(dialect_insert(StoredBlob).values([
+                {'key': d.key, 'sha256': d.sha256, 'size': d.size, 'created_at': datetime.utcnow()} for d in stored
+            ]).on_conflict_do_nothing(index_elements=['key']))
+        db.session.add_all([
+            ReimbursementDocument(reimbursement_id=reimb.id, kind=kind, blob_key=d.key)
+            for kind, d in documents.items() if d
+        ])
+    return reimb
+
+def reimbursement_entity(include_archived=False):
+    # Reimbursement, or an alias of it over reimb_form UNION ALL
+    # reimb_form_archive for the (rare) views that ask for history.
+    if not include_archived:
+        return Reimbursement
+    names = [c.name for c in Reimbursement.__table__.columns]
+    rows = union_all(select(*[Reimbursement.__table__.c[n] for n in names]),
+                     select(*[ReimbursementArchive.__table__.c[n] for n in names]))
+    return aliased(Reimbursement, rows.subquery('reimb_all'))
+
+def get_reimbursement(req_id):
+    # A single request by id, live or archived.
+    return db.session.get(Reimbursement, req_id) or db.session.get(ReimbursementArchive, req_id)
+
+def get_reimbursements_page(include_archived=False, **page):
+    entity = reimbursement_entity(include_archived)
+    rows, next_cursor = paginate_reimbursements(db.session.query(entity), entity=entity, **page)
     return [(r.email, r.purpose, r.amount, r.status, r.submitted_at,
              r.teacher_status, r.hod_status, r.principal_status,
-             r.md_status, r.accountant_status) for r in reimbursements]
+             r.md_status, r.accountant_status) for r in rows], next_cursor
 
-def get_reimbursement_by_email(email):
-    records = Reimbursement.query.filter_by(email=email).all()
+def get_reimbursement_by_email(email, include_archived=False):
+    entity = reimbursement_entity(include_archived)
+    records = db.session.query(entity).filter(entity.email == email).order_by(entity.submitted_at).all()
     return [(r.purpose, r.amount, r.status, r.submitted_at) for r in records]
 
-def get_pending_requests_for_teacher(department):
-    return Reimbursement.query.filter_by(teacher_status='Pending', department=department).all()
-
-def get_pending_requests_for_hod(department):
-    return Reimbursement.query.filter_by(
-        hod_status='Pending', teacher_status='Approved', department=department
-    ).all()
-
-def get_pending_requests_for_principal():
-    return Reimbursement.query.filter_by(
-        principal_status='Pending', teacher_status='Approved', hod_status='Approved'
-    ).all()
-
-def get_pending_requests_for_md():
-    return Reimbursement.query.filter_by(
-        md_status='Pending', teacher_status='Approved',
-        hod_status='Approved', principal_status='Approved'
-    ).all()
-
-def get_pending_requests_for_accountant():
-    return Reimbursement.query.filter_by(
-        accountant_status='Pending', teacher_status='Approved',
-        hod_status='Approved', principal_status='Approved', md_status='Approved'
-    ).all()
-
-# ---------------- Approval Updates ----------------
-
-def update_teacher_approval(req_id, status, remarks):
-    reimb = Reimbursement.query.get(req_id)
-    if reimb:
-        reimb.teacher_status = status
-        reimb.teacher_remarks = remarks
-        reimb.status = "Pending HOD" if status == "Approved" else "Rejected by Teacher"
-        db.session.commit()
-
-def update_hod_approval(req_id, status, remarks):
-    reimb = Reimbursement.query.get(req_id)
-    if reimb:
-        reimb.hod_status = status
-        reimb.hod_remarks = remarks
-        reimb.status = "Pending Principal" if status == "Approved" else "Rejected by HOD"
-        db.session.commit()
-
-def update_principal_approval(req_id, status, remarks):
-    reimb = Reimbursement.query.get(req_id)
-    if reimb:
-        reimb.principal_status = status
-        reimb.principal_remarks = remarks
-        reimb.status = "Pending MD" if status == "Approved" else "Rejected by Principal"
-        db.session.commit()
+# ---------------- Paging ----------------
+# Keyset (cursor) paging: the cursor carries the sort value and id of the
+# last row shown, so every page is an index range scan instead of an OFFSET.
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SORT_COLUMNS = ('submitted_at', 'amount')
+
+def encode_cursor(sort, row):
+    value = getattr(row, sort)
+    value = value.isoformat() if isinstance(value, datetime) else value
+    return base64.urlsafe_b64encode(json.dumps([sort, value, row.id]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        sort, value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == 'submitted_at':
+            value = datetime.fromisoformat(value)
+        return sort, value, int(last_id)
+    except (ValueError, TypeError):
+        return None
+
+def filter_reimbursements(query, department=None, status=None, min_amount=None, max_amount=None,
+                          date_from=None, date_to=None, entity=Reimbursement):
+    # Works on both legacy Query objects and 2.0-style select() statements;
+    # `entity` is Reimbursement or a reimbursement_entity() alias.
+    if department:
+        query = query.filter(entity.department == department)
+    if status:
+        query = query.filter(entity.status == status)
+    if min_amount is not None:
+        query = query.filter(entity.amount >= min_amount)
+    if max_amount is not None:
+        query = query.filter(entity.amount <= max_amount)
+    if date_from:
+        query = query.filter(entity.submitted_at >= date_from)
+    if date_to:
+        query = query.filter(entity.submitted_at < date_to + timedelta(days=1))
+    return query
+
+def paginate_reimbursements(query, cursor=None, limit=PAGE_SIZE, sort='submitted_at', order='asc',
+                            entity=Reimbursement, **filters):
+    # Returns (rows, next_cursor); next_cursor is None on the last page.
+    if sort not in SORT_COLUMNS:
+        sort = 'submitted_at'
+    limit = max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+    column = getattr(entity, sort)
+    descending = order == 'desc'
+
+    query = filter_reimbursements(query, entity=entity, **filters)
+    position = decode_cursor(cursor) if cursor else None
+    if position and position[0] == sort:
+        key = tuple_(column, entity.id)
+        query = query.filter(key < (position[1], position[2]) if descending else key > (position[1], position[2]))
+    if descending:
+        query = query.order_by(column.desc(), entity.id.desc())
+    else:
+        query = query.order_by(column, entity.id)
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(sort, rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+# ---------------- Approval Queues ----------------
+
+def get_pending_requests(role, **page):
+    # (rows, next_cursor) for the queue of `role`; see paginate_reimbursements
+    # for **page. For department-scoped stages page['department'] is the
+    # approver's own department rather than a filter.
+    query = Reimbursement.query.filter(Reimbursement.stage == role)
+    if STAGES_BY_ROLE[role].scoped:
+        query = query.filter(Reimbursement.department == page.pop('department', None))
+    return paginate_reimbursements(query, **page)
+
+# ---------------- Approval Transitions ----------------
+
+def _approved_values(stage):
+    # Where an approval at `stage` sends a request. Later stages the claim is
+    # too small for are skipped (pipeline.APPROVAL_SKIP_BELOW), so the next
+    # stage, its status and the skipped stages' status columns are CASEs on
+    # the amount.
+    values, stage_whens, status_whens, skipped = {}, [], [], []
+    target = None
+    for later in later_stages(stage):
+        if later.skip_below is None:
+            target = later
+            break
+        stage_whens.append((Reimbursement.amount >= later.skip_below, later.role))
+        status_whens.append((Reimbursement.amount >= later.skip_below, later.pending_status))
+        skipped.append(Reimbursement.amount < later.skip_below)
+        column = getattr(Reimbursement, f'{later.prefix}_status')
+        values[column] = case((and_(*skipped), SKIPPED), else_=column)
+    next_stage = target.role if target else STAGE_PROCESSED
+    next_status = target.pending_status if target else 'Processed'
+    values[Reimbursement.stage] = case(*stage_whens, else_=next_stage) if stage_whens else next_stage
+    values[Reimbursement.status] = case(*status_whens, else_=next_status) if status_whens else next_status
+    return values
+
+def _transition_statement(role, status, department=False):
+    # UPDATE for requests waiting on `role` whose previous approver approved
+    # (or skipped) them, and in :approver_department if `department`. The WHERE clause
+    # is the whole concurrency check: a row another approver got to first no
+    # longer matches and is not returned. Parameters: :remarks, and :acted_at
+    # / :actor stamped on the stage.
+    stage = STAGES_BY_ROLE[role]
+    conditions = [Reimbursement.stage == role]
+    previous = previous_stage(stage)
+    if previous is not None:
+        conditions.append(getattr(Reimbursement, f'{previous.prefix}_status').in_(('Approved', SKIPPED)))
+    if department:
+        conditions.append(Reimbursement.department == bindparam('approver_department'))
+    values = {
+        getattr(Reimbursement, f'{stage.prefix}_status'): status,
+        getattr(Reimbursement, f'{stage.prefix}_remarks'): bindparam('remarks'),
+        getattr(Reimbursement, f'{stage.prefix}_at'): bindparam('acted_at'),
+        getattr(Reimbursement, f'{stage.prefix}_by'): bindparam('actor'),
+        Reimbursement.stage_entered_at: bindparam('acted_at'),
+        Reimbursement.sla_flagged_at: None,
+        Reimbursement.version: Reimbursement.version + 1,
+    }
+    if status == 'Approved':
+        values.update(_approved_values(stage))
+    else:
+        values.update({Reimbursement.stage: STAGE_REJECTED, Reimbursement.status: stage.rejected_status})
+    return (
+        update(Reimbursement)
+        .where(*conditions)
+        .values(values)
+        .returning(Reimbursement.id, Reimbursement.email, Reimbursement.department, Reimbursement.amount,
+                   Reimbursement.submitted_at, Reimbursement.stage, Reimbursement.status, Reimbursement.version)
+        .execution_options(synchronize_session=False)
+    )
 
-def update_md_approval(req_id, status, remarks):
-    reimb = Reimbursement.query.get(req_id)
-    if reimb:
-        reimb.md_status = status
-        reimb.md_remarks = remarks
-        reimb.status = "Pending Accountant" if status == "Approved" else "Rejected by MD"
-        db.session.commit()
+@functools.lru_cache(maxsize=None)
+def _single_transition(role, status, department, versioned):
+    # Built once per shape; only the bound parameters change per approval.
+    stmt = _transition_statement(role, status, department).where(Reimbursement.id == bindparam('req_id'))
+    if versioned:
+        stmt = stmt.where(Reimbursement.version == bindparam('expected_version'))
+    return stmt
+
+def _record_transitions(role, rows):
+    # Rollup cells and live-update events for the rows that moved.
+    moved = {}
+    for r in rows:
+        key = (r.department, summary_month(r.submitted_at), r.stage)
+        count, amount = moved.get(key, (0, 0))
+        moved[key] = (count + 1, amount + r.amount)
+    for (dept, month, new_stage), (count, amount) in moved.items():
+        bump_summary(dept, role, month, -count, -amount)
+        bump_summary(dept, new_stage, month, count, amount)
+    for r in rows:
+        record_stage_change(db.session, r.id, r.department, role, r.stage)
+    scopes = set()
+    for r in rows:
+        scopes.update((stage_channel(role, r.department), student_scope(r.email)))
+        if r.stage in STAGES:
+            scopes.add(stage_channel(r.stage, r.department))
+    bump_change_versions(scopes)
+
+def transition_request(req_id, role, status, remarks, version=None, department=None, actor=None):
+    # Approves or rejects one request with a single conditional
+    # UPDATE ... RETURNING. `version` is the one the approver was shown; if
+    # given, the request must not have changed since. Returns the updated
+    # row, or None on a conflict (already handled, other stage or version).
+    # Does not commit, so the caller can queue notifications in the same
+    # transaction.
+    stmt = _single_transition(role, status, department is not None, version is not None)
+    row = db.session.execute(stmt, {'req_id': req_id, 'remarks': remarks, 'expected_version': version,
+                                    'approver_department': department, 'acted_at': datetime.utcnow(),
+                                    'actor': actor}).first()
+    if row is not None:
+        _record_transitions(role, [row])
+    return row
+
+# ---------------- Bulk Approvals ----------------
+
+def bulk_update_approval(role, req_ids, status, remarks_by_id, department=None, actor=None):
+    # The same transition for a whole selection in one UPDATE; the rows
+    # actually changed come back via RETURNING. Does not commit.
+    prefix = STAGES_BY_ROLE[role].prefix
+    stmt = (_transition_statement(role, status, department is not None)
+            .where(Reimbursement.id.in_(req_ids))
+            .values({getattr(Reimbursement, f'{prefix}_remarks'): case(remarks_by_id, value=Reimbursement.id)}))
+    rows = db.session.execute(stmt, {'approver_department': department, 'acted_at': datetime.utcnow(),
+                                     'actor': actor}).all()
+    _record_transitions(role, rows)
+    return rows
+
+# ---------------- Summary ----------------
+
+def summary_month(value):
+    return value.strftime('%Y-%m') if isinstance(value, datetime) else value
+
+def bump_summary(department, stage, submitted_at, count, amount):
+    # Atomic upsert-increment of one rollup cell; part of the caller's transaction.
+    stmt = dialect_insert(ReimbursementSummary).values(
+        department=department or 'Unknown', stage=stage, month=summary_month(submitted_at),
+        request_count=count, total_amount=amount
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['department', 'stage', 'month'],
+        set_={
+            'request_count': ReimbursementSummary.request_count + stmt.excluded.request_count,
+            'total_amount': ReimbursementSummary.total_amount + stmt.excluded.total_amount,
+        }
+    ))
+
+def _month_expression(model=Reimbursement):
+    if db.engine.dialect.name == 'postgresql':
+        return db.func.to_char(model.submitted_at, 'YYYY-MM')
+    return db.func.strftime('%Y-%m', model.submitted_at)
+
+def compute_summary():
+    # GROUP BY straight off reimb_form and its archive (archiving does not
+    # change the rollup); used to (re)build the rollup.
+    cells = {}
+    for model in (Reimbursement, ReimbursementArchive):
+        month = _month_expression(model)
+        department = db.func.coalesce(model.department, 'Unknown')
+        for dept, stage, m, count, total in db.session.query(
+            department, model.stage, month, db.func.count(model.id), db.func.coalesce(db.func.sum(model.amount), 0)
+        ).group_by(department, model.stage, month):
+            previous = cells.get((dept, stage, m), (0, 0))
+            cells[(dept, stage, m)] = (previous[0] + count, previous[1] + total)
+    return [(dept, stage, m, count, total) for (dept, stage, m), (count, total) in cells.items()]
+
+def rebuild_summary():
+    ReimbursementSummary.query.delete()
+    db.session.add_all([
+        ReimbursementSummary(department=dept, stage=stage, month=month, request_count=count, total_amount=total)
+        for dept, stage, month, count, total in compute_summary()
+    ])
+    db.session.commit()
 
-def update_accountant_approval(req_id, status, remarks):
-    reimb = Reimbursement.query.get(req_id)
-    if reimb:
-        reimb.accountant_status = status
-        reimb.accountant_remarks = remarks
-        reimb.status = "Processed" if status == "Approved" else "Rejected by Accountant"
-        db.session.commit()
+def get_summary(by=('department', 'stage')):
+    # Counts, sums and averages over the rollup grouped by any of
+    # department / stage / month.
+    columns = [getattr(ReimbursementSummary, name) for name in by]
+    count = db.func.sum(ReimbursementSummary.request_count)
+    total = db.func.sum(ReimbursementSummary.total_amount)
+    rows = db.session.query(*columns, count.label('count'), total.label('total')) \
+        .group_by(*columns).having(count > 0).order_by(*columns).all()
+    return [dict(zip(by, r[:len(by)]), count=r.count, total=r.total, average=r.total / r.count) for r in rows]
+
+# ---------------- Change Versions ----------------
+# What the conditional GETs in app.py compare: a queue scope is named like its
+# live-update channel (events.stage_channel), a student's history is
+# "student:<email>", and GLOBAL_SCOPE is bumped by bulk rewrites that touch
+# every page (maintenance.normalize_statuses).
+
+GLOBAL_SCOPE = 'all'
+
+def student_scope(email):
+    return f"student:{email}"
+
+def bump_change_versions(scopes):
+    # Atomic upsert-increment, part of the caller's transaction. Sorted so
+    # concurrent bulk transitions lock the rows in the same order.
+    scopes = sorted(set(scopes))
+    if not scopes:
+        return
+    stmt = dialect_insert(ChangeVersion).values([{'scope': scope, 'version': 1} for scope in scopes])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['scope'], set_={'version': ChangeVersion.version + 1}
+    ))
+
+def get_change_versions(scopes):
+    # scope -> version, 0 for scopes nothing has changed in yet
+    rows = db.session.execute(select(ChangeVersion.scope, ChangeVersion.version)
+                              .where(ChangeVersion.scope.in_(scopes))).all()
+    versions = dict.fromkeys(scopes, 0)
+    versions.update(rows)
+    return versions
+
+# ---------------- Mail Outbox ----------------
+
+def enqueue_email(subject, recipients, body, sender=None, attachment=None, report_id=None):
+    # Only adds to the session: the row is committed together with whatever
+    # change the caller commits next, and delivered later by mailer.py.
+    if not recipients:
+        return None
+    msg = OutboxMessage(
+        subject=subject, sender=sender, recipients=','.join(recipients), body=body, report_id=report_id,
+        status='pending', attempts=0, next_attempt_at=datetime.utcnow()
+    )
+    if attachment:
+        msg.attachment_name, msg.attachment_type, msg.attachment_data = attachment
+    db.session.add(msg)
+    return msg
 
 # ---------------- Utility ----------------
 
@@ -0,0 +1,113 @@
+# notifications.py - approver notifications, immediate or as a digest
+#
+# Every approval used to mail the next approvers right away, one message per
+# request. Users can now choose an hourly or daily digest instead: notify()
+# still queues an immediate mail for everyone else, but records an event row
+# per digest recipient and request. send_due_digests() then turns all of a
+# recipient's pending events into one message listing the requests, once
+# their oldest event is an hour / a day old. It runs from the outbox worker
+# and from `flask --app app send-digests`.
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert
+
+from models import (
+    db, NotificationEvent, Reimbursement, enqueue_email, get_digest_modes, get_emails_by_role,
+    get_emails_by_role_and_dept, get_name_by_email
+)
+
+# mode -> how long events may wait before the digest goes out
+NOTIFY_MODES = {
+    'immediate': None,
+    'hourly': timedelta(hours=1),
+    'daily': timedelta(days=1),
+}
+DIGEST_CHUNK_SIZE = 500
+
+
+def notify(subject, recipients, body, req_ids, sender=None, report_id=None, topic=None, immediate=False):
+    # Same contract as enqueue_email (adds to the caller's transaction), for
+    # mails about the requests in `req_ids`. `topic` heads the requests'
+    # section in a digest (default: the subject). Mails carrying reports (an
+    # attached PDF, or `immediate` ones with download links) go out right away
+    # to everyone, since a digest only lists the requests.
+    digest = {} if immediate or report_id is not None else get_digest_modes()
+    immediate = [r for r in recipients if r not in digest]
+    enqueue_email(subject, immediate, body, sender=sender, report_id=report_id)
+    now = datetime.utcnow()
+    events = [{'recipient': r, 'subject': topic or subject, 'req_id': req_id, 'created_at': now}
+              for r in recipients if r in digest for req_id in req_ids]
+    if events:
+        db.session.execute(insert(NotificationEvent), events)
+
+
+def stage_recipients(stage, department=None):
+    # Approvers of a pipeline stage (department-scoped stages: of `department`).
+    if stage.scoped:
+        return get_emails_by_role_and_dept(stage.role, department)
+    return get_emails_by_role(stage.role)
+
+
+def _due_recipients(now, flush):
+    modes = get_digest_modes()
+    pending = db.session.query(NotificationEvent.recipient, func.min(NotificationEvent.created_at)) \
+        .group_by(NotificationEvent.recipient).all()
+    due = []
+    for recipient, oldest in pending:
+        # Someone who switched back to immediate gets what is left right away.
+        window = NOTIFY_MODES.get(modes.get(recipient, 'immediate'))
+        if flush or window is None or oldest <= now - window:
+            due.append(recipient)
+    return due
+
+
+def _digest_body(recipient, events, details):
+    by_subject = {}
+    for e in sorted(events, key=lambda e: (e.created_at, e.req_id)):
+        by_subject.setdefault(e.subject, {}).setdefault(e.req_id, e)
+    sections = []
+    for subject, requests in by_subject.items():
+        lines = []
+        for req_id in requests:
+            r = details.get(req_id)
+            lines.append(f"  - Request {req_id}: ₹{r.amount} ({r.department}) — {r.purpose}" if r
+                         else f"  - Request {req_id}")
+        sections.append(f"{subject} ({len(lines)})\n" + "\n".join(lines))
+    count = sum(len(requests) for requests in by_subject.values())
+    name = get_name_by_email(recipient) or 'Faculty'
+    body = (f"Dear {name},\n\nHere is a summary of {count} reimbursement update(s) since your last digest:\n\n"
+            + "\n\n".join(sections) + "\n\nPlease login to review.\n\nRegards,\nReimbursement Portal\n")
+    return count, body
+
+
+def send_due_digests(sender=None, now=None, flush=False):
+    # Queues one digest mail per due recipient; returns how many were queued.
+    # Events are claimed with DELETE ... RETURNING, so concurrent runs (one
+    # per outbox worker) never put the same event in two digests.
+    now = now or datetime.utcnow()
+    due = _due_recipients(now, flush)
+    sent = 0
+    for i in range(0, len(due), DIGEST_CHUNK_SIZE):
+        events = db.session.execute(
+            delete(NotificationEvent)
+            .where(NotificationEvent.recipient.in_(due[i:i + DIGEST_CHUNK_SIZE]))
+            .returning(NotificationEvent.recipient, NotificationEvent.subject, NotificationEvent.req_id,
+                       NotificationEvent.created_at)
+            .execution_options(synchronize_session=False)
+        ).all()
+        req_ids = list({e.req_id for e in events})
+        details = {}
+        for j in range(0, len(req_ids), DIGEST_CHUNK_SIZE):
+            details.update((r.id, r) for r in db.session.query(
+                Reimbursement.id, Reimbursement.amount, Reimbursement.department, Reimbursement.purpose
+            ).filter(Reimbursement.id.in_(req_ids[j:j + DIGEST_CHUNK_SIZE])))
+
+        by_recipient = {}
+        for e in events:
+            by_recipient.setdefault(e.recipient, []).append(e)
+        for recipient, recipient_events in by_recipient.items():
+            count, body = _digest_body(recipient, recipient_events, details)
+            enqueue_email(f"Reimbursement Portal digest: {count} update(s)", [recipient], body, sender=sender)
+            sent += 1
+        db.session.commit()
+    return sent
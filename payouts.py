@@ -0,0 +1,187 @@
+# payouts.py - month-end payout report bundles for the accounts department
+#
+# A batch covers every Processed claim whose final approval fell in one month
+# (optionally one department). Claims are streamed from the database in id
+# order per department, rendered to PDF on a process pool and written into a
+# ZIP on disk as they finish: one folder per department holding a summary PDF
+# and the individual claim reports. Claim reports already in the report cache
+# are copied instead of re-rendered. Progress is stored on the PayoutBatch row
+# so any worker can report it while the batch runs.
+import io
+import multiprocessing
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, select, update
+
+from models import db, PayoutBatch, STAGE_PROCESSED, reimbursement_entity
+from reports import generate_payout_summary, render_report, report_data
+
+PAYOUT_CHUNK_SIZE = 500
+PROGRESS_EVERY = 50  # claims between progress writes
+
+
+def period_bounds(period):
+    # 'YYYY-MM' -> [first day of month, first day of next month)
+    start = datetime.strptime(period, '%Y-%m')
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start, end
+
+
+def _filters(entity, period, department):
+    # accountant_at is when the final approval happened (migration 0008
+    # backfilled it from updated_at for older claims).
+    start, end = period_bounds(period)
+    filters = [entity.stage == STAGE_PROCESSED, entity.accountant_at >= start, entity.accountant_at < end]
+    if department:
+        filters.append(entity.department == department)
+    return filters
+
+
+# Old months may already be (partly) archived, so payouts read both tables.
+def count_payout_claims(period, department=None):
+    entity = reimbursement_entity(include_archived=True)
+    return db.session.query(func.count(entity.id)).filter(*_filters(entity, period, department)).scalar()
+
+
+def iter_payout_claims(period, department=None, chunk_size=PAYOUT_CHUNK_SIZE):
+    entity = reimbursement_entity(include_archived=True)
+    stmt = (select(entity).where(*_filters(entity, period, department))
+            .order_by(entity.department, entity.id)
+            .execution_options(yield_per=chunk_size))
+    yield from db.session.execute(stmt).scalars()
+
+
+def _render_claim(data):
+    return render_report(data)
+
+
+def _render_summary(department, period, claims):
+    buffer = io.BytesIO()
+    generate_payout_summary(department, period, claims, buffer)
+    return buffer.getvalue()
+
+
+def _set_progress(batch_id, **values):
+    # Own transaction: db.session is busy streaming claims, and committing it
+    # would close the server-side cursor.
+    with db.engine.begin() as conn:
+        conn.execute(update(PayoutBatch).where(PayoutBatch.id == batch_id).values(**values))
+
+
+def build_payout_bundle(batch, output_dir, workers=2, echo=None):
+    # Writes the ZIP for `batch` and returns its path.
+    os.makedirs(output_dir, exist_ok=True)
+    scope = batch.department or 'all'
+    path = os.path.join(output_dir, f"payouts-{batch.period}-{scope}-{batch.id}.zip")
+    partial = f"{path}.part"
+    total = count_payout_claims(batch.period, batch.department)
+    _set_progress(batch.id, status='Running', total=total, done=0, error=None)
+    reports = current_app.extensions.get('reports')
+
+    done = 0
+    window = deque()  # (archive name, future or cached path), written in order
+    # "spawn" so the pool never forks a threaded web worker; PDFs are already
+    # compressed, so entries are stored rather than deflated again.
+    pool = ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('spawn'))
+    try:
+        with zipfile.ZipFile(partial, 'w', zipfile.ZIP_STORED) as bundle:
+            def drain(keep):
+                nonlocal done
+                while len(window) > keep:
+                    name, item = window.popleft()
+                    if isinstance(item, str):
+                        bundle.write(item, name)
+                    else:
+                        bundle.writestr(name, item.result())
+                    if name.endswith('summary.pdf'):
+                        continue
+                    done += 1
+                    if done % PROGRESS_EVERY == 0 or done == total:
+                        _set_progress(batch.id, done=done)
+                        if echo:
+                            echo(f"{done}/{total} claims")
+
+            def add_summary(department, claims):
+                window.append((f"{department}/summary.pdf",
+                               pool.submit(_render_summary, department, batch.period, claims)))
+
+            department, claims = None, []
+            for reimb in iter_payout_claims(batch.period, batch.department):
+                if reimb.department != department:
+                    if claims:
+                        add_summary(department, claims)
+                    department, claims = reimb.department, []
+                data = report_data(reimb)
+                claims.append({'id': reimb.id, 'student_name': data['student_name'], 'email': reimb.email,
+                               'purpose': reimb.purpose, 'amount': reimb.amount, 'processed_at': reimb.accountant_at})
+                name = f"{reimb.department}/claim-{reimb.id}.pdf"
+                cached = reports.cached_path(reimb) if reports else None
+                window.append((name, cached or pool.submit(_render_claim, data)))
+                # Bounded look-ahead: memory stays flat however many claims there are.
+                drain(keep=workers * 4)
+            if claims:
+                add_summary(department, claims)
+            drain(keep=0)
+    except BaseException:
+        for _, item in window:
+            if not isinstance(item, str):
+                item.cancel()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    os.replace(partial, path)
+    return path
+
+
+def create_payout_batch(period, department=None, requested_by=None):
+    period_bounds(period)  # ValueError on a malformed period
+    batch = PayoutBatch(period=period, department=department or None, requested_by=requested_by)
+    db.session.add(batch)
+    db.session.commit()
+    return batch
+
+
+def run_payout_batch(batch_id, output_dir, workers=2, echo=None):
+    batch = db.session.get(PayoutBatch, batch_id)
+    try:
+        path = build_payout_bundle(batch, output_dir, workers=workers, echo=echo)
+    except Exception as e:
+        db.session.rollback()
+        _set_progress(batch_id, status='Failed', error=str(e), finished_at=datetime.utcnow())
+        raise
+    _set_progress(batch_id, status='Done', path=path, finished_at=datetime.utcnow())
+    return path
+
+
+class PayoutService:
+    """Runs payout batches one at a time in the background of a web worker."""
+
+    def __init__(self, app=None):
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.output_dir = app.config['PAYOUT_DIR']
+        self.workers = app.config['PAYOUT_WORKERS']
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='payout-batch')
+        app.extensions['payouts'] = self
+
+    def _run(self, batch_id):
+        with self.app.app_context():
+            try:
+                return run_payout_batch(batch_id, self.output_dir, workers=self.workers)
+            except Exception:
+                self.app.logger.exception('Payout batch %s failed', batch_id)
+
+    def submit(self, batch_id):
+        return self.executor.submit(self._run, batch_id)
@@ -0,0 +1,68 @@
+# pipeline.py - the approval chain, declared once
+#
+# A request visits PIPELINE in order; reimb_form.stage holds the role whose
+# action is pending, then Processed or Rejected. Everything that differs per
+# stage (queue scope, status labels, the mail sent when a request arrives,
+# the dashboard template) lives here, and models.py / app.py have a single
+# queue query, transition and route for all stages. Adding a stage is one
+# Stage(...) line plus its <role>_status / <role>_remarks columns.
+#
+# APPROVAL_SKIP_BELOW lets small claims skip stages: with "MD:5000" a claim
+# under ₹5000 goes from the Principal straight to the Accountant, and its
+# md_status is recorded as Skipped.
+from config import APPROVAL_SKIP_BELOW
+
+STAGE_PROCESSED = 'Processed'
+STAGE_REJECTED = 'Rejected'
+FINAL_STAGES = (STAGE_PROCESSED, STAGE_REJECTED)  # never change again; archived after a while
+SKIPPED = 'Skipped'
+
+
+class Stage:
+    """One approval step: who acts, on which requests, and how they hear about them."""
+
+    def __init__(self, role, template, scoped=False, subject=None, ask='Please review and take action.'):
+        self.role = role
+        self.prefix = role.lower()  # <prefix>_status / <prefix>_remarks columns, /<prefix>_dashboard
+        self.template = template
+        self.scoped = scoped  # queue (and notifications) limited to one department
+        self.pending_status = f'Pending {role}'
+        self.rejected_status = f'Rejected by {role}'
+        self.subject = subject or f'Action Required: {role} Approval'
+        self.ask = ask
+        self.skip_below = None  # claims under this amount skip the stage
+
+
+PIPELINE = [
+    Stage('Teacher', 'teacher_dashboard.html', scoped=True),
+    Stage('HOD', 'Hod_dashboard.html', scoped=True),
+    Stage('Principal', 'Principal_dashboard.html'),
+    Stage('MD', 'md_dashboard.html'),
+    Stage('Accountant', 'accountant_dashboard.html', subject='Action Required: Accountant Final Check',
+          ask='Please process this reimbursement.'),
+]
+STAGES = [s.role for s in PIPELINE]
+STAGES_BY_ROLE = {s.role: s for s in PIPELINE}
+
+for _role, _amount in APPROVAL_SKIP_BELOW.items():
+    if _role not in STAGES_BY_ROLE or _role == STAGES[0]:
+        raise ValueError(f"APPROVAL_SKIP_BELOW: {_role} is not a stage that can be skipped")
+    STAGES_BY_ROLE[_role].skip_below = _amount
+
+
+def get_stage(role):
+    return STAGES_BY_ROLE.get(role)
+
+
+def later_stages(stage):
+    return PIPELINE[PIPELINE.index(stage) + 1:]
+
+
+def previous_stage(stage):
+    position = PIPELINE.index(stage)
+    return PIPELINE[position - 1] if position else None
+
+
+def is_final(stage):
+    # Approving here processes the request.
+    return stage is PIPELINE[-1]
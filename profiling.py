@@ -0,0 +1,77 @@
+# profiling.py - opt-in per-request SQL profiling
+#
+# Enable with QUERY_PROFILING=true. Every statement executed while handling a
+# request is timed through SQLAlchemy engine events; after the request the
+# statement count, total DB time and slowest statements are logged, the same
+# statement text repeated QUERY_PROFILING_REPEAT_THRESHOLD+ times is flagged
+# as a likely N+1, and in debug mode the numbers are also sent back as
+# X-Query-Count / X-Query-Time-ms / Server-Timing headers.
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start'].pop()
+    if has_request_context() and 'query_profile' in g:
+        g.query_profile.append((statement, time.perf_counter() - started))
+
+
+class QueryProfiler:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if not app.config.get('QUERY_PROFILING'):
+            return
+        # Class-level listeners cover every engine (primary and any binds).
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.extensions['query_profiler'] = self
+
+    def _start(self):
+        g.query_profile = []
+
+    def summarize(self, profile):
+        config = self.app.config
+        total = sum(duration for _, duration in profile)
+        slowest = sorted(profile, key=lambda item: item[1], reverse=True)[:config['QUERY_PROFILING_TOP']]
+        repeated = [(statement, count) for statement, count in Counter(s for s, _ in profile).most_common()
+                    if count >= config['QUERY_PROFILING_REPEAT_THRESHOLD']]
+        return {'count': len(profile), 'total_ms': total * 1000, 'slowest': slowest, 'repeated': repeated}
+
+    def _finish(self, response):
+        profile = g.pop('query_profile', None)
+        if profile is None:
+            return response
+        config = self.app.config
+        logger = self.app.logger
+        summary = self.summarize(profile)
+
+        logger.info("%s %s: %d queries, %.1f ms in DB", request.method, request.path,
+                    summary['count'], summary['total_ms'])
+        for statement, duration in summary['slowest']:
+            if duration * 1000 >= config['QUERY_PROFILING_SLOW_MS']:
+                logger.warning("Slow query (%.1f ms) on %s: %s", duration * 1000, request.path, ' '.join(statement.split()))
+        for statement, count in summary['repeated']:
+            logger.warning("Possible N+1 on %s: statement ran %d times: %s", request.path, count, ' '.join(statement.split()))
+
+        if self.app.debug:
+            response.headers['X-Query-Count'] = str(summary['count'])
+            response.headers['X-Query-Time-ms'] = f"{summary['total_ms']:.1f}"
+            response.headers['Server-Timing'] = f"db;dur={summary['total_ms']:.1f};desc=\"{summary['count']} queries\""
+            if summary['repeated']:
+                response.headers['X-Query-Repeated'] = str(len(summary['repeated']))
+        return response
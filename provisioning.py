@@ -0,0 +1,176 @@
+# provisioning.py - bulk user import from CSV
+#
+# CSV columns: name, email, role, department, password (optional). Rows are
+# validated and deduplicated (within the file and against `users`), passwords
+# are hashed on a process pool, and users are inserted in multi-row batches.
+# Rows without a password get an invite token instead: the account is created
+# with an unusable password and the invite link is queued in the mail outbox.
+# Used by the admin upload page and `flask --app app import-users`.
+import csv
+import hashlib
+import multiprocessing
+import re
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select
+from werkzeug.security import generate_password_hash
+
+from models import db, User, UserInvite, OutboxMessage, dialect_insert, invalidate_directory
+
+ROLES = ['Admin', 'Student', 'Teacher', 'HOD', 'Principal', 'MD', 'Accountant']
+DEPARTMENT_ROLES = ['Student', 'Teacher', 'HOD']
+DEPARTMENTS = ['COMPS', 'IT', 'EXTC', 'MECH']
+REQUIRED_COLUMNS = ['name', 'email', 'role']
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+$')
+UNUSABLE_PASSWORD = '!invited'  # never matches check_password_hash
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.invited = 0
+        self.errors = []  # (line number, email, message)
+
+    def error(self, line, email, message):
+        self.errors.append((line, email, message))
+
+
+def _validate(line, row, existing_in_file, send_invites):
+    name = (row.get('name') or '').strip()
+    email = (row.get('email') or '').strip().lower()
+    role = (row.get('role') or '').strip()
+    department = (row.get('department') or '').strip().upper()
+    password = row.get('password') or ''
+
+    if not name:
+        return None, 'name is required'
+    if not EMAIL_RE.match(email):
+        return None, 'invalid email'
+    # Same rule as self-registration.
+    if not (email.endswith('fcrit.ac.in') or email.endswith('gmail.com')):
+        return None, 'only college or Gmail IDs allowed'
+    if role not in ROLES:
+        return None, f"role must be one of {', '.join(ROLES)}"
+    if role in DEPARTMENT_ROLES:
+        if department not in DEPARTMENTS:
+            return None, f"department must be one of {', '.join(DEPARTMENTS)}"
+    else:
+        department = 'None'
+    if not password and not send_invites:
+        return None, 'password is required when invites are not sent'
+    if email in existing_in_file:
+        return None, f'duplicate of line {existing_in_file[email]}'
+    existing_in_file[email] = line
+    return {'name': name, 'email': email, 'role': role, 'department': department, 'password': password}, None
+
+
+def _existing_emails(emails, chunk=1000):
+    found = set()
+    emails = list(emails)
+    for i in range(0, len(emails), chunk):
+        found.update(db.session.execute(select(User.email).where(User.email.in_(emails[i:i + chunk]))).scalars())
+    return found
+
+
+def _hash_passwords(passwords, workers):
+    # scrypt hashing is deliberately slow (~100 ms); spread it over processes.
+    # "spawn" so the pool never forks a threaded web worker.
+    if workers <= 1 or len(passwords) < 8:
+        return [generate_password_hash(p) for p in passwords]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(generate_password_hash, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def import_users(lines, invite_url=None, send_invites=True, dry_run=False, workers=4, batch_size=1000,
+                 invite_ttl=7 * 86400, sender=None):
+    # `lines` is an iterable of CSV text lines (an open file works);
+    # `invite_url(token)` builds the link mailed to invited users.
+    result = ImportResult()
+    reader = csv.DictReader(lines)
+    columns = [c.strip().lower() for c in (reader.fieldnames or [])]
+    missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+    if missing:
+        result.error(1, None, f"missing column(s): {', '.join(missing)}")
+        return result
+    reader.fieldnames = columns
+
+    valid, seen = [], {}
+    for line, row in enumerate(reader, start=2):
+        user, message = _validate(line, row, seen, send_invites)
+        if message:
+            result.error(line, (row.get('email') or '').strip(), message)
+        else:
+            valid.append((line, user))
+
+    existing = _existing_emails(u['email'] for _, u in valid)
+    for line, user in valid:
+        if user['email'] in existing:
+            result.error(line, user['email'], 'already registered')
+    valid = [(line, u) for line, u in valid if u['email'] not in existing]
+    if dry_run:
+        result.created = len(valid)
+        result.invited = sum(1 for _, u in valid if not u['password'])
+        result.errors.sort(key=lambda e: e[0])
+        return result
+
+    with_password = [u for _, u in valid if u['password']]
+    for user, password_hash in zip(with_password, _hash_passwords([u['password'] for u in with_password], workers)):
+        user['password_hash'] = password_hash
+
+    lines_by_email = {u['email']: line for line, u in valid}
+    expires_at = datetime.utcnow() + timedelta(seconds=invite_ttl)
+    for i in range(0, len(valid), batch_size):
+        batch = [u for _, u in valid[i:i + batch_size]]
+        # ON CONFLICT covers users registering themselves while the import runs.
+        inserted = set(db.session.execute(
+            dialect_insert(User).values([{
+                'name': u['name'], 'email': u['email'], 'role': u['role'], 'department': u['department'],
+                'password_hash': u.get('password_hash', UNUSABLE_PASSWORD),
+            } for u in batch]).on_conflict_do_nothing(index_elements=['email']).returning(User.email)
+        ).scalars())
+        for u in batch:
+            if u['email'] not in inserted:
+                result.error(lines_by_email[u['email']], u['email'], 'already registered')
+
+        invites, mails = [], []
+        for u in batch:
+            if u['email'] in inserted and not u['password']:
+                token = secrets.token_urlsafe(32)
+                invites.append({'token_hash': hash_token(token), 'email': u['email'], 'expires_at': expires_at})
+                mails.append({
+                    'subject': 'Your Reimbursement Portal account', 'sender': sender, 'recipients': u['email'],
+                    'body': f"Dear {u['name']},\n\nAn account has been created for you on the Reimbursement Portal. "
+                            f"Set your password here (valid for {invite_ttl // 86400} days):\n\n{invite_url(token)}\n\n"
+                            f"Regards,\nReimbursement Portal",
+                })
+        if invites:
+            db.session.execute(insert(UserInvite), invites)
+            db.session.execute(insert(OutboxMessage), mails)
+        db.session.commit()
+        result.created += len(inserted)
+        result.invited += len(invites)
+
+    invalidate_directory()
+    result.errors.sort(key=lambda e: e[0])
+    return result
+
+
+def redeem_invite(token, password):
+    # Sets the password of an invited user; returns the email or None if the
+    # token is unknown, used or expired.
+    invite = db.session.get(UserInvite, hash_token(token))
+    if invite is None or invite.used_at is not None or invite.expires_at < datetime.utcnow():
+        return None
+    user = User.query.filter_by(email=invite.email).first()
+    if user is None:
+        return None
+    user.password_hash = generate_password_hash(password)
+    invite.used_at = datetime.utcnow()
+    db.session.commit()
+    return user.email
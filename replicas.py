@@ -0,0 +1,115 @@
+# replicas.py - read-only requests served from replica databases
+#
+# DATABASE_REPLICA_URLS lists read replicas of DATABASE_URL (comma separated);
+# each becomes a `replicaN` bind. Views marked @read_replica (dashboards,
+# exports, search) run their SELECTs on a replica; every other view, and every
+# write anywhere, uses the primary (see models.RoutingSession). A read-only
+# request still goes to the primary when
+#   - this session wrote something in the last READ_YOUR_WRITES seconds, so
+#     the dashboard shown right after an approval includes that approval;
+#   - no replica is within REPLICA_MAX_LAG seconds of the primary. Every
+#     REPLICA_CHECK_INTERVAL seconds each process stamps replica_heartbeat on
+#     the primary and compares the replicas' copies of it; a replica that is
+#     behind or unreachable is skipped until it catches up.
+# Locally, point DATABASE_URL and DATABASE_REPLICA_URLS at two SQLite files
+# and copy the first over the second to "replicate".
+import functools
+import random
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, session
+from sqlalchemy import select
+
+from models import db, ReplicaHeartbeat, dialect_insert
+
+WROTE_AT_KEY = 'db_wrote_at'
+
+
+def replica_binds(urls):
+    # DATABASE_REPLICA_URLS -> SQLALCHEMY_BINDS entries
+    return {f'replica{i}': url.strip() for i, url in enumerate((urls or '').split(',')) if url.strip()}
+
+
+class ReplicaRouter:
+    """Chooses a sufficiently fresh replica for read-only requests."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.bind_keys = sorted(k for k in app.config.get('SQLALCHEMY_BINDS') or {} if k.startswith('replica'))
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.read_your_writes = app.config['READ_YOUR_WRITES']
+        self.lags = {}  # bind key -> seconds behind, None if unusable
+        self._next_check = 0
+        self._lock = threading.Lock()
+        app.extensions['replicas'] = self
+        if self.bind_keys:
+            app.after_request(self._remember_writes)
+
+    def _remember_writes(self, response):
+        if db.session.info.get('wrote'):
+            session[WROTE_AT_KEY] = time.time()
+        return response
+
+    def recently_wrote(self):
+        return time.time() - session.get(WROTE_AT_KEY, 0) < self.read_your_writes
+
+    def measure_lags(self):
+        now = datetime.utcnow()
+        try:
+            with db.engine.begin() as conn:
+                primary_beat = conn.execute(select(ReplicaHeartbeat.beat_at).where(ReplicaHeartbeat.id == 1)).scalar()
+                stmt = dialect_insert(ReplicaHeartbeat).values(id=1, beat_at=now)
+                conn.execute(stmt.on_conflict_do_update(index_elements=[ReplicaHeartbeat.id],
+                                                        set_={'beat_at': stmt.excluded.beat_at}))
+        except Exception:
+            self.app.logger.exception('Replica heartbeat failed; reading from the primary')
+            return {key: None for key in self.bind_keys}
+
+        lags = {}
+        for key in self.bind_keys:
+            try:
+                with db.engines[key].connect() as conn:
+                    beat = conn.execute(select(ReplicaHeartbeat.beat_at).where(ReplicaHeartbeat.id == 1)).scalar()
+            except Exception:
+                self.app.logger.warning('Replica %s is unreachable', key, exc_info=True)
+                beat = None
+            if beat is None or primary_beat is None:
+                lags[key] = None
+            elif beat >= primary_beat:
+                # Has everything up to the previous heartbeat.
+                lags[key] = 0.0
+            else:
+                lags[key] = (now - beat).total_seconds()
+        return lags
+
+    def pick(self):
+        # A replica engine, or None to stay on the primary.
+        if not self.bind_keys:
+            return None
+        now = time.monotonic()
+        if now >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self.lags = self.measure_lags()
+                self._next_check = now + self.check_interval
+            finally:
+                self._lock.release()
+        fresh = [key for key, lag in self.lags.items() if lag is not None and lag <= self.max_lag]
+        return db.engines[random.choice(fresh)] if fresh else None
+
+
+def read_replica(view):
+    # Marks a view that only reads: its queries may be served by a replica.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        router = current_app.extensions.get('replicas')
+        if router is not None and router.bind_keys and not router.recently_wrote():
+            db.session.info['replica'] = router.pick()
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,339 @@
+# reports.py - PDF reimbursement reports
+#
+# Styles and the decoded logo are built once per process and shared by every
+# render. Reports are rendered into memory and cached on disk under
+# REPORT_CACHE_DIR, keyed by request id + updated_at, so re-downloads and
+# re-sent mails reuse the same file until the request changes again.
+# reportlab is imported on first render, not when the app starts. Renders are
+# CPU-bound, so they run in a (lazily started) process pool and never compete
+# with request threads for the GIL; the thread pool only waits on them.
+import glob
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from models import get_name_by_email, get_reimbursement
+
+LOGO_PATH = "static/logo.png"
+
+REPORT_FIELDS = [
+    'id', 'email', 'purpose', 'amount', 'letter', 'certificate',
+    'brochure', 'bill', 'status', 'submitted_at',
+    'teacher_status', 'teacher_remarks',
+    'hod_status', 'hod_remarks',
+    'principal_status', 'principal_remarks',
+    'md_status', 'md_remarks',
+    'accountant_status', 'accountant_remarks', 'department'
+]
+
+_assets = None
+_assets_lock = threading.Lock()
+
+
+def _logo_class():
+    from reportlab.platypus import Flowable
+
+    class _Logo(Flowable):
+        # Draws the shared, already decoded ImageReader instead of re-reading
+        # static/logo.png for every document.
+        def __init__(self, reader, width, height):
+            super().__init__()
+            self.reader, self.width, self.height = reader, width, height
+            self.hAlign = 'LEFT'
+
+        def wrap(self, availWidth, availHeight):
+            return self.width, self.height
+
+        def draw(self):
+            self.canv.drawImage(self.reader, 0, 0, self.width, self.height, mask='auto')
+
+    return _Logo
+
+
+def get_assets():
+    global _assets
+    if _assets is None:
+        with _assets_lock:
+            if _assets is None:
+                from reportlab.lib import colors
+                from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+                from reportlab.lib.utils import ImageReader
+                from reportlab.platypus import TableStyle
+
+                styles = getSampleStyleSheet()
+                try:
+                    logo = ImageReader(LOGO_PATH)
+                    logo.getRGBData()  # decode now so concurrent renders only read
+                except Exception:
+                    logo = None
+                _assets = {
+                    'styles': styles,
+                    'bold': styles["Heading4"],
+                    # Optional custom paragraph style for cleaner spacing
+                    'para': ParagraphStyle(name="Custom", parent=styles["Normal"], fontSize=10, leading=14),
+                    'logo': logo,
+                    'logo_flowable': _logo_class(),
+                    'table_style': TableStyle([
+                        ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+                        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+                        ('ALIGN', (1, 1), (-1, -1), 'CENTER'),
+                        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                        ('BOX', (0, 0), (-1, -1), 0.8, colors.black),
+                        ('GRID', (0, 0), (-1, -1), 0.4, colors.grey),
+                        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                        ('FONTSIZE', (0, 0), (-1, -1), 9),
+                        ('LEFTPADDING', (0, 0), (-1, -1), 6),
+                        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+                    ]),
+                }
+    return _assets
+
+
+def generate_reimbursement_report(data, output):
+    # `output` is a path or a writable binary file object.
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
+
+    assets = get_assets()
+    styles, bold, para_style = assets['styles'], assets['bold'], assets['para']
+    doc = SimpleDocTemplate(output, pagesize=A4, rightMargin=40, leftMargin=40, topMargin=60, bottomMargin=30)
+    elements = []
+
+    # Logo
+    if assets['logo'] is not None:
+        elements.append(assets['logo_flowable'](assets['logo'], 60, 60))
+
+    # Heading
+    elements.append(Paragraph("<b>Fr. C Rodrigues Institute of Technology, Vashi</b>", styles["Heading1"]))
+    elements.append(Paragraph("Reimbursement Final Report", styles["Title"]))
+    elements.append(Spacer(1, 12))
+
+    # Student Info
+    elements.append(Paragraph(f"<b>Student Name:</b> {data['student_name']}", para_style))
+    elements.append(Paragraph(f"<b>Email:</b> {data['email']}", para_style))
+    elements.append(Paragraph(f"<b>Department:</b> {data['department']}", para_style))
+    if 'transaction_ref' in data:
+        elements.append(Paragraph(f"<b>Transaction Ref:</b> {data['transaction_ref']}", para_style))
+    elements.append(Spacer(1, 12))
+
+    # Main table
+    table_data = [[
+        Paragraph("<b>Purpose</b>", para_style),
+        Paragraph("<b>Amount (₹)</b>", para_style),
+        Paragraph("<b>Status</b>", para_style),
+        Paragraph("<b>Date Submitted</b>", para_style)
+    ], [
+        Paragraph(data['purpose'], para_style),
+        f"₹{data['amount']}",
+        data['accountant_status'],
+        str(data['submitted_at']).split('.')[0]
+    ]]
+
+    table = Table(table_data, colWidths=[3.2 * inch, 1.2 * inch, 1.2 * inch, 2 * inch])
+    table.setStyle(assets['table_style'])
+    elements.append(table)
+    elements.append(Spacer(1, 20))
+
+    # Remarks sections
+    elements.append(Paragraph("<b>Accountant Remarks:</b>", bold))
+    elements.append(Paragraph(data['accountant_remarks'] or '', para_style))
+    elements.append(Spacer(1, 8))
+
+    # Optional other roles
+    for role in ['teacher', 'hod', 'principal']:
+        status_key = f"{role}_status"
+        remarks_key = f"{role}_remarks"
+        if data.get(status_key) or data.get(remarks_key):
+            elements.append(Paragraph(f"<b>{role.upper()} Status:</b> {data.get(status_key, '')}", para_style))
+            elements.append(Paragraph(f"<b>{role.upper()} Remarks:</b> {data.get(remarks_key, '')}", para_style))
+            elements.append(Spacer(1, 8))
+
+    elements.append(Spacer(1, 30))
+
+    # Signature Line
+    elements.append(Spacer(1, 40))
+    elements.append(Paragraph("__________________________", para_style))
+    elements.append(Paragraph("Signature (Accounts Dept)", para_style))
+    elements.append(Spacer(1, 20))
+
+    # Footer
+    elements.append(Spacer(1, 20))
+    footer = Paragraph("<i>Generated by Reimbursement Portal - FCRIT</i>", para_style)
+    elements.append(footer)
+
+    doc.build(elements)
+
+
+def generate_payout_summary(department, period, claims, output):
+    # Consolidated list of a department's processed claims for one period.
+    # `claims` are dicts with id, student_name, email, purpose, amount, processed_at.
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
+
+    assets = get_assets()
+    styles, para_style = assets['styles'], assets['para']
+    doc = SimpleDocTemplate(output, pagesize=A4, rightMargin=40, leftMargin=40, topMargin=60, bottomMargin=30)
+    elements = []
+
+    if assets['logo'] is not None:
+        elements.append(assets['logo_flowable'](assets['logo'], 60, 60))
+    elements.append(Paragraph("<b>Fr. C Rodrigues Institute of Technology, Vashi</b>", styles["Heading1"]))
+    elements.append(Paragraph("Reimbursement Payout Summary", styles["Title"]))
+    elements.append(Paragraph(f"<b>Department:</b> {department}", para_style))
+    elements.append(Paragraph(f"<b>Period:</b> {period}", para_style))
+    elements.append(Spacer(1, 12))
+
+    total = sum(c['amount'] for c in claims)
+    table_data = [[Paragraph(f"<b>{h}</b>", para_style) for h in ("ID", "Student", "Purpose", "Amount (₹)", "Processed")]]
+    for c in claims:
+        table_data.append([
+            str(c['id']),
+            Paragraph(f"{c['student_name']}<br/>{c['email']}", para_style),
+            Paragraph(c['purpose'], para_style),
+            f"₹{c['amount']:.2f}",
+            c['processed_at'].strftime('%Y-%m-%d') if c['processed_at'] else '',
+        ])
+    table_data.append(['', Paragraph(f"<b>{len(claims)} claim(s)</b>", para_style), '', f"₹{total:.2f}", ''])
+
+    # repeatRows keeps the header on every page of a long department list.
+    table = Table(table_data, colWidths=[0.6 * inch, 2.2 * inch, 2.6 * inch, 1 * inch, 1 * inch], repeatRows=1)
+    table.setStyle(assets['table_style'])
+    elements.append(table)
+    elements.append(Spacer(1, 40))
+    elements.append(Paragraph("__________________________", para_style))
+    elements.append(Paragraph("Signature (Accounts Dept)", para_style))
+    elements.append(Spacer(1, 20))
+    elements.append(Paragraph("<i>Generated by Reimbursement Portal - FCRIT</i>", para_style))
+
+    doc.build(elements)
+
+
+def render_report(data):
+    buffer = io.BytesIO()
+    generate_reimbursement_report(data, buffer)
+    return buffer.getvalue()
+
+
+def report_data(reimb):
+    data = {field: getattr(reimb, field) for field in REPORT_FIELDS}
+    data['student_name'] = get_name_by_email(reimb.email) or reimb.email
+    return data
+
+
+class ReportService:
+    """Renders reports on a thread pool into the on-disk report cache."""
+
+    def __init__(self, app=None):
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.executor = None
+        self._processes = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.cache_dir = app.config['REPORT_CACHE_DIR']
+        self.wait = app.config['REPORT_WAIT']
+        self.executor = ThreadPoolExecutor(max_workers=app.config['REPORT_WORKERS'],
+                                           thread_name_prefix='report-render')
+        app.extensions['reports'] = self
+
+    def _render(self, data):
+        # Started on first use so `gunicorn --preload` never forks a pool.
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self.app.config['REPORT_WORKERS'],
+                                                      mp_context=multiprocessing.get_context('spawn'))
+        return self._processes.submit(render_report, data).result()
+
+    def _cache_path(self, reimb):
+        stamp = (reimb.updated_at or reimb.submitted_at).strftime('%Y%m%d%H%M%S%f')
+        return os.path.join(self.cache_dir, f"{reimb.id}-{stamp}.pdf")
+
+    def cached_path(self, reimb):
+        # Path of an already rendered, current PDF, or None.
+        path = self._cache_path(reimb)
+        return path if os.path.exists(path) else None
+
+    def get_path(self, req_id):
+        # Path of the cached PDF, rendering it first if needed. Concurrent
+        # callers for the same version wait on a single render.
+        reimb = get_reimbursement(req_id)
+        if reimb is None:
+            return None
+        path = self._cache_path(reimb)
+        if os.path.exists(path):
+            return path
+
+        with self._lock:
+            pending = self._inflight.get(path)
+            if pending is None:
+                pending = self._inflight[path] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return pending.result()
+
+        try:
+            pdf = self._render(report_data(reimb))
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(pdf)
+            os.replace(tmp_path, path)
+            # Older versions only; readers that opened one keep their handle.
+            for stale in glob.glob(os.path.join(self.cache_dir, f"{reimb.id}-*.pdf")):
+                if stale != path:
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+            pending.set_result(path)
+            return path
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(path, None)
+
+    def get_pdf(self, req_id):
+        # A newer render may remove the file between get_path and open.
+        for attempt in range(3):
+            path = self.get_path(req_id)
+            if path is None:
+                return None
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def _render_task(self, req_id):
+        with self.app.app_context():
+            return self.get_path(req_id)
+
+    def submit(self, req_id):
+        # Render in the background (e.g. right after the final approval).
+        return self.executor.submit(self._render_task, req_id)
+
+    def fetch(self, reimb):
+        # Cached path for a request the caller already loaded; a miss is
+        # rendered on the pool rather than in the calling (request) thread.
+        # None if it is not ready within REPORT_WAIT seconds; the render
+        # carries on and a later call finds it cached.
+        path = self._cache_path(reimb)
+        if os.path.exists(path):
+            return path
+        try:
+            return self.submit(reimb.id).result(timeout=self.wait)
+        except FutureTimeout:
+            return None
@@ -0,0 +1,126 @@
+# search.py - full-text search over reimbursement requests
+#
+# Searches purpose, student email and all approver remarks. Every word of the
+# query is a prefix ("conf hack" finds "Conference ... hackathon"), all words
+# must match, and results are ranked with purpose matches weighted highest.
+#
+# Postgres: a generated tsvector column on reimb_form with a GIN index.
+# SQLite: an FTS5 table kept in sync by triggers (local runs).
+# Both are installed by migration 0005; other databases fall back to LIKE.
+import re
+
+from sqlalchemy import column, literal_column, or_, table, text, tuple_
+
+from models import db, Reimbursement, PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, decode_cursor
+
+REMARK_COLUMNS = ['teacher_remarks', 'hod_remarks', 'principal_remarks', 'md_remarks', 'accountant_remarks']
+MAX_TERMS = 8
+
+
+def _remarks_sql(prefix=''):
+    return " || ' ' || ".join(f"coalesce({prefix}{c}, '')" for c in REMARK_COLUMNS)
+
+
+# Emails are indexed whole and split on '.'/'@' so any part can be searched.
+PG_VECTOR = f"""
+    setweight(to_tsvector('simple', coalesce(purpose, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(email, '') || ' ' || translate(coalesce(email, ''), '.@', '  ')), 'B') ||
+    setweight(to_tsvector('simple', {_remarks_sql()}), 'C')
+"""
+
+SQLITE_ROW = "new.id, new.purpose, new.email, {remarks}".format(remarks=_remarks_sql('new.'))
+
+
+def install_search_index():
+    # Idempotent; run from migrations.
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        db.session.execute(text(
+            f"ALTER TABLE reimb_form ADD COLUMN IF NOT EXISTS search_vector tsvector "
+            f"GENERATED ALWAYS AS ({PG_VECTOR}) STORED"
+        ))
+        db.session.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_reimb_search_vector ON reimb_form USING GIN (search_vector)"
+        ))
+    elif dialect == 'sqlite':
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS reimb_search USING fts5(purpose, email, remarks)"
+        ))
+        db.session.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS reimb_search_insert AFTER INSERT ON reimb_form BEGIN
+                INSERT INTO reimb_search (rowid, purpose, email, remarks) VALUES ({SQLITE_ROW});
+            END
+        """))
+        db.session.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS reimb_search_update
+            AFTER UPDATE OF purpose, email, {', '.join(REMARK_COLUMNS)} ON reimb_form BEGIN
+                DELETE FROM reimb_search WHERE rowid = old.id;
+                INSERT INTO reimb_search (rowid, purpose, email, remarks) VALUES ({SQLITE_ROW});
+            END
+        """))
+        db.session.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS reimb_search_delete AFTER DELETE ON reimb_form BEGIN
+                DELETE FROM reimb_search WHERE rowid = old.id;
+            END
+        """))
+        db.session.execute(text("DELETE FROM reimb_search"))
+        db.session.execute(text(
+            f"INSERT INTO reimb_search (rowid, purpose, email, remarks) "
+            f"SELECT id, purpose, email, {_remarks_sql()} FROM reimb_form"
+        ))
+
+
+def search_terms(q):
+    # Words only: everything else is dropped, so terms are safe to splice
+    # into tsquery / FTS5 syntax.
+    return re.findall(r'\w+', (q or '').lower())[:MAX_TERMS]
+
+
+def _ranked_query(terms):
+    # (query of (Reimbursement, rank), rank expression); higher rank is better.
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        vector = literal_column('reimb_form.search_vector')
+        tsquery = db.func.to_tsquery('simple', ' & '.join(f'{t}:*' for t in terms))
+        rank = db.func.ts_rank_cd(vector, tsquery)
+        return db.session.query(Reimbursement, rank.label('rank')).filter(vector.op('@@')(tsquery)), rank
+    if dialect == 'sqlite':
+        fts = table('reimb_search', column('rowid'))
+        # bm25 is lower-is-better; weights are purpose, email, remarks
+        rank = -db.func.bm25(literal_column('reimb_search'), 10.0, 5.0, 1.0)
+        query = (db.session.query(Reimbursement, rank.label('rank'))
+                 .join(fts, fts.c.rowid == Reimbursement.id)
+                 .filter(literal_column('reimb_search').op('MATCH')(' '.join(f'"{t}"*' for t in terms))))
+        return query, rank
+    # Unindexed fallback: every word must appear somewhere, no ranking.
+    query = db.session.query(Reimbursement, db.literal(0.0).label('rank'))
+    for t in terms:
+        columns = [Reimbursement.purpose, Reimbursement.email] + [getattr(Reimbursement, c) for c in REMARK_COLUMNS]
+        query = query.filter(or_(*[c.ilike(f'%{t}%') for c in columns]))
+    return query, db.literal(0.0)
+
+
+def search_reimbursements(q, stage=None, department=None, cursor=None, limit=PAGE_SIZE):
+    # Returns (rows, next_cursor), best matches first. Each row is a
+    # Reimbursement with a `search_rank` attribute.
+    terms = search_terms(q)
+    if not terms:
+        return [], None
+    limit = max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+
+    query, rank = _ranked_query(terms)
+    if stage:
+        query = query.filter(Reimbursement.stage == stage)
+    if department:
+        query = query.filter(Reimbursement.department == department)
+    position = decode_cursor(cursor) if cursor else None
+    if position and position[0] == 'search_rank':
+        query = query.filter(tuple_(rank, Reimbursement.id) < (position[1], position[2]))
+
+    results = query.order_by(rank.desc(), Reimbursement.id.desc()).limit(limit + 1).all()
+    rows = []
+    for reimb, score in results:
+        reimb.search_rank = score
+        rows.append(reimb)
+    next_cursor = encode_cursor('search_rank', rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,205 @@
+# sessions.py - server-side sessions
+#
+# Flask's default session lives in a cookie signed with SECRET_KEY; here the
+# cookie only carries a signed random id and the data is kept in a shared
+# store, so any worker on any host can serve any request. Sessions expire
+# after SESSION_LIFETIME once logged in and SESSION_ANONYMOUS_LIFETIME before
+# (registration / OTP). Expired entries are swept periodically by each process
+# and by `flask --app app sweep-sessions`.
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, select
+from werkzeug.datastructures import CallbackDict
+
+from models import db, ServerSession, dialect_insert
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        # Issue a new id on the next save (call on login to prevent fixation).
+        self.rotate = True
+        self.modified = True
+
+
+class SessionStore:
+    """Where session data lives, keyed by session id."""
+
+    def load(self, sid):
+        # Returns (data, expires_at), or None if missing or expired.
+        raise NotImplementedError
+
+    def save(self, sid, data, expires_at):
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def sweep(self):
+        # Remove expired entries, returning how many were removed.
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Per-process store for tests and single-process development."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        entry = self._data.get(sid)
+        if entry is None or entry[1] <= datetime.utcnow():
+            return None
+        return serializer.loads(entry[0]), entry[1]
+
+    def save(self, sid, data, expires_at):
+        with self._lock:
+            self._data[sid] = (serializer.dumps(data), expires_at)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def sweep(self):
+        now = datetime.utcnow()
+        with self._lock:
+            expired = [sid for sid, (_, expires_at) in self._data.items() if expires_at <= now]
+            for sid in expired:
+                del self._data[sid]
+        return len(expired)
+
+
+class DatabaseSessionStore(SessionStore):
+    """Sessions in the user_sessions table, shared by every worker and host."""
+
+    # Own short transactions on the engine, so saving the session never
+    # commits (or gets rolled back with) whatever the request left in db.session.
+    def load(self, sid):
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                select(ServerSession.data, ServerSession.expires_at)
+                .where(ServerSession.id == sid, ServerSession.expires_at > datetime.utcnow())
+            ).first()
+        if row is None:
+            return None
+        return serializer.loads(row.data), row.expires_at
+
+    def save(self, sid, data, expires_at):
+        stmt = dialect_insert(ServerSession).values(id=sid, data=serializer.dumps(data), expires_at=expires_at)
+        stmt = stmt.on_conflict_do_update(index_elements=[ServerSession.id],
+                                          set_={'data': stmt.excluded.data, 'expires_at': stmt.excluded.expires_at})
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def delete(self, sid):
+        with db.engine.begin() as conn:
+            conn.execute(delete(ServerSession).where(ServerSession.id == sid))
+
+    def sweep(self):
+        with db.engine.begin() as conn:
+            return conn.execute(delete(ServerSession).where(ServerSession.expires_at <= datetime.utcnow())).rowcount
+
+
+SESSION_STORES = {
+    'database': DatabaseSessionStore,
+    'memory': MemorySessionStore,
+}
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+        self._last_sweep = time.monotonic()
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-session')
+
+    def lifetime(self, app, session):
+        seconds = app.config['SESSION_LIFETIME'] if 'user_id' in session else app.config['SESSION_ANONYMOUS_LIFETIME']
+        return timedelta(seconds=seconds)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            loaded = self.store.load(sid) if sid else None
+            if loaded is not None:
+                data, expires_at = loaded
+                return ServerSideSession(data, sid=sid, expires_at=expires_at)
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        self._maybe_sweep(app)
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = datetime.utcnow()
+        lifetime = self.lifetime(app, session)
+        # Sliding expiry without a write on every request: unchanged sessions
+        # are only re-saved once less than half their lifetime remains.
+        refresh_due = session.expires_at is None or session.expires_at - now < lifetime / 2
+        if not (session.modified or session.rotate or refresh_due):
+            return
+
+        if session.sid is None or session.rotate:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        self.store.save(session.sid, dict(session), now + lifetime)
+
+        response.set_cookie(
+            name, self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path, secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app),
+        )
+        response.vary.add('Cookie')
+
+    def _maybe_sweep(self, app):
+        if time.monotonic() - self._last_sweep < app.config['SESSION_SWEEP_INTERVAL']:
+            return
+        self._last_sweep = time.monotonic()
+        try:
+            self.store.sweep()
+        except Exception:
+            app.logger.exception('Session sweep failed')
+
+
+def init_sessions(app):
+    # SESSION_BACKEND=cookie keeps Flask's signed-cookie sessions.
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'cookie':
+        return
+    store = SESSION_STORES[backend]()
+    app.session_interface = ServerSessionInterface(store)
+    app.extensions['sessions'] = store
+
+
+def regenerate_session(session):
+    # New session id after login; signed-cookie sessions have no id to rotate.
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
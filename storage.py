@@ -0,0 +1,175 @@
+# storage.py - content-addressed storage for uploaded documents
+#
+# Uploads are streamed to disk in chunks while the multipart body is parsed,
+# hashing as they go, so a file is never held in memory and an oversized file
+# is rejected as soon as it crosses UPLOAD_MAX_FILE_SIZE. Each blob is stored
+# once under "<sha256>.<ext>"; resubmitting the same brochure only adds a
+# reference row (see models.ReimbursementDocument). Since a key never changes
+# content, downloads carry the hash as a strong ETag and long-lived
+# Cache-Control (UPLOAD_CACHE_MAX_AGE).
+import hashlib
+import os
+import shutil
+import tempfile
+
+from flask import Request, abort, current_app, send_file, send_from_directory
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+
+ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'pdf'])
+CHUNK_SIZE = 64 * 1024
+
+
+class StoredFile:
+    def __init__(self, key, sha256, size):
+        self.key, self.sha256, self.size = key, sha256, size
+
+
+class StorageBackend:
+    """Where blobs live. Keys are "<sha256>.<ext>" and never change content."""
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def put(self, key, local_path):
+        # Take ownership of a finished local temp file.
+        raise NotImplementedError
+
+    def serve(self, key):
+        # A Flask response for downloading the blob.
+        raise NotImplementedError
+
+    def temp_dir(self):
+        # Directory for in-flight uploads (same filesystem as put() targets
+        # where possible, so put() can be a rename).
+        return tempfile.gettempdir()
+
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        # None for keys that would escape the storage root
+        return safe_join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key):
+        path = self.path(key)
+        return path is not None and os.path.exists(path)
+
+    def put(self, key, local_path):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(local_path, target)
+
+    def serve(self, key):
+        path = self.path(key)
+        if path is None:
+            abort(404)
+        if os.path.exists(path):
+            # The key is the content hash: a strong ETag, and safe to keep for
+            # as long as the browser likes. private, as downloads need a login.
+            response = send_file(os.path.abspath(path), etag=key.split('.', 1)[0],
+                                 max_age=current_app.config['UPLOAD_CACHE_MAX_AGE'])
+            response.cache_control.public = False
+            response.cache_control.private = True
+            response.cache_control.immutable = True
+            return response
+        # Files uploaded before content addressing live flat in the root.
+        return send_from_directory(self.root, key)
+
+    def temp_dir(self):
+        # Created on first upload rather than at startup.
+        path = os.path.join(self.root, '.tmp')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+
+class HashingSpool:
+    """Writable temp file that hashes and size-checks every chunk written."""
+
+    def __init__(self, directory, max_size):
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.max_size = max_size
+        self.claimed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            # The parser drops this part, so nothing else will close it.
+            self.close()
+            raise RequestEntityTooLarge(f"Each file must be at most {self.max_size // (1024 * 1024)} MB")
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        self._file.close()
+        if not self.claimed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        storage = current_app.extensions['storage']
+        spool = HashingSpool(storage.temp_dir(), current_app.config['UPLOAD_MAX_FILE_SIZE'])
+        self.__dict__.setdefault('_spools', []).append(spool)
+        return spool
+
+    def close(self):
+        # Flask calls this when the request ends. Also covers spools that
+        # never reached request.files because a later part was rejected.
+        super().close()
+        for spool in self.__dict__.get('_spools', ()):
+            spool.close()
+
+
+def init_storage(app):
+    app.extensions['storage'] = LocalStorage(app.config['UPLOAD_FOLDER'])
+    app.request_class = UploadRequest
+    # Whole-request cap, enforced by werkzeug from Content-Length before
+    # anything is read.
+    app.config['MAX_CONTENT_LENGTH'] = app.config['UPLOAD_MAX_REQUEST_SIZE']
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def store_upload(file_obj):
+    # Returns a StoredFile, or None when no (allowed) file was sent.
+    if not file_obj or not file_obj.filename or not allowed_file(file_obj.filename):
+        return None
+    storage = current_app.extensions['storage']
+    ext = file_obj.filename.rsplit('.', 1)[1].lower()
+    spool = file_obj.stream
+
+    # Spools written by UploadRequest are closed (and removed unless claimed)
+    # when the request ends; anything else is copied in chunks and closed here.
+    owned = not isinstance(spool, HashingSpool)
+    if owned:
+        spool = HashingSpool(storage.temp_dir(), current_app.config['UPLOAD_MAX_FILE_SIZE'])
+    try:
+        if owned:
+            shutil.copyfileobj(file_obj.stream, spool, CHUNK_SIZE)
+        spool.flush()
+        key = f"{spool.hexdigest()}.{ext}"
+        if not storage.exists(key):
+            storage.put(key, spool.path)
+            spool.claimed = True
+        return StoredFile(key, spool.hexdigest(), spool.size)
+    finally:
+        if owned:
+            spool.close()
+
+
+def serve_upload(key):
+    return current_app.extensions['storage'].serve(key)
@@ -7,3 +7,282 @@ env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
 print("ENV:", os.getenv("DATABASE_URL"))
+
+# Run with `python -m pytest -q test.py`. Each test gets its own SQLite file;
+# the module-level app that `import app` builds is pointed at a scratch file
+# too, so the tests never touch the database from .env.
+import smtplib
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+os.environ['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp(prefix='rms-test-')}/import.db"
+os.environ['MAIL_OUTBOX_WORKERS'] = '0'
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app import create_app, mail
+from mailer import claim_batch, drain_outbox
+from migrations import run_migrations
+from pipeline import PIPELINE, STAGES
+from models import db, insert_user, insert_reimbursement, NotificationEvent, OutboxMessage, Reimbursement, \
+    compute_summary, enqueue_email, get_summary, set_notify_mode
+
+
+@pytest.fixture
+def flask_app(tmp_path):
+    flask_app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'REPORT_CACHE_DIR': str(tmp_path / 'report_cache'),
+        'PAYOUT_DIR': str(tmp_path / 'payout_reports'),
+        'MAIL_OUTBOX_WORKERS': 0,
+        'MAIL_USERNAME': 'portal@fcrit.ac.in',
+    })
+    with flask_app.app_context():
+        db.create_all()
+        run_migrations(echo=lambda *a: None)
+    yield flask_app
+    with flask_app.app_context():
+        db.engine.dispose()
+
+
+def add_user(flask_app, email, role, department='CS', password='pw'):
+    with flask_app.app_context():
+        insert_user(email.split('@')[0], email, generate_password_hash(password), role, department)
+
+
+def add_request(flask_app, email, amount=100, stage=None):
+    # A submitted request, optionally moved straight to `stage` (earlier
+    # stages approved); returns its id.
+    with flask_app.app_context():
+        reimb = insert_reimbursement(email, 'Conference', amount, 'l.pdf', 'c.pdf', 'b.pdf', 'bill.pdf')
+        if stage is not None:
+            for earlier in PIPELINE[:STAGES.index(stage)]:
+                setattr(reimb, f'{earlier.prefix}_status', 'Approved')
+            reimb.stage, reimb.status = stage, f'Pending {stage}'
+        db.session.commit()
+        return reimb.id
+
+
+def login(flask_app, email, password='pw'):
+    client = flask_app.test_client()
+    response = client.post('/login', data={'email': email, 'password': password})
+    assert response.status_code == 302
+    return client
+
+
+# ------------------ STARTUP ------------------
+def test_startup_needs_no_database_and_no_reportlab():
+    # A fresh interpreter against an unreachable database: importing the app
+    # and building another one must neither connect nor pull in reportlab.
+    probe = "import sys, app; app.create_app(); print('reportlab' in sys.modules)"
+    env = dict(os.environ, DATABASE_URL='sqlite:////nonexistent/rms/unreachable.db')
+    out = subprocess.run([sys.executable, '-c', probe], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, timeout=120)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.split()[-1] == 'False', 'reportlab is imported at startup'
+
+
+# ------------------ MAIL OUTBOX ------------------
+class FakeSMTP:
+    # Stands in for smtplib.SMTP: records what Flask-Mail hands over and
+    # refuses the first `failures` messages like a busy server would.
+    sent = []
+    failures = 0
+
+    def __init__(self, host, port):
+        pass
+
+    def set_debuglevel(self, level):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, username, password):
+        pass
+
+    def sendmail(self, sender, recipients, message, *options):
+        if FakeSMTP.failures:
+            FakeSMTP.failures -= 1
+            raise smtplib.SMTPResponseException(421, b'Service not available, try again later')
+        FakeSMTP.sent.append(recipients)
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    monkeypatch.setattr(FakeSMTP, 'sent', [])
+    monkeypatch.setattr(FakeSMTP, 'failures', 0)
+    monkeypatch.setattr(smtplib, 'SMTP', FakeSMTP)
+    return FakeSMTP
+
+
+def queue_mail(flask_app, recipient='student@fcrit.ac.in'):
+    with flask_app.app_context():
+        msg = enqueue_email('Request Submitted', [recipient], 'Your request was submitted.', sender='portal@fcrit.ac.in')
+        db.session.commit()
+        return msg.id
+
+
+def outbox_row(flask_app, msg_id):
+    with flask_app.app_context():
+        return db.session.get(OutboxMessage, msg_id)
+
+
+def rewind(flask_app, msg_id, seconds):
+    # Moves the message's next attempt into the past instead of sleeping.
+    with flask_app.app_context():
+        msg = db.session.get(OutboxMessage, msg_id)
+        msg.next_attempt_at -= timedelta(seconds=seconds)
+        db.session.commit()
+
+
+def test_outbox_delivers_queued_mail(flask_app, smtp):
+    msg_id = queue_mail(flask_app)
+
+    assert drain_outbox(flask_app, mail) == 1
+    assert smtp.sent == [['student@fcrit.ac.in']]
+    row = outbox_row(flask_app, msg_id)
+    assert (row.status, row.attempts, row.last_error) == ('sent', 0, None)
+    assert row.sent_at is not None
+    # Nothing is delivered twice.
+    assert drain_outbox(flask_app, mail) == 0
+
+
+def test_outbox_retries_after_a_transient_failure(flask_app, smtp):
+    msg_id = queue_mail(flask_app)
+    smtp.failures = 1
+
+    before = datetime.utcnow()
+    assert drain_outbox(flask_app, mail) == 0
+    row = outbox_row(flask_app, msg_id)
+    assert (row.status, row.attempts) == ('pending', 1)
+    assert '421' in row.last_error
+    backoff = timedelta(seconds=flask_app.config['MAIL_OUTBOX_BACKOFF_BASE'])
+    assert row.next_attempt_at >= before + backoff
+    # Not retried before the backoff is up ...
+    assert drain_outbox(flask_app, mail) == 0
+    assert smtp.sent == []
+
+    # ... and delivered once it is.
+    rewind(flask_app, msg_id, flask_app.config['MAIL_OUTBOX_BACKOFF_BASE'])
+    assert drain_outbox(flask_app, mail) == 1
+    assert smtp.sent == [['student@fcrit.ac.in']]
+    row = outbox_row(flask_app, msg_id)
+    assert (row.status, row.attempts, row.last_error) == ('sent', 1, None)
+
+
+def test_outbox_message_is_reclaimed_after_its_lease_expires(flask_app, smtp):
+    msg_id = queue_mail(flask_app)
+    lease = flask_app.config['MAIL_OUTBOX_LEASE']
+
+    # A worker claims the message and dies before sending it.
+    with flask_app.app_context():
+        assert [m.id for m in claim_batch(10, lease)] == [msg_id]
+    assert outbox_row(flask_app, msg_id).status == 'sending'
+    # While the lease holds, no other worker gets it.
+    with flask_app.app_context():
+        assert claim_batch(10, lease) == []
+    assert drain_outbox(flask_app, mail) == 0
+
+    rewind(flask_app, msg_id, lease)
+    assert drain_outbox(flask_app, mail) == 1
+    assert smtp.sent == [['student@fcrit.ac.in']]
+    assert outbox_row(flask_app, msg_id).status == 'sent'
+
+
+# ------------------ NOTIFICATIONS ------------------
+def test_final_report_reaches_digest_mode_teachers(flask_app):
+    add_user(flask_app, 'student@fcrit.ac.in', 'Student')
+    add_user(flask_app, 'teacher@fcrit.ac.in', 'Teacher')
+    add_user(flask_app, 'accountant@fcrit.ac.in', 'Accountant', department='None')
+    with flask_app.app_context():
+        set_notify_mode('teacher@fcrit.ac.in', 'daily')
+    req_id = add_request(flask_app, 'student@fcrit.ac.in', stage='Accountant')
+
+    accountant = login(flask_app, 'accountant@fcrit.ac.in')
+    response = accountant.post(f'/accountant_approve/{req_id}', data={'remarks': 'paid', 'action': 'approve'})
+    assert response.status_code == 302
+
+    with flask_app.app_context():
+        assert db.session.get(Reimbursement, req_id).stage == 'Processed'
+        reports = OutboxMessage.query.filter_by(report_id=req_id).all()
+        assert [m.recipients for m in reports] == ['teacher@fcrit.ac.in']
+        # Nothing about the report is held back for the daily digest.
+        assert NotificationEvent.query.filter_by(recipient='teacher@fcrit.ac.in').count() == 0
+
+
+# ------------------ CONCURRENT APPROVALS ------------------
+def pop_flashes(client):
+    with client.session_transaction() as sess:
+        return sess.pop('_flashes', [])
+
+
+def assert_summary_consistent(flask_app):
+    # The rollup maintained by every transition matches a recount of the table.
+    with flask_app.app_context():
+        expected = {}
+        for department, stage, _, count, _ in compute_summary():
+            expected[(department, stage)] = expected.get((department, stage), 0) + count
+        rollup = {(c['department'], c['stage']): c['count'] for c in get_summary()}
+        assert rollup == {k: v for k, v in expected.items() if v}
+
+
+def race(clients, post):
+    # Runs post(client, i) for every client at the same instant.
+    barrier = threading.Barrier(len(clients))
+
+    def run(i):
+        barrier.wait()
+        return post(clients[i], i)
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        return list(pool.map(run, range(len(clients))))
+
+
+def test_concurrent_approvals_of_one_request_have_one_winner(flask_app):
+    add_user(flask_app, 'student@fcrit.ac.in', 'Student')
+    add_user(flask_app, 'teacher@fcrit.ac.in', 'Teacher')
+    req_id = add_request(flask_app, 'student@fcrit.ac.in')
+    clients = [login(flask_app, 'teacher@fcrit.ac.in') for _ in range(8)]
+    for client in clients:
+        pop_flashes(client)
+
+    responses = race(clients, lambda client, i: client.post(
+        f'/teacher_approve/{req_id}', data={'remarks': f'teacher {i}', 'action': 'approve', 'version': 1}))
+
+    assert [r.status_code for r in responses] == [302] * len(clients)
+    outcomes = [[category for category, _ in pop_flashes(client)] for client in clients]
+    winners = [i for i, categories in enumerate(outcomes) if categories == ['success']]
+    assert len(winners) == 1
+    assert all(categories == ['warning'] for i, categories in enumerate(outcomes) if i not in winners)
+    with flask_app.app_context():
+        reimb = db.session.get(Reimbursement, req_id)
+        assert (reimb.stage, reimb.version, reimb.teacher_remarks) == ('HOD', 2, f'teacher {winners[0]}')
+    assert_summary_consistent(flask_app)
+
+
+def test_concurrent_bulk_approvals_move_each_request_once(flask_app):
+    add_user(flask_app, 'student@fcrit.ac.in', 'Student')
+    add_user(flask_app, 'teacher@fcrit.ac.in', 'Teacher')
+    add_user(flask_app, 'hod@fcrit.ac.in', 'HOD')
+    ids = [add_request(flask_app, 'student@fcrit.ac.in', amount=100 + i) for i in range(10)]
+    clients = [login(flask_app, 'teacher@fcrit.ac.in') for _ in range(6)]
+
+    race(clients, lambda client, i: client.post(
+        '/bulk_approve', data={'ids': [str(x) for x in ids], 'action': 'approve', 'remarks': f'bulk {i}'}))
+
+    with flask_app.app_context():
+        rows = Reimbursement.query.filter(Reimbursement.id.in_(ids)).all()
+        assert {(r.stage, r.version) for r in rows} == {('HOD', 2)}
+        # One HOD notification per request that actually moved.
+        notified = OutboxMessage.query.filter(OutboxMessage.subject.startswith('Action Required: HOD Approval')).all()
+        assert sum(m.body.count('Request ') for m in notified) == len(ids)
+    assert_summary_consistent(flask_app)